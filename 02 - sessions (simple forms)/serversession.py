@@ -0,0 +1,373 @@
+# Server-side sessions for Flask.
+#
+# Flask normally keeps the whole session in a signed cookie: every response
+# re-serializes and re-signs it, and the cookie (which the browser sends with
+# every request) grows with everything put in the session. This module keeps
+# the session data on the server instead. The cookie holds only a long random
+# session ID, which means nothing by itself.
+#
+#   app.session_interface = ServerSessionInterface(MemoryStore())
+#
+# Session data is stored in a compact binary form (see encode and decode) and
+# only written back when it changed. Expired sessions are cleared out by a
+# background thread.
+#
+# Call session.regenerate() whenever the user logs in or out. The session
+# then gets a new ID, so an ID that someone else planted in the browser (or
+# saw before the login) is of no use to them ("session fixation").
+
+import logging
+import secrets
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from flask.sessions import SessionInterface, SessionMixin
+from markupsafe import Markup
+from werkzeug.datastructures import CallbackDict
+
+log = logging.getLogger(__name__)
+
+
+# Encoding ########################################
+#
+# Each value is a one-byte type tag followed by its contents. Whole numbers
+# and lengths are varints (7 bits per byte), so small ones take one byte.
+# This handles what sessions normally hold: None, booleans, numbers,
+# strings, bytes, lists, tuples, and dictionaries of those, plus the extra
+# types Flask's own session cookie handles: Markup (as in flashed messages),
+# datetimes, and UUIDs. Anything else raises TypeError when the session is saved.
+
+def _write_varint(out, number):
+    while number >= 0x80:
+        out.append((number & 0x7f) | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _read_varint(data, position):
+    number = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, position
+        shift += 7
+
+
+def _encode(value, out):
+    if value is None:
+        out += b'N'
+    elif value is True:
+        out += b'T'
+    elif value is False:
+        out += b'F'
+    elif isinstance(value, int):
+        out += b'I'
+        _write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)  # Small negatives stay small.
+    elif isinstance(value, float):
+        out += b'D' + struct.pack('<d', value)
+    elif isinstance(value, Markup):
+        # Before str, since Markup is a str that is already safe HTML.
+        out += b'H'
+        raw = value.encode('utf-8')
+        _write_varint(out, len(raw))
+        out += raw
+    elif isinstance(value, datetime):
+        out += b'W'
+        raw = value.isoformat().encode('ascii')
+        _write_varint(out, len(raw))
+        out += raw
+    elif isinstance(value, uuid.UUID):
+        out += b'X' + value.bytes
+    elif isinstance(value, (str, bytes)):
+        raw = value.encode('utf-8') if isinstance(value, str) else value
+        out += b'S' if isinstance(value, str) else b'B'
+        _write_varint(out, len(raw))
+        out += raw
+    elif isinstance(value, (list, tuple)):
+        out += b'L' if isinstance(value, list) else b'U'
+        _write_varint(out, len(value))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out += b'M'
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    else:
+        raise TypeError("Can't store {!r} in the session (a {})".format(value, type(value).__name__))
+
+
+def _decode(data, position):
+    tag = data[position:position + 1]
+    position += 1
+    if tag == b'N':
+        return None, position
+    if tag == b'T':
+        return True, position
+    if tag == b'F':
+        return False, position
+    if tag == b'I':
+        number, position = _read_varint(data, position)
+        return (number >> 1 if not number & 1 else -(number >> 1) - 1), position
+    if tag == b'D':
+        return struct.unpack_from('<d', data, position)[0], position + 8
+    if tag in (b'S', b'B', b'H', b'W'):
+        length, position = _read_varint(data, position)
+        raw = bytes(data[position:position + length])
+        if len(raw) != length:
+            raise ValueError('Bad session data (truncated)')
+        if tag == b'B':
+            return raw, position + length
+        text = raw.decode('utf-8')
+        if tag == b'H':
+            return Markup(text), position + length
+        if tag == b'W':
+            return datetime.fromisoformat(text), position + length
+        return text, position + length
+    if tag == b'X':
+        raw = bytes(data[position:position + 16])
+        if len(raw) != 16:
+            raise ValueError('Bad session data (truncated)')
+        return uuid.UUID(bytes=raw), position + 16
+    if tag in (b'L', b'U'):
+        count, position = _read_varint(data, position)
+        items = []
+        for _ in range(count):
+            item, position = _decode(data, position)
+            items.append(item)
+        return (items if tag == b'L' else tuple(items)), position
+    if tag == b'M':
+        count, position = _read_varint(data, position)
+        mapping = {}
+        for _ in range(count):
+            key, position = _decode(data, position)
+            mapping[key], position = _decode(data, position)
+        return mapping, position
+    raise ValueError('Bad session data (tag {!r})'.format(tag))
+
+
+def encode(value):
+    """Return `value` as compact bytes."""
+    out = bytearray()
+    _encode(value, out)
+    return bytes(out)
+
+
+def decode(data):
+    """Return the value that `encode` turned into `data`. Raises ValueError if `data` is damaged."""
+    try:
+        value, position = _decode(data, 0)
+    except (IndexError, struct.error) as err:
+        # Ran off the end of the data.
+        raise ValueError('Bad session data (truncated)') from err
+    if position != len(data):
+        raise ValueError('Bad session data (extra bytes)')
+    return value
+
+
+# Stores ########################################
+#
+# A store keeps encoded sessions by ID, each with an expiry time (seconds
+# since the epoch). Expired sessions are never returned.
+
+class MemoryStore(object):
+    """Sessions kept in this process's memory. The least recently used go first when there are `max_sessions`."""
+
+    def __init__(self, max_sessions=10000):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # id -> (data, expiry time)
+        self._lock = threading.Lock()
+
+    def load(self, session_id):
+        """Return (data, expiry time) for a session, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or entry[1] <= time.time():
+                return None
+            self._sessions.move_to_end(session_id)
+            return entry
+
+    def save(self, session_id, data, expires):
+        with self._lock:
+            self._sessions[session_id] = (data, expires)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def touch(self, session_id, expires):
+        """Push back a session's expiry time without rewriting it."""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                self._sessions[session_id] = (entry[0], expires)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def sweep(self):
+        """Remove expired sessions. Returns how many were removed."""
+        now = time.time()
+        with self._lock:
+            expired = [session_id for session_id, (data, expires) in self._sessions.items() if expires <= now]
+            for session_id in expired:
+                del self._sessions[session_id]
+        return len(expired)
+
+
+class SQLiteStore(object):
+    """Sessions kept in an SQLite file, so they survive restarts and every process of the app shares them."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS session '
+                           '(id TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS session_expires ON session (expires)')
+
+    def _connection(self):
+        # SQLite connections can't be shared between threads, so each thread opens its own.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def load(self, session_id):
+        return self._connection().execute('SELECT data, expires FROM session WHERE id = ? AND expires > ?',
+                                          (session_id, time.time())).fetchone()
+
+    def save(self, session_id, data, expires):
+        self._connection().execute('INSERT OR REPLACE INTO session (id, data, expires) VALUES (?, ?, ?)',
+                                   (session_id, data, expires))
+
+    def touch(self, session_id, expires):
+        self._connection().execute('UPDATE session SET expires = ? WHERE id = ?', (expires, session_id))
+
+    def delete(self, session_id):
+        self._connection().execute('DELETE FROM session WHERE id = ?', (session_id,))
+
+    def sweep(self):
+        return self._connection().execute('DELETE FROM session WHERE expires <= ?', (time.time(),)).rowcount
+
+
+# Session Interface ########################################
+
+class ServerSession(CallbackDict, SessionMixin):
+    """The session dictionary. Like Flask's own, it notices when keys are set or
+    removed, but not changes inside a value (set `session.modified = True` for those)."""
+
+    def __init__(self, initial=None, session_id=None, stored=None):
+        def on_update(self):
+            self.modified = True
+        super(ServerSession, self).__init__(initial, on_update)
+        self.session_id = session_id
+        self.stored = stored  # (data, expiry time) as loaded, or None for a new session
+        self.modified = False
+        self.regenerated = False
+
+    def regenerate(self):
+        """Move the session to a new ID when the response is sent, and forget the old one.
+
+        Call this when the user logs in or out.
+        """
+        self.regenerated = True
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keep sessions in `store`, with only the session ID in the cookie.
+
+    Sessions expire `app.permanent_session_lifetime` after they were last
+    saved. To spare the store a write on every request, an unchanged
+    session's expiry is only pushed back once it is half used up.
+    As with Flask's own sessions, the cookie of a permanent session
+    (`session.permanent = True`) lasts as long as the session does; any
+    other session's cookie goes when the browser is closed.
+    Every `sweep_interval` seconds a background thread removes expired sessions.
+    """
+
+    def __init__(self, store, sweep_interval=300.0):
+        self.store = store
+        self.sweep_interval = sweep_interval
+        self._sweeper = None
+        self._lock = threading.Lock()
+
+    def _start_sweeper(self):
+        with self._lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_forever, name='session-sweeper', daemon=True)
+                self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.store.sweep()
+            except Exception:
+                # Say so, but keep going; the next sweep may work (say, once SQLite is no longer locked).
+                log.exception('Removing expired sessions failed')
+
+    def open_session(self, app, request):
+        self._start_sweeper()
+        session_id = request.cookies.get(self.get_cookie_name(app))
+        if session_id:
+            stored = self.store.load(session_id)
+            if stored is not None:
+                try:
+                    return ServerSession(decode(stored[0]), session_id, stored)
+                except ValueError:
+                    self.store.delete(session_id)  # Unreadable; start a new session.
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if session.regenerated and session.session_id is not None:
+            self.store.delete(session.session_id)
+            session.session_id, session.stored = None, None
+
+        # An emptied session is removed altogether.
+        if not session:
+            if session.stored is not None:
+                self.store.delete(session.session_id)
+            if session.session_id is not None or session.modified:
+                response.delete_cookie(self.get_cookie_name(app), domain=self.get_cookie_domain(app),
+                                       path=self.get_cookie_path(app), secure=self.get_cookie_secure(app),
+                                       httponly=self.get_cookie_httponly(app), samesite=self.get_cookie_samesite(app))
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        expires = time.time() + lifetime
+        data = encode(dict(session)) if session.modified or session.stored is None else session.stored[0]
+        if session.stored is not None and data == session.stored[0]:
+            # Nothing changed. Only push back the expiry once half the lifetime is gone.
+            if session.stored[1] - time.time() < lifetime / 2:
+                self.store.touch(session.session_id, expires)
+                if session.permanent:
+                    self._set_cookie(app, session, response, expires)
+            return
+
+        if session.session_id is None:
+            session.session_id = secrets.token_urlsafe(32)
+        self.store.save(session.session_id, data, expires)
+        self._set_cookie(app, session, response, expires)
+
+    def _set_cookie(self, app, session, response, expires):
+        # A permanent session's cookie expires along with the session in the store.
+        expires = datetime.fromtimestamp(expires, timezone.utc) if session.permanent else None
+        response.set_cookie(self.get_cookie_name(app), session.session_id,
+                            expires=expires, domain=self.get_cookie_domain(app),
+                            path=self.get_cookie_path(app), secure=self.get_cookie_secure(app),
+                            httponly=self.get_cookie_httponly(app), samesite=self.get_cookie_samesite(app))
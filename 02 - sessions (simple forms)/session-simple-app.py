@@ -1,12 +1,25 @@
 # Based on example from Flask documentation:
 # http://flask.pocoo.org/docs/0.12/quickstart/#sessions
 
+import os
+
 from flask import Flask, render_template, session, request, redirect, url_for
 
+import serversession
+
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'super secret key'
 
+# Keep the session on the server; the cookie only holds a random session ID
+# (see serversession.py). Set SESSION_DB to a file name to keep sessions in
+# SQLite, so they survive a restart and are shared by every process.
+if os.environ.get('SESSION_DB'):
+    session_store = serversession.SQLiteStore(os.environ['SESSION_DB'])
+else:
+    session_store = serversession.MemoryStore()
+app.session_interface = serversession.ServerSessionInterface(session_store)
+
 
 @app.route('/')
 def index():
@@ -21,6 +34,8 @@ def index():
 @app.route('/signup', methods=['GET', 'POST'])
 def sign_up():
     if request.method == 'POST':
+        # A new session ID for the new user (see serversession.py).
+        session.regenerate()
         session['user'] = {
             'name': request.form['name'],
             'email': request.form['email']
@@ -34,8 +49,10 @@ def sign_up():
 def log_out():
     # Remove username from session if present
     session.pop('user', None)
+    session.regenerate()
     return redirect(url_for('index'))
 
 
 # Go!
-app.run(debug=True)
+if __name__ == '__main__':
+    app.run(debug=True)
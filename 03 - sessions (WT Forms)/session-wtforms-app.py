@@ -1,10 +1,31 @@
-from flask import Flask, session, redirect, url_for, render_template, flash
+import os
+import sys
+
+from flask import Flask, session, redirect, url_for, render_template, flash, request
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, BooleanField, PasswordField
 from wtforms.validators import Email, Length, Regexp
 
+# Server-side sessions come from the simple forms example, and the rate
+# limiter from the login example (one copy of each module, shared).
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, os.pardir, '02 - sessions (simple forms)'))
+sys.path.append(os.path.join(here, os.pardir, 'login'))
+import serversession  # noqa: E402
+import ratelimit  # noqa: E402
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret key for session application'
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024  # No page here takes more than a small form
+
+# Keep the session on the server; the cookie only holds a random session ID
+# (see serversession.py). Set SESSION_DB to a file name to keep sessions in
+# SQLite, so they survive a restart and are shared by every process.
+if os.environ.get('SESSION_DB'):
+    session_store = serversession.SQLiteStore(os.environ['SESSION_DB'])
+else:
+    session_store = serversession.MemoryStore()
+app.session_interface = serversession.ServerSessionInterface(session_store)
 
 
 # Default route shows a simple home page.
@@ -25,6 +46,36 @@ class LoginForm(FlaskForm):
     submit = SubmitField('Log In')
 
 
+# Limit login attempts, per client and per e-mail address (see ratelimit.py).
+# A client gets 10 tries, then one every 6 seconds; an address gets 5, then one a minute.
+# Set LOGIN_RATE_LIMIT_DB to a file name to share the limits between processes.
+if os.environ.get('LOGIN_RATE_LIMIT_DB'):
+    client_buckets = account_buckets = ratelimit.SQLiteBuckets(os.environ['LOGIN_RATE_LIMIT_DB'])
+else:
+    client_buckets = ratelimit.LocalBuckets()
+    # Never drop an account's bucket to make room, or trying lots of made-up
+    # addresses would reset the limit on a real one.
+    account_buckets = ratelimit.LocalBuckets(when_full='reject')
+client_limiter = ratelimit.RateLimiter('client', rate=1 / 6, burst=10, backend=client_buckets)
+account_limiter = ratelimit.RateLimiter('account', rate=1 / 60, burst=5, backend=account_buckets)
+
+
+@app.before_request
+def limit_login_attempts():
+    # Refuse login attempts over the limits before the form is validated (with its
+    # three regular expressions) or the password checked. The client's limit is
+    # checked before the form is even read.
+    if request.endpoint != 'login' or request.method != 'POST':
+        return None
+    wait = client_limiter.take(request.remote_addr)
+    if wait:
+        return ratelimit.too_many_requests(wait)
+    wait = account_limiter.take(request.form.get('email', '').strip().lower())
+    if wait:
+        return ratelimit.too_many_requests(wait)
+    return None
+
+
 # Log in
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -40,8 +91,12 @@ def login():
         else:
             # Correct password. Add a value to the session object
             # to show that the user is logged in. Redirect to home page.
+            # The session gets a new ID, so one from before the login is no use to anyone.
+            session.regenerate()
             session['email'] = login_form.email.data
             session['remember'] = login_form.remember.data
+            # A permanent session's cookie outlasts the browser (for app.permanent_session_lifetime).
+            session.permanent = login_form.remember.data
             flash('User {} logged in'.format(session['email']))
             return redirect(url_for('index'))
 
@@ -62,7 +117,9 @@ def logout():
     #    Removing the email from the session has the effect of logging out the user.
     # 2. If 'email' is not in the session, return the second argument (None)
     session.pop('remember', None)
+    session.permanent = False
     user_name = session.pop('email', None)
+    session.regenerate()
     flash('User {} logged out'.format(user_name))
     return redirect(url_for('index'))
 
@@ -0,0 +1,172 @@
+import importlib.util
+import os
+import time
+import unittest
+import uuid
+from datetime import datetime, timezone
+
+from markupsafe import Markup
+
+# The application's file name isn't a valid module name, so load it by path.
+spec = importlib.util.spec_from_file_location('session_wtforms_app',
+                                              os.path.join(os.path.dirname(__file__), 'session-wtforms-app.py'))
+session_app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(session_app)
+app = session_app.app
+ratelimit = session_app.ratelimit
+serversession = session_app.serversession
+
+
+class EncodingTestCase(unittest.TestCase):
+    """Test the binary encoding of session data."""
+
+    def test_round_trip(self):
+        value = {'user': {'name': 'Fred', 'email': 'fred@ziffle.com'}, 'n': -5, 'big': 2 ** 70, 'f': 1.5,
+                 'b': b'\x00', 'none': None, 't': True, 'pair': (1, 'two'),
+                 '_flashes': [('message', Markup('<b>Hi</b>'))],
+                 'when': datetime(2024, 5, 6, 7, 8, 9, tzinfo=timezone.utc), 'id': uuid.uuid4()}
+        decoded = serversession.decode(serversession.encode(value))
+        self.assertEqual(decoded, value)
+        self.assertIsInstance(decoded['_flashes'][0][1], Markup)
+
+    def test_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            serversession.encode({'items': {1, 2}})
+
+    def test_damaged_data(self):
+        data = serversession.encode({'user': 'fred@ziffle.com', 'count': 1000})
+        for length in range(len(data)):
+            with self.assertRaises(ValueError):
+                serversession.decode(data[:length])
+
+
+class SweeperTestCase(unittest.TestCase):
+    """Test the background removal of expired sessions."""
+
+    def test_keeps_sweeping_after_error(self):
+        """A sweep that fails is logged, and later sweeps still run."""
+        class FlakyStore(serversession.MemoryStore):
+            sweeps = 0
+
+            def sweep(self):
+                self.sweeps += 1
+                if self.sweeps == 1:
+                    raise RuntimeError('database is locked')
+                return super(FlakyStore, self).sweep()
+
+        store = FlakyStore()
+        interface = serversession.ServerSessionInterface(store, sweep_interval=0.01)
+        with self.assertLogs(serversession.log, 'ERROR'):
+            interface._start_sweeper()
+            deadline = time.monotonic() + 5
+            while store.sweeps < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertGreaterEqual(store.sweeps, 3)
+        self.assertTrue(interface._sweeper.is_alive())
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """Test the token buckets behind the login limits."""
+
+    def test_full_buckets_rejected(self):
+        """With when_full='reject', a flood of new keys can't push out a bucket that is still limiting."""
+        buckets = ratelimit.LocalBuckets(max_keys=3, when_full='reject')
+        for n in range(2):
+            self.assertEqual(buckets.take('victim', 1 / 60, 2, now=0), 0.0)
+        self.assertGreater(buckets.take('victim', 1 / 60, 2, now=1), 0)
+        for n in range(10):
+            buckets.take('junk{}'.format(n), 1 / 60, 2, now=2)
+        self.assertGreater(buckets.rejections, 0)
+        self.assertGreater(buckets.take('victim', 1 / 60, 2, now=3), 0)
+
+        # Buckets that have refilled make room for new keys.
+        self.assertEqual(buckets.take('new', 1 / 60, 2, now=1000), 0.0)
+
+    def test_full_buckets_evicted(self):
+        buckets = ratelimit.LocalBuckets(max_keys=2)
+        for key in ('a', 'b', 'c'):
+            buckets.take(key, 1, 5, now=0)
+        self.assertEqual((len(buckets), buckets.evictions), (2, 1))
+
+    def test_client_limit_first(self):
+        """A client over its limit is refused before the form is read."""
+        session_app.client_limiter.backend = ratelimit.LocalBuckets()
+        session_app.account_limiter.backend = ratelimit.LocalBuckets(when_full='reject')
+        client = app.test_client()
+        for n in range(session_app.client_limiter.burst):
+            client.post('/login', data={'email': 'user{}@example.com'.format(n), 'password': 'x'})
+        allowed = session_app.account_limiter.allowed
+        resp = client.post('/login', data={'email': 'fred@ziffle.com', 'password': 'x'})
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(session_app.account_limiter.allowed, allowed)
+
+
+class SessionTestCase(unittest.TestCase):
+    """Test server-side sessions in the application."""
+
+    def setUp(self):
+        app.testing = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        # A fresh store, and fresh rate limits so the tests' logins aren't refused.
+        self.store = serversession.MemoryStore()
+        app.session_interface = serversession.ServerSessionInterface(self.store)
+        session_app.client_limiter.backend = ratelimit.LocalBuckets()
+        session_app.account_limiter.backend = ratelimit.LocalBuckets(when_full='reject')
+        self.client = app.test_client()
+
+    def session_id(self):
+        cookie = self.client.get_cookie(app.config['SESSION_COOKIE_NAME'])
+        return cookie.value if cookie is not None else None
+
+    def log_in(self, remember=False):
+        data = {'email': 'fred@ziffle.com', 'password': 'password!0!'}
+        if remember:
+            data['remember'] = 'y'
+        return self.client.post('/login', data=data)
+
+    def test_new_id_on_login_and_logout(self):
+        """Logging in or out moves the session to a new ID and forgets the old one."""
+        with self.client.session_transaction() as session:
+            session['visited'] = True  # A session from before the login
+        before = self.session_id()
+        self.assertIsNotNone(before)
+
+        self.log_in()
+        logged_in = self.session_id()
+        self.assertNotEqual(logged_in, before)
+        self.assertIsNone(self.store.load(before))
+        self.assertIn(b'fred@ziffle.com', self.client.get('/').data)
+
+        self.client.get('/logout')
+        self.assertNotEqual(self.session_id(), logged_in)
+        self.assertIsNone(self.store.load(logged_in))
+
+    def test_unchanged_session_not_saved(self):
+        """Requests that don't change the session don't write it or set the cookie."""
+        self.log_in()
+        self.client.get('/')  # Shows the flashed message, which changes the session.
+        resp = self.client.get('/')
+        self.assertNotIn('Set-Cookie', resp.headers)
+
+    def test_damaged_session(self):
+        """A session that can't be read is replaced by a new one."""
+        self.log_in()
+        session_id = self.session_id()
+        data, expires = self.store.load(session_id)
+        self.store.save(session_id, data[:-3], expires)
+        resp = self.client.get('/')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn(b'fred@ziffle.com', resp.data)
+
+    def test_remember_me(self):
+        """Only a remembered login gets a cookie that outlasts the browser."""
+        resp = self.log_in()
+        self.assertNotIn('Expires', resp.headers['Set-Cookie'])
+        self.client.get('/logout')
+        resp = self.log_in(remember=True)
+        self.assertIn('Expires', resp.headers['Set-Cookie'])
+
+
+# Do the right thing if this file is run standalone.
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,43 @@
+import concurrent.futures
+import csv
+from decimal import Decimal
 import os
 from pathlib import PurePath
 
-from flask import Flask, render_template, request, flash, redirect, url_for
+import click
+from flask import Flask, render_template, request, flash, redirect, url_for, jsonify, Response, stream_with_context, \
+    abort, send_from_directory
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired
-from wtforms import StringField, SubmitField, SelectField, FloatField, PasswordField, BooleanField, ValidationError
+from markupsafe import Markup, escape
+import psycopg2
+from wtforms import StringField, SubmitField, SelectField, DecimalField, PasswordField, BooleanField, ValidationError
 from wtforms.validators import Email, Length, DataRequired, NumberRange, InputRequired, EqualTo
 
 import db
+import photos
+import querylog
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'Super Secret Unguessable Key'
 
+# Number of rows on each page of the member and comment listings.
+PAGE_SIZE = 50
+
+# Which resized copies of members' photos the details and member list pages show (see photos.thumbnail_sizes).
+DETAILS_PHOTO_SIZE = 512
+THUMBNAIL_PHOTO_SIZE = 128
+
+# Browsers may keep a photo this long (seconds) without asking about it again.
+PHOTO_MAX_AGE = 365 * 24 * 60 * 60
+
+# The transfer page lists every account in its menus up to this many accounts;
+# past that, it looks accounts up as you type instead.
+ACCOUNT_SELECT_LIMIT = 200
+
+# Seconds a request adding a comment waits for it to be stored before giving up.
+COMMENT_WRITE_TIMEOUT = 5.0
+
 
 
 @app.before_request
@@ -19,6 +45,15 @@ def before_request():
     db.open_db_connection()
 
 
+@app.after_request
+def add_server_timing(response):
+    # Report this request's database time to the browser's developer tools.
+    # A streamed response's queries haven't run yet, so there's nothing to report.
+    if not response.is_streamed:
+        response.headers['Server-Timing'] = querylog.server_timing()
+    return response
+
+
 @app.teardown_request
 def teardown_request(exception):
     db.close_db_connection()
@@ -29,19 +64,135 @@ def index():
     return render_template('index.html')
 
 
+@app.route('/stats/pool')
+def pool_stats():
+    return jsonify(dict(db.pool_stats(), replicas=db.replica_pool_stats()))
+
+
+# Timing percentiles for every statement this process has run, slowest total first.
+@app.route('/stats/queries')
+def query_stats():
+    return jsonify(queries=querylog.query_stats.report())
+
+
+@app.route('/stats/member-cache')
+def member_cache_stats():
+    return jsonify(db.member_cache_stats())
+
+
+@app.route('/stats/comment-writer')
+def comment_writer_stats():
+    return jsonify(db.comment_writer_stats())
+
+
+@app.route('/stats/account-directory')
+def account_directory_stats():
+    return jsonify(db.account_directory_stats())
+
+
 @app.route('/foo')
 def foo():
     print(db.last_photo_seq())
     return "FOO"
 
+
+def stream_template(template_name, **context):
+    """Render a template a piece at a time instead of building one big string."""
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(5)
+    return stream
+
+
+# List members one page at a time. Add ?stream=1 to send every member
+# in a single streamed response; memory use stays flat either way.
 @app.route('/members')
 def all_members():
-    return render_template('all-members.html', members=db.all_members())
+    if request.args.get('stream'):
+        return Response(stream_with_context(stream_template('all-members.html', members=db.stream_members())))
+
+    # Ask for one extra row so we know whether there is a next page.
+    members = db.members_page(request.args.get('after'), PAGE_SIZE + 1)
+    next_url = None
+    if len(members) > PAGE_SIZE:
+        members = members[:PAGE_SIZE]
+        next_url = url_for('all_members', after=members[-1]['email'])
+
+    # Look up photos and comment counts for the whole page at once:
+    # two queries, no matter how many members are on the page.
+    emails = [member['email'] for member in members]
+    comment_counts = db.load_comment_counts(emails)
+    thumbnails = {}
+    for email, member in db.load_members(emails).items():
+        if member is not None and member['file_path'] is not None:
+            thumbnails[email] = photo_url(photos.best_variant(app.static_folder, member['file_path'],
+                                                              THUMBNAIL_PHOTO_SIZE))
+    return render_template('all-members.html', members=members, next_url=next_url,
+                           comment_counts=comment_counts, thumbnails=thumbnails)
 
 
 @app.route('/comments')
 def all_comments():
-    return render_template('all-comments.html', comments=db.all_comments())
+    if request.args.get('stream'):
+        return Response(stream_with_context(stream_template('all-comments.html', comments=db.stream_comments())))
+
+    after = None
+    if 'after_id' in request.args:
+        after = (request.args.get('after_last', ''),
+                 request.args.get('after_first', ''),
+                 request.args.get('after_id', type=int))
+    comments = db.comments_page(after, PAGE_SIZE + 1)
+    next_url = None
+    if len(comments) > PAGE_SIZE:
+        comments = comments[:PAGE_SIZE]
+        last = comments[-1]
+        next_url = url_for('all_comments',
+                           after_last=last['last_name'], after_first=last['first_name'], after_id=last['id'])
+    return render_template('all-comments.html', comments=comments, next_url=next_url)
+
+
+# Add a comment. Expects a JSON body like {"email": "fred@ziffle.com", "body": "Hello"}.
+# Comments arriving at about the same time are written together (see db.queue_comment);
+# we answer once this one's batch is committed.
+@app.route('/comments', methods=['POST'])
+def add_comment():
+    body = request.get_json(silent=True) or {}
+    if (not isinstance(body, dict) or not body.get('email') or not body.get('body')
+            or not isinstance(body['email'], str) or not isinstance(body['body'], str)):
+        return jsonify(error='A comment needs an "email" and a "body"'), 400
+
+    future = db.queue_comment(body['email'], body['body'])
+    try:
+        comment = future.result(timeout=COMMENT_WRITE_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        return jsonify(error='Comment not stored yet; try again later'), 503
+    except psycopg2.IntegrityError:
+        return jsonify(error='No member with email {}'.format(body['email'])), 400
+    except psycopg2.DataError as err:
+        return jsonify(error=err.pgerror or str(err)), 400
+    return jsonify(id=comment['id'], email=comment['member'], body=comment['body']), 201
+
+
+# Full-text search over comments, best match first. For example, /comments/search?q=lively+-sample
+@app.route('/comments/search')
+def search_comments():
+    query = request.args.get('q', '').strip()
+    comments, next_url = [], None
+    if query:
+        try:
+            comments, next_cursor = db.search_comments(query, PAGE_SIZE, request.args.get('after'))
+        except ValueError:
+            abort(400)
+        if next_cursor is not None:
+            next_url = url_for('search_comments', q=query, after=next_cursor)
+    return render_template('search-comments.html', query=query, comments=comments, next_url=next_url)
+
+
+@app.template_filter('highlight')
+def highlight(headline):
+    """Escape a search headline, then mark up the words that matched."""
+    return escape(headline).replace(db.highlight_start, Markup('<mark>')).replace(db.highlight_stop, Markup('</mark>'))
 
 
 @app.route('/details/<email>')
@@ -52,13 +203,48 @@ def member_details(email):
         flash('No member with email {}'.format(email))
         redirect(url_for('all_members'))
 
-    print(member)
     if member['file_path'] is not None:
-        photo_path = url_for('static', filename=member['file_path'])
+        # Show the medium-sized copy, linked to the full-sized original.
+        photo_path = photo_url(photos.best_variant(app.static_folder, member['file_path'], DETAILS_PHOTO_SIZE))
+        full_photo_path = photo_url(member['file_path'])
     else:
-        photo_path = ''
+        photo_path = full_photo_path = ''
+
+    return render_template('member-details.html', member=member,
+                           photo_path=photo_path, full_photo_path=full_photo_path)
+
 
-    return render_template('member-details.html', member=member, photo_path=photo_path)
+def photo_url(file_path):
+    """Return the URL for a photo, with a fingerprint of its content.
+
+    Because the URL changes whenever the photo does, browsers can cache
+    each URL forever. Photos saved by photos.save_upload are named by
+    their content already; older ones get a version parameter.
+    """
+    file_name = PurePath(file_path).name
+    if photos.is_fingerprinted(file_path):
+        return url_for('serve_photo', file_name=file_name)
+    return url_for('serve_photo', file_name=file_name, v=photos.fingerprint(app.static_folder, file_path))
+
+
+# Serve member photos with long-lived caching. Werkzeug takes care of
+# If-None-Match (304 responses) and Range requests, and passes the open file
+# to the WSGI server's file wrapper, which uses sendfile() where available
+# (e.g., gunicorn), so photo bytes don't pass through Python. Behind a web server
+# that supports X-Sendfile, set app.config['USE_X_SENDFILE'] = True to hand off the file entirely.
+@app.route('/photos/<file_name>')
+def serve_photo(file_name):
+    folder = os.path.join(app.static_folder, photos.photo_folder)
+    if not os.path.isfile(os.path.join(folder, file_name)):
+        abort(404)
+
+    response = send_from_directory(folder, file_name,
+                                   etag=photos.fingerprint(folder, file_name),
+                                   max_age=PHOTO_MAX_AGE,
+                                   conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route('/comments/<email>')
@@ -68,6 +254,7 @@ def member_comments(email):
         flash('No member with email {}'.format(email))
         comments = []
     else:
+        # find_member usually comes from the member cache, so this is often the only query.
         comments = db.comments_by_member(email)
     return render_template('member-comments.html', member=member, comments=comments)
 
@@ -107,33 +294,14 @@ def create_member():
                                         member_form.password.data)
 
             if rowcount == 1:
-                # Grab the photo data and create an initial database record.
-                uploaded_photo = member_form.photo.data
-                photo_row = db.init_photo(member_form.email.data)
-                print("PHOTO ROW", photo_row)
-
-                # Come up with our own name for the file (more secure than user-supplied file)
-                file_name = "file{:04d}".format(photo_row['id'])
-                print("FILE NAME", file_name)
-
-                # Grab the file extension from the original file and add it to our name.
-                # N.B.: THIS EXPOSES US TO A MODERATE SECURITY RISK: Better to inspect the
-                # file content rather than rely on the user-supplied file name.
-                extension = PurePath(uploaded_photo.filename).suffix
-                file_name += extension
-                print("FILE+EXT", file_name)
-
-                # Create path to file that will be within the 'static' folder of the application
-                file_path = os.path.join('photos', file_name)
-                print("FILE PATH", file_path)
-
-                # Save the file to the 'static' folder; use absolute path based on app.static_folder.
-                save_path = os.path.join(app.static_folder, file_path)
-                uploaded_photo.save(save_path)
-                print("SAVE PATH", save_path)
-
-                # Update the database row now that we know the name and location of the file
-                db.set_photo(photo_row['id'], file_path)
+                # Save the photo under a name derived from its content, so the same
+                # picture uploaded twice is stored only once, and record it in the database.
+                file_path = photos.save_upload(member_form.photo.data, app.static_folder)
+                db.create_photo(member_form.email.data, file_path)
+
+                # Make the smaller versions in a background process; the details page
+                # uses them once they exist.
+                photos.schedule_thumbnails(app.static_folder, file_path)
 
                 flash("Member {} created".format(member_form.email.data))
                 return redirect(url_for('all_members'))
@@ -189,6 +357,12 @@ def update_member(email):
     return render_template('member-form.html', form=member_form, mode='update')
 
 
+# Totals and top commenters, read from the summary tables that db.py keeps up to date.
+@app.route('/dashboard')
+def dashboard():
+    return render_template('dashboard.html', totals=db.summary_totals(), top_commenters=db.top_commenters(10))
+
+
 @app.route('/accounts')
 def all_accounts():
     return render_template('all-accounts.html', accounts=db.all_accounts())
@@ -197,7 +371,7 @@ def all_accounts():
 class FundsTransferForm(FlaskForm):
     from_account = SelectField('From Account', coerce=int, validators=[DataRequired()])
     to_account = SelectField('To Account', coerce=int, validators=[DataRequired()])
-    amount = FloatField('Amount', validators=[NumberRange(min=0.01)])
+    amount = DecimalField('Amount', places=2, validators=[InputRequired(), NumberRange(min=Decimal('0.01'))])
     cause_rollback = BooleanField('Cause Rollback')
     submit = SubmitField('Transfer Funds')
 
@@ -205,60 +379,160 @@ class FundsTransferForm(FlaskForm):
         if form.from_account.data == form.to_account.data:
             raise ValidationError("Destination account can't be the same as source account")
 
+    def validate_amount(form, field):
+        try:
+            db.to_cents(field.data)
+        except ValueError:
+            raise ValidationError("Amount can't have fractions of a cent")
+
+
+# Balances are stored in cents; show them in dollars.
+@app.template_filter('dollars')
+def dollars(cents):
+    return '${:.2f}'.format(db.dollars(cents))
+
 
 def account_details(account):
-    return "{} ({:.2f})".format(account['name'], account['balance'])
+    return "{} ({:.2f})".format(account['name'], db.dollars(account['balance_cents']))
+
+
+def account_choices(accounts):
+    return [(account['id'], account_details(account)) for account in accounts]
 
 
 @app.route('/transfer', methods=['GET', 'POST'])
 def transfer():
     xfer_form = FundsTransferForm()
-    all_accounts = db.all_accounts()
-
-    # Set choices for the "from" account using an ordinary loop
-    xfer_form.from_account.choices = []
-    for account in all_accounts:
-        xfer_form.from_account.choices.append((account['id'], account_details(account)))
 
-    # Set choices for the "to" account using list comprehension
-    xfer_form.to_account.choices = [(acct['id'], account_details(acct)) for acct in all_accounts]
+    # The account directory is shared by every request and only re-read after a
+    # transfer, and the choices are built from it once, not once per request.
+    # Both fields can use the same list, since nothing changes it.
+    choices = db.account_directory.build('choices', account_choices)
+    xfer_form.from_account.choices = choices
+    xfer_form.to_account.choices = choices
 
     if xfer_form.validate_on_submit():
-        # Assume we can do the transfer
-        can_do_transfer = True
-
-        # Make sure the source account exists.
-        from_account = db.find_account(xfer_form.from_account.data)
-        if from_account is None:
-            can_do_transfer = False
-            flash("The From account doesn't exist")
-
-        # Make sure the destination account exists.
-        to_account = db.find_account(xfer_form.to_account.data)
-        if to_account is None:
-            can_do_transfer = False
-            flash("The To account doesn't exist")
-
-        # There must be sufficient funds for the requested transfer
+        # The directory already has every account, so look them up there rather
+        # than going back to the database. The model layer re-checks everything
+        # (with the rows locked) when it makes the transfer.
+        from_account = db.account_directory.find(xfer_form.from_account.data)
+        to_account = db.account_directory.find(xfer_form.to_account.data)
         transfer_amount = xfer_form.amount.data
-        if from_account['balance'] < transfer_amount:
-            can_do_transfer = False
-            flash("Insufficient funds: balance in {} is {:.2f}, amount is {:.2f}".format(from_account['name'],
-                                                                                         from_account['balance'],
-                                                                                         transfer_amount))
-        if can_do_transfer:
-            # Everything checks out; transfer!
-            message = db.transfer_funds(from_account['id'],
-                                        to_account['id'],
-                                        transfer_amount,
-                                        xfer_form.cause_rollback.data)
-            flash("Transferred {:.2f} from {} to {}".format(transfer_amount,
-                                                            from_account['name'],
-                                                            to_account['name']))
-            flash("Message from model layer: {}".format(message))
-            return redirect(url_for('all_accounts'))
-
-    return render_template('transfer-funds.html', form=xfer_form)
+
+        if from_account is None or to_account is None:
+            # The directory was reloaded after the choices were checked, and a chosen
+            # account is no longer in it; treat that like any other bad choice.
+            for field, account in ((xfer_form.from_account, from_account), (xfer_form.to_account, to_account)):
+                if account is None:
+                    field.errors.append('Not a valid choice.')
+        else:
+            try:
+                message = db.transfer_funds(from_account['id'],
+                                            to_account['id'],
+                                            db.to_cents(transfer_amount),
+                                            xfer_form.cause_rollback.data)
+            except (db.TransferError, ValueError) as err:
+                flash("Transfer failed: {}".format(err))
+            else:
+                flash("Transferred {:.2f} from {} to {}".format(transfer_amount,
+                                                                from_account['name'],
+                                                                to_account['name']))
+                flash("Message from model layer: {}".format(message))
+                return redirect(url_for('all_accounts'))
+
+    # With lots of accounts, don't send them all; the page looks them up as you type.
+    search_accounts = len(choices) > ACCOUNT_SELECT_LIMIT
+    return render_template('transfer-funds.html', form=xfer_form, search_accounts=search_accounts)
+
+
+# Search-as-you-type for the transfer page, e.g. /accounts/search?q=sav
+@app.route('/accounts/search')
+def search_accounts():
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    accounts = db.account_directory.search(request.args.get('q', ''), limit)
+    return jsonify(accounts=[{'id': account['id'], 'label': account_details(account)} for account in accounts])
+
+
+# Apply a batch of transfers in one transaction. Expects a JSON body like
+# {"transfers": [{"from": 1, "to": 2, "amount": "10.00"}, ...]} (amounts in dollars).
+# Returns the new balances in cents.
+@app.route('/transfer/batch', methods=['POST'])
+def transfer_batch():
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body, dict):
+        return jsonify(error='Expected a JSON object with a "transfers" list'), 400
+    try:
+        transfers = [(int(t['from']), int(t['to']), db.to_cents(t['amount'])) for t in body.get('transfers', [])]
+    except (KeyError, TypeError, ValueError):
+        return jsonify(error='Each transfer needs integer "from" and "to" and an "amount" in dollars and cents'), 400
+
+    try:
+        balances = db.transfer_many(transfers)
+    except db.TransferError as err:
+        return jsonify(error=str(err)), 409
+    except ValueError as err:
+        return jsonify(error=str(err)), 400
+    return jsonify(transferred=len(transfers), balances={str(k): v for k, v in balances.items()})
+
+
+# Command-line bulk import. For example:
+#   flask import-members members.csv
+#   flask import-comments comments.csv
+# CSV files need a header row naming the columns (see db.member_columns and db.comment_columns).
+def run_import(import_function, csv_file, chunk_size, **options):
+    def report(read, written):
+        click.echo('{} rows read, {} written'.format(read, written))
+
+    db.open_db_connection()
+    try:
+        totals = import_function(csv.DictReader(csv_file), chunk_size=chunk_size, progress=report, **options)
+    finally:
+        db.close_db_connection()
+    click.echo('Done: {read} rows read, {written} written'.format(**totals))
+
+
+@app.cli.command('import-members')
+@click.argument('csv_file', type=click.File('r'))
+@click.option('--chunk-size', default=10000, help='Rows per COPY and commit')
+@click.option('--on-conflict', type=click.Choice(['skip', 'update', 'error']), default='skip',
+              help='What to do with e-mails that already exist')
+def import_members_command(csv_file, chunk_size, on_conflict):
+    """Import members from a CSV file."""
+    run_import(db.import_members, csv_file, chunk_size, on_conflict=on_conflict)
+
+
+@app.cli.command('import-comments')
+@click.argument('csv_file', type=click.File('r'))
+@click.option('--chunk-size', default=10000, help='Rows per COPY and commit')
+def import_comments_command(csv_file, chunk_size):
+    """Import comments from a CSV file."""
+    run_import(db.import_comments, csv_file, chunk_size)
+
+
+@app.cli.command('rebuild-summaries')
+def rebuild_summaries_command():
+    """Recompute the summary tables from scratch."""
+    db.open_db_connection()
+    try:
+        db.rebuild_summaries()
+    finally:
+        db.close_db_connection()
+    click.echo('Summaries rebuilt')
+
+
+@app.cli.command('verify-summaries')
+def verify_summaries_command():
+    """Check the summary tables against a full recount."""
+    db.open_db_connection()
+    try:
+        problems = db.verify_summaries()
+    finally:
+        db.close_db_connection()
+    for problem in problems:
+        click.echo(problem, err=True)
+    if problems:
+        raise click.exceptions.Exit(1)
+    click.echo('Summaries are correct')
 
 
 # Make this the last line in the file!
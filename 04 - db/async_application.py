@@ -0,0 +1,211 @@
+# An async version of the busiest pages in application.py, using Quart (an
+# async reimplementation of Flask's API) and async_db.py. Run it with an ASGI
+# server, for example:
+#
+#   hypercorn async_application:app
+#
+# Pages it doesn't serve (creating and updating members, photos, the JSON
+# endpoints) are left to application.py; links to them point at the paths
+# application.py uses, so both can sit behind the same web server.
+
+import asyncio
+from decimal import Decimal
+from pathlib import PurePath
+
+from quart import Quart, render_template, request, flash, redirect, url_for, jsonify, session
+from wtforms import Form, SelectField, DecimalField, BooleanField, SubmitField
+from wtforms.csrf.session import SessionCSRF
+from wtforms.validators import DataRequired, InputRequired, NumberRange
+
+import application
+import async_db as db
+import photos
+
+app = Quart(__name__)
+app.config['SECRET_KEY'] = application.app.config['SECRET_KEY']
+app.add_template_filter(application.highlight, 'highlight')
+app.add_template_filter(application.dollars, 'dollars')
+
+PAGE_SIZE = application.PAGE_SIZE
+
+# URLs for pages that only application.py serves.
+_sync_urls = application.app.url_map.bind('')
+
+
+def build_sync_url(error, endpoint, values):
+    return _sync_urls.build(endpoint, values)
+
+
+app.url_build_error_handlers.append(build_sync_url)
+
+
+@app.before_serving
+async def open_pool():
+    if db.pool is None:
+        await db.init_pool()
+
+
+@app.after_serving
+async def close_pool():
+    await db.close_pool()
+
+
+@app.route('/')
+async def index():
+    return await render_template('index.html')
+
+
+@app.route('/stats/pool')
+async def pool_stats():
+    return jsonify(db.pool_stats())
+
+
+def photo_url(file_path):
+    """Return the URL for a photo, with a fingerprint of its content (see application.photo_url)."""
+    file_name = PurePath(file_path).name
+    if photos.is_fingerprinted(file_path):
+        return url_for('serve_photo', file_name=file_name)
+    return url_for('serve_photo', file_name=file_name, v=photos.fingerprint(app.static_folder, file_path))
+
+
+@app.route('/members')
+async def all_members():
+    members = await db.members_page(request.args.get('after'), PAGE_SIZE + 1)
+    next_url = None
+    if len(members) > PAGE_SIZE:
+        members = members[:PAGE_SIZE]
+        next_url = url_for('all_members', after=members[-1]['email'])
+
+    # The comment counts and the photos don't depend on each other, so look them up at the same time.
+    emails = [member['email'] for member in members]
+    comment_counts, loaded = await asyncio.gather(db.load_comment_counts(emails), db.load_members(emails))
+    thumbnails = {}
+    for email, member in loaded.items():
+        if member is not None and member['file_path'] is not None:
+            thumbnails[email] = photo_url(photos.best_variant(app.static_folder, member['file_path'],
+                                                              application.THUMBNAIL_PHOTO_SIZE))
+    return await render_template('all-members.html', members=members, next_url=next_url,
+                                 comment_counts=comment_counts, thumbnails=thumbnails)
+
+
+@app.route('/comments')
+async def all_comments():
+    after = None
+    if 'after_id' in request.args:
+        after = (request.args.get('after_last', ''),
+                 request.args.get('after_first', ''),
+                 request.args.get('after_id', type=int))
+    comments = await db.comments_page(after, PAGE_SIZE + 1)
+    next_url = None
+    if len(comments) > PAGE_SIZE:
+        comments = comments[:PAGE_SIZE]
+        last = comments[-1]
+        next_url = url_for('all_comments',
+                           after_last=last['last_name'], after_first=last['first_name'], after_id=last['id'])
+    return await render_template('all-comments.html', comments=comments, next_url=next_url)
+
+
+@app.route('/comments/search')
+async def search_comments():
+    query = request.args.get('q', '').strip()
+    comments, next_url = [], None
+    if query:
+        try:
+            comments, next_cursor = await db.search_comments(query, PAGE_SIZE, request.args.get('after'))
+        except ValueError:
+            return 'Bad cursor', 400
+        if next_cursor is not None:
+            next_url = url_for('search_comments', q=query, after=next_cursor)
+    return await render_template('search-comments.html', query=query, comments=comments, next_url=next_url)
+
+
+@app.route('/details/<email>')
+async def member_details(email):
+    member = await db.find_member(email)
+    if member is None:
+        await flash('No member with email {}'.format(email))
+        return redirect(url_for('all_members'))
+
+    if member['file_path'] is not None:
+        photo_path = photo_url(photos.best_variant(app.static_folder, member['file_path'],
+                                                   application.DETAILS_PHOTO_SIZE))
+        full_photo_path = photo_url(member['file_path'])
+    else:
+        photo_path = full_photo_path = ''
+    return await render_template('member-details.html', member=member,
+                                 photo_path=photo_path, full_photo_path=full_photo_path)
+
+
+@app.route('/comments/<email>')
+async def member_comments(email):
+    # Neither query needs the other's answer, so run them at the same time.
+    member, comments = await asyncio.gather(db.find_member(email), db.comments_by_member(email))
+    if member is None:
+        await flash('No member with email {}'.format(email))
+        comments = []
+    return await render_template('member-comments.html', member=member, comments=comments)
+
+
+@app.route('/dashboard')
+async def dashboard():
+    totals, top_commenters = await asyncio.gather(db.summary_totals(), db.top_commenters(10))
+    return await render_template('dashboard.html', totals=totals, top_commenters=top_commenters)
+
+
+@app.route('/accounts')
+async def all_accounts():
+    return await render_template('all-accounts.html', accounts=await db.all_accounts())
+
+
+# Flask-WTF only works with Flask, so this is a plain WTForms form
+# that keeps its CSRF token in the (Quart) session instead.
+class FundsTransferForm(Form):
+    class Meta:
+        csrf = True
+        csrf_class = SessionCSRF
+        csrf_secret = app.config['SECRET_KEY'].encode()
+
+    from_account = SelectField('From Account', coerce=int, validators=[DataRequired()])
+    to_account = SelectField('To Account', coerce=int, validators=[DataRequired()])
+    amount = DecimalField('Amount', places=2, validators=[InputRequired(), NumberRange(min=Decimal('0.01'))])
+    cause_rollback = BooleanField('Cause Rollback')
+    submit = SubmitField('Transfer Funds')
+
+    validate_to_account = application.FundsTransferForm.validate_to_account
+    validate_amount = application.FundsTransferForm.validate_amount
+
+
+@app.route('/transfer', methods=['GET', 'POST'])
+async def transfer():
+    xfer_form = FundsTransferForm(await request.form, meta={'csrf_context': session})
+
+    if request.method == 'POST':
+        # Checking the form only needs the two accounts it names, not all of them;
+        # look both up at the same time.
+        fields = [field for field in (xfer_form.from_account, xfer_form.to_account) if field.data is not None]
+        found = await asyncio.gather(*(db.find_account(field.data) for field in fields))
+        accounts_by_id = {account['id']: account for account in found if account is not None}
+        choices = application.account_choices(accounts_by_id.values())
+        xfer_form.from_account.choices = xfer_form.to_account.choices = choices
+
+        if xfer_form.validate():
+            from_account = accounts_by_id[xfer_form.from_account.data]
+            to_account = accounts_by_id[xfer_form.to_account.data]
+            transfer_amount = xfer_form.amount.data
+            try:
+                message = await db.transfer_funds(from_account['id'], to_account['id'],
+                                                  db.to_cents(transfer_amount), xfer_form.cause_rollback.data)
+            except (db.TransferError, ValueError) as err:
+                await flash("Transfer failed: {}".format(err))
+            else:
+                await flash("Transferred {:.2f} from {} to {}".format(transfer_amount,
+                                                                      from_account['name'],
+                                                                      to_account['name']))
+                await flash("Message from model layer: {}".format(message))
+                return redirect(url_for('all_accounts'))
+
+    # Showing the form needs every account.
+    choices = application.account_choices(await db.all_accounts())
+    xfer_form.from_account.choices = xfer_form.to_account.choices = choices
+    search_accounts = len(choices) > application.ACCOUNT_SELECT_LIMIT
+    return await render_template('transfer-funds.html', form=xfer_form, search_accounts=search_accounts)
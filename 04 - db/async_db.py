@@ -0,0 +1,563 @@
+import asyncio
+import itertools
+import time
+
+import asyncpg
+import psycopg2.extensions
+
+import db
+import querylog
+
+# Async Database Utilities ########################################
+#
+# The same model functions as db.py, as coroutines on an asyncpg pool, for
+# async_application.py. While one request waits for PostgreSQL, the event loop
+# serves others, so a slow query ties up a connection but not a worker.
+#
+# Each function takes a connection from the pool only for as long as it runs,
+# so a request can run several of them at once with asyncio.gather. Settings
+# (data_source_name, pool_max_size, ...), the member cache, the account
+# directory, the comment writer, and the summary table helpers are shared
+# with db.py. Read replicas aren't supported here.
+
+pool = None
+
+
+def connect_arguments(dsn):
+    """Turn a libpq connection string or URI (as used by db.py) into asyncpg.connect arguments."""
+    settings = psycopg2.extensions.parse_dsn(dsn)
+    arguments = {'database': settings.get('dbname'), 'user': settings.get('user'),
+                 'password': settings.get('password'), 'host': settings.get('host'),
+                 'port': int(settings['port']) if 'port' in settings else None}
+    # libpq's "options" holds server settings like "-c search_path=test".
+    server_settings = {}
+    for option in settings.get('options', '').split('-c'):
+        name, _, value = option.strip().partition('=')
+        if name:
+            server_settings[name] = value
+    if server_settings:
+        arguments['server_settings'] = server_settings
+    return {name: value for name, value in arguments.items() if value is not None}
+
+
+async def init_pool(dsn=None, **settings):
+    """Replace the connection pool, closing the old one.
+
+    Keyword arguments are passed to asyncpg.create_pool; by default the pool
+    matches db.py's `pool_max_size` and `pool_max_idle` settings.
+    """
+    global pool
+    options = {'min_size': 1, 'max_size': db.pool_max_size,
+               'max_inactive_connection_lifetime': db.pool_max_idle}
+    options.update(settings)
+    if pool is not None:
+        await pool.close()
+    pool = await asyncpg.create_pool(**connect_arguments(dsn or db.data_source_name), **options)
+    return pool
+
+
+async def close_pool():
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+
+def pool_stats():
+    """Return usage counters for the connection pool."""
+    size = pool.get_size()
+    return {'size': size, 'idle': pool.get_idle_size(), 'in_use': size - pool.get_idle_size(),
+            'max_size': pool.get_max_size()}
+
+
+async def _timed(method, query, *args):
+    """Run `method(query, *args)` and record its time in the query statistics."""
+    start = time.perf_counter()
+    try:
+        return await method(query, *args)
+    finally:
+        querylog.record_query(query, time.perf_counter() - start)
+
+
+async def fetch(query, *args):
+    """Run a query on a pooled connection and return all its rows."""
+    async with pool.acquire() as connection:
+        return await _timed(connection.fetch, query, *args)
+
+
+async def fetchrow(query, *args):
+    """Run a query on a pooled connection and return its first row (or None)."""
+    async with pool.acquire() as connection:
+        return await _timed(connection.fetchrow, query, *args)
+
+
+async def execute(query, *args):
+    """Run a statement on a pooled connection and return the number of rows it changed."""
+    async with pool.acquire() as connection:
+        status = await _timed(connection.execute, query, *args)
+    # The status is a string like 'UPDATE 1'.
+    return int(status.split()[-1])
+
+
+# Users and Comments ########################################
+
+async def create_member(email, first_name, last_name, password):
+    """Create a new member."""
+    query = 'INSERT INTO member (email, first_name, last_name, password) VALUES ($1, $2, $3, $4)'
+    async with pool.acquire() as connection:
+        async with connection.transaction():
+            status = await _timed(connection.execute, query, email, first_name, last_name, password)
+            row_count = int(status.split()[-1])  # 'INSERT 0 1'
+            await _add_to_summary(connection, member_count=row_count)
+    db.member_cache.invalidate(email)
+    return row_count
+
+
+async def update_member(email, first_name, last_name, password):
+    """Update a member's profile."""
+    row_count = await execute('UPDATE member SET first_name = $2, last_name = $3, password = $4 WHERE email = $1',
+                              email, first_name, last_name, password)
+    db.member_cache.invalidate(email)
+    return row_count
+
+
+async def create_comment(email, body):
+    """Add a comment from a member and return the new row."""
+    query = '''
+WITH new_comment AS (
+  INSERT INTO comment (body, member) VALUES ($1, $2)
+  RETURNING id, body, member
+), counted AS (
+  INSERT INTO member_comment_count (member, comment_count)
+  SELECT member, 1 FROM new_comment
+  ON CONFLICT (member) DO UPDATE SET comment_count = member_comment_count.comment_count + 1
+), summarized AS (
+  UPDATE summary SET comment_count = comment_count + 1 WHERE slot = $3
+)
+SELECT * FROM new_comment'''
+    comment = await fetchrow(query, body, email, db.summary_slot())
+    db.member_cache.invalidate(email)
+    return comment
+
+
+async def queue_comment(email, body):
+    """Add a comment along with others, and return the new row once it is stored (see db.queue_comment).
+
+    The comments go through db.py's comment writer, which writes batches from
+    its own thread, so awaiting the row doesn't block the event loop.
+    """
+    return await asyncio.wrap_future(db.get_comment_writer().submit(email, body))
+
+
+async def create_photo(email, file_path):
+    """Create a photo record for a member and return the new row (including its ID)."""
+    photo = await fetchrow('INSERT INTO photo (member_email, file_path) VALUES ($1, $2) RETURNING *',
+                           email, file_path)
+    db.member_cache.invalidate(email)
+    return photo
+
+
+async def set_photo(photo_id, file_path):
+    """Update a photo record with the proper file name"""
+    rows = await fetch('UPDATE photo SET file_path = $2 WHERE id = $1 RETURNING member_email', photo_id, file_path)
+    for row in rows:
+        db.member_cache.invalidate(row['member_email'])
+    return len(rows)
+
+
+async def last_photo_seq():
+    row = await fetchrow('SELECT last_value FROM photo_id_seq')
+    return row[0]
+
+
+async def all_members():
+    """List all members."""
+    return await fetch('SELECT * FROM member ORDER BY email')
+
+
+async def all_comments():
+    """List all comments, along with the members who wrote them."""
+    query = '''
+SELECT m.first_name, m.last_name, m.email, c.body
+FROM member AS m INNER JOIN comment AS c ON m.email = c.member
+ORDER BY m.last_name ASC, m.first_name ASC'''
+    return await fetch(query)
+
+
+async def members_page(after_email=None, limit=50):
+    """Return up to `limit` members whose e-mail sorts after `after_email` (see db.members_page)."""
+    if after_email is None:
+        return await fetch('SELECT email, first_name, last_name FROM member ORDER BY email LIMIT $1', limit)
+    return await fetch('SELECT email, first_name, last_name FROM member WHERE email > $1 ORDER BY email LIMIT $2',
+                       after_email, limit)
+
+
+async def comments_page(after=None, limit=50):
+    """Return up to `limit` comments that sort after the key `after` (see db.comments_page)."""
+    query = '''
+SELECT c.id, m.first_name, m.last_name, m.email, c.body
+FROM member AS m INNER JOIN comment AS c ON m.email = c.member'''
+    args = [limit]
+    if after is not None:
+        query += '\nWHERE (m.last_name, m.first_name, c.id) > ($2, $3, $4)'
+        args.extend(after)
+    query += '\nORDER BY m.last_name ASC, m.first_name ASC, c.id ASC\nLIMIT $1'
+    return await fetch(query, *args)
+
+
+async def find_member(memberEmail):
+    """Look up a single member. Results are kept in db.member_cache."""
+    return (await load_members([memberEmail]))[memberEmail]
+
+
+async def comments_by_member(email):
+    """Retrieve comments for a member with the given e-mail address."""
+    return (await load_comments([email]))[email]
+
+
+async def load_members(emails):
+    """Look up many members (with their newest photo) at once.
+
+    Returns a dictionary mapping each e-mail to its member, or to None if
+    there is no such member. Members in db.member_cache aren't fetched again.
+    """
+    members = {}
+    wanted = []
+    for email in set(emails):
+        member = db.member_cache.get(email)
+        if member is not None:
+            members[email] = member
+        else:
+            wanted.append(email)
+
+    if wanted:
+        query = """
+    SELECT m.email, m.first_name, m.last_name, p.file_path
+    FROM member AS m
+       LEFT JOIN LATERAL (SELECT file_path FROM photo
+                          WHERE photo.member_email = m.email
+                          ORDER BY id DESC LIMIT 1) AS p ON TRUE
+    WHERE m.email = ANY($1::text[])
+    """
+        for member in await fetch(query, wanted):
+            db.member_cache.put(member['email'], member)
+            members[member['email']] = member
+
+    return {email: members.get(email) for email in emails}
+
+
+async def load_comments(emails):
+    """Return a dictionary mapping each e-mail to the list of that member's comments."""
+    comments = {email: [] for email in emails}
+    query = 'SELECT id, body, member FROM comment WHERE member = ANY($1::text[]) ORDER BY member, id'
+    for comment in await fetch(query, list(comments)):
+        comments[comment['member']].append(comment)
+    return comments
+
+
+async def load_comment_counts(emails):
+    """Return a dictionary mapping each e-mail to the number of comments by that member."""
+    counts = {email: 0 for email in emails}
+    query = 'SELECT member, comment_count FROM member_comment_count WHERE member = ANY($1::text[])'
+    for member, count in await fetch(query, list(counts)):
+        counts[member] = count
+    return counts
+
+
+async def search_comments(query, limit=20, cursor=None):
+    """Find comments matching a web-style search (see db.search_comments). Returns (comments, next_cursor)."""
+    after_rank, after_id = None, None
+    if cursor:
+        rank, _, comment_id = cursor.partition(':')
+        after_rank, after_id = float(rank), int(comment_id)
+
+    query_sql = '''
+WITH search AS (
+  SELECT websearch_to_tsquery('english', $1) AS terms
+), page AS (
+  SELECT c.id, c.member, c.body, ts_rank_cd(c.body_search, s.terms) AS rank
+  FROM comment AS c, search AS s
+  WHERE c.body_search @@ s.terms
+    AND ($4::int IS NULL OR (ts_rank_cd(c.body_search, s.terms), c.id) < ($3::real, $4::int))
+  ORDER BY rank DESC, c.id DESC
+  LIMIT $2
+)
+SELECT p.id, p.body, p.rank, m.email, m.first_name, m.last_name,
+       ts_headline('english', p.body, s.terms,
+                   'StartSel=' || $5 || ', StopSel=' || $6 || ', HighlightAll=false') AS headline
+FROM page AS p
+  INNER JOIN member AS m ON m.email = p.member
+  CROSS JOIN search AS s
+ORDER BY p.rank DESC, p.id DESC'''
+    comments = await fetch(query_sql, query, limit + 1, after_rank, after_id,
+                           db.highlight_start, db.highlight_stop)
+    next_cursor = None
+    if len(comments) > limit:
+        comments = comments[:limit]
+        next_cursor = '{}:{}'.format(comments[-1]['rank'], comments[-1]['id'])
+    return comments, next_cursor
+
+
+# Accounts ########################################
+
+TransferError = db.TransferError
+to_cents = db.to_cents
+
+
+async def all_accounts():
+    """Return all data in the account table."""
+    return await fetch('SELECT * FROM account ORDER BY name')
+
+
+async def find_account(account_id):
+    """Return the account with id 'account_id'."""
+    return await fetchrow('SELECT * FROM account WHERE id = $1', account_id)
+
+
+async def read_balance(account_id):
+    """Get the balance for an account, in cents."""
+    row = await fetchrow('SELECT balance_cents FROM account WHERE id = $1', account_id)
+    return row['balance_cents']
+
+
+async def update_balance(account_id, new_balance_cents):
+    """Set the balance in account 'account_id' to 'new_balance_cents' (see db.update_balance).
+
+    Each function here has a connection only while it runs, so unlike
+    db.update_balance this commits.
+    """
+    async with pool.acquire() as connection:
+        async with connection.transaction():
+            row = await _timed(connection.fetchrow, 'SELECT balance_cents FROM account WHERE id = $1 FOR UPDATE',
+                               account_id)
+            if row is None:
+                raise RuntimeError("Failed to update account {}".format(account_id))
+            change = new_balance_cents - row['balance_cents']
+            await _timed(connection.execute, 'UPDATE account SET balance_cents = $2 WHERE id = $1',
+                         account_id, new_balance_cents)
+            await _timed(connection.execute,
+                         'INSERT INTO ledger (from_account, to_account, amount_cents) VALUES (NULL, $1, $2)',
+                         account_id, change)
+            await _add_to_summary(connection, total_balance=db.dollars(change))
+    db.account_directory.invalidate()
+
+
+async def _transfer_failure(from_account_id, to_account_id, amount_cents):
+    """Work out why a transfer failed. Only runs on the (rare) failure path."""
+    from_account, to_account = await asyncio.gather(find_account(from_account_id), find_account(to_account_id))
+    for account_id, account in ((from_account_id, from_account), (to_account_id, to_account)):
+        if account is None:
+            return "Account {} doesn't exist".format(account_id)
+    return 'Insufficient funds: balance in account {} is {:.2f}, amount is {:.2f}'.format(
+        from_account_id, db.dollars(from_account['balance_cents']), db.dollars(amount_cents))
+
+
+async def transfer_funds(from_account_id, to_account_id, amount_cents, cause_rollback):
+    """Transfer `amount_cents` cents (see db.transfer_funds).
+
+    asyncpg can't send several statements with parameters at once, so the
+    lock, the summary update, and the conditional UPDATE (which also writes
+    the ledger entry) are three round trips in one transaction.
+    Raises db.TransferError if the transfer can't be made, or ValueError if both accounts are the same.
+    """
+    db._check_amount(amount_cents)
+    db._check_accounts(from_account_id, to_account_id)
+    ids = [from_account_id, to_account_id]
+    update = '''
+WITH moved AS (
+  UPDATE account
+  SET balance_cents = balance_cents + CASE WHEN id = $2 THEN $3::bigint ELSE -$3::bigint END
+  WHERE id = ANY($4::int[])
+    AND (SELECT count(*) FROM account WHERE id = ANY($4::int[])) = 2
+    AND (SELECT balance_cents FROM account WHERE id = $1) >= $3::bigint
+  RETURNING id, name, balance_cents
+), logged AS (
+  INSERT INTO ledger (from_account, to_account, amount_cents)
+  SELECT $1, $2, $3::bigint WHERE (SELECT count(*) FROM moved) = 2
+)
+SELECT * FROM moved'''
+    async with pool.acquire() as connection:
+        transaction = connection.transaction()
+        await transaction.start()
+        try:
+            await _timed(connection.execute, 'SELECT id FROM account WHERE id = ANY($1::int[]) ORDER BY id FOR UPDATE',
+                         ids)
+            await _timed(connection.execute,
+                         'UPDATE summary SET transfer_count = transfer_count + 1, '
+                         'transferred_total = transferred_total + $1::bigint / 100.0 WHERE slot = $2',
+                         amount_cents, db.summary_slot())
+            rows = await _timed(connection.fetch, update, from_account_id, to_account_id, amount_cents, ids)
+        except BaseException:
+            await transaction.rollback()
+            raise
+        balances = {row['id']: row['balance_cents'] for row in rows}
+
+        if len(balances) != 2 or cause_rollback:
+            await transaction.rollback()
+        else:
+            await transaction.commit()
+
+    if len(balances) != 2:
+        raise db.TransferError(await _transfer_failure(from_account_id, to_account_id, amount_cents))
+    if cause_rollback:
+        return "Rolled back transaction: from was {:.2f}, to was {:.2f}".format(
+            db.dollars(balances[from_account_id]), db.dollars(balances[to_account_id]))
+    db.account_directory.invalidate()
+    return "Committed transaction"
+
+
+async def transfer_many(transfers):
+    """Apply a batch of transfers in one transaction (see db.transfer_many).
+
+    Returns a dictionary mapping account id to its new balance in cents.
+    """
+    transfers = list(transfers)
+    account_ids = sorted({account_id for transfer in transfers for account_id in transfer[:2]})
+    if not account_ids:
+        return {}
+
+    async with pool.acquire() as connection:
+        # Leaving the block with an exception rolls the transaction back.
+        async with connection.transaction():
+            rows = await _timed(connection.fetch, 'SELECT id, balance_cents FROM account WHERE id = ANY($1::int[]) '
+                                                  'ORDER BY id FOR UPDATE', account_ids)
+            balances = {row['id']: row['balance_cents'] for row in rows}
+            for index, (from_account_id, to_account_id, amount_cents) in enumerate(transfers):
+                db._check_amount(amount_cents, 'Transfer {}: amount'.format(index))
+                db._check_accounts(from_account_id, to_account_id, 'Transfer {}'.format(index))
+                for account_id in (from_account_id, to_account_id):
+                    if account_id not in balances:
+                        raise db.TransferError("Transfer {}: account {} doesn't exist".format(index, account_id))
+                if balances[from_account_id] < amount_cents:
+                    raise db.TransferError('Transfer {}: insufficient funds in account {}'.format(
+                        index, from_account_id))
+                balances[from_account_id] -= amount_cents
+                balances[to_account_id] += amount_cents
+
+            changed = sorted(balances.items())
+            await _timed(connection.execute,
+                         'UPDATE account SET balance_cents = v.balance_cents '
+                         'FROM unnest($1::int[], $2::bigint[]) AS v (id, balance_cents) WHERE account.id = v.id',
+                         [account_id for account_id, _ in changed], [balance for _, balance in changed])
+            await _timed(connection.execute,
+                         'INSERT INTO ledger (from_account, to_account, amount_cents) '
+                         'SELECT * FROM unnest($1::int[], $2::int[], $3::bigint[])',
+                         *(list(column) for column in zip(*transfers)))
+            await _add_to_summary(connection, transfer_count=len(transfers),
+                                  transferred_total=db.dollars(sum(t[2] for t in transfers)))
+    db.account_directory.invalidate()
+    return balances
+
+
+# Bulk Import ########################################
+#
+# As in db.py, each chunk is copied into a staging table and moved into place
+# with one statement, committing once per chunk. asyncpg copies the rows in
+# PostgreSQL's binary format, so there is no CSV to build.
+
+def _record_chunks(rows, columns, chunk_size):
+    """Yield lists of up to `chunk_size` tuples, from dictionaries or sequences in `columns` order."""
+    rows = iter(rows)
+    while True:
+        chunk = [tuple(row[column] for column in columns) if isinstance(row, dict) else tuple(row)
+                 for row in itertools.islice(rows, chunk_size)]
+        if not chunk:
+            return
+        yield chunk
+
+
+async def import_members(rows, chunk_size=10000, on_conflict='skip', progress=None):
+    """Load many members quickly using COPY (see db.import_members).
+
+    Returns a dictionary with the total rows read and written.
+    """
+    if on_conflict not in db.member_conflict_actions:
+        raise ValueError("on_conflict must be 'skip', 'update', or 'error'")
+    insert = '''
+WITH imported AS (
+  INSERT INTO member (email, first_name, last_name, password)
+  SELECT DISTINCT ON (email) email, first_name, last_name, password FROM member_import
+  {}
+  RETURNING xmax = 0 AS inserted
+)
+SELECT count(*), count(*) FILTER (WHERE inserted) FROM imported'''.format(db.member_conflict_actions[on_conflict])
+
+    read = written = 0
+    async with pool.acquire() as connection:
+        await connection.execute('CREATE TEMPORARY TABLE IF NOT EXISTS member_import (LIKE member)')
+        try:
+            for chunk in _record_chunks(rows, db.member_columns, chunk_size):
+                async with connection.transaction():
+                    await connection.copy_records_to_table('member_import', records=chunk,
+                                                           columns=db.member_columns)
+                    chunk_written, chunk_inserted = await _timed(connection.fetchrow, insert)
+                    await _add_to_summary(connection, member_count=chunk_inserted)
+                    await connection.execute('TRUNCATE member_import')
+                read += len(chunk)
+                written += chunk_written
+                if progress is not None:
+                    progress(read, written)
+        finally:
+            # Imported members may replace ones we have cached.
+            db.member_cache.clear()
+
+    return {'read': read, 'written': written}
+
+
+async def import_comments(rows, chunk_size=10000, progress=None):
+    """Load many comments quickly using COPY, committing once per chunk (see db.import_comments)."""
+    insert = '''
+WITH imported AS (
+  INSERT INTO comment (member, body) SELECT member, body FROM comment_import
+  RETURNING member
+), counted AS (
+  INSERT INTO member_comment_count (member, comment_count)
+  SELECT member, count(*) FROM imported GROUP BY member
+  ON CONFLICT (member) DO UPDATE SET comment_count = member_comment_count.comment_count + excluded.comment_count
+)
+SELECT count(*) FROM imported'''
+
+    read = 0
+    async with pool.acquire() as connection:
+        await connection.execute('CREATE TEMPORARY TABLE IF NOT EXISTS comment_import '
+                                 '(member VARCHAR(100), body TEXT)')
+        for chunk in _record_chunks(rows, db.comment_columns, chunk_size):
+            async with connection.transaction():
+                await connection.copy_records_to_table('comment_import', records=chunk,
+                                                       columns=db.comment_columns)
+                await _add_to_summary(connection, comment_count=await _timed(connection.fetchval, insert))
+                await connection.execute('TRUNCATE comment_import')
+            read += len(chunk)
+            if progress is not None:
+                progress(read, read)
+
+    return {'read': read, 'written': read}
+
+
+# Summaries ########################################
+
+async def _add_to_summary(connection, **amounts):
+    """Add to the running totals in the summary table, in `connection`'s transaction (see db.add_to_summary)."""
+    amounts = {column: amount for column, amount in amounts.items() if amount}
+    if not amounts:
+        return
+    assignments = ', '.join('{0} = {0} + ${1}'.format(column, number) for number, column in enumerate(amounts, 2))
+    await _timed(connection.execute, 'UPDATE summary SET {} WHERE slot = $1'.format(assignments),
+                 db.summary_slot(), *amounts.values())
+
+
+async def summary_totals():
+    """Return the overall totals (account count, total balance, comment count, and so on)."""
+    query = 'SELECT {} FROM summary'.format(', '.join('sum({0}) AS {0}'.format(c) for c in db.summary_columns))
+    return dict(await fetchrow(query))
+
+
+async def top_commenters(limit=10):
+    """Return the members with the most comments, most first, as (member, comment count) pairs."""
+    query = '''
+SELECT member, comment_count FROM member_comment_count
+ORDER BY comment_count DESC, member
+LIMIT $1'''
+    counts = await fetch(query, limit)
+    members = await load_members([row['member'] for row in counts])
+    return [(members[row['member']], row['comment_count']) for row in counts]
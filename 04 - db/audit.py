@@ -0,0 +1,132 @@
+# Check the query plans of the statements in db.py.
+#
+# Seeds the --dsn database (see seed.py), runs each model function once while
+# recording the exact SQL it sends, then runs EXPLAIN (ANALYZE) on every distinct
+# statement and flags sequential scans and sorts. Statements that change data
+# are explained inside a transaction that is rolled back.
+#
+# WARNING: this drops and re-creates the tables in the --dsn database.
+#
+#   python audit.py --dsn "dbname=isd_bench" --scale 1000000
+
+import argparse
+import json
+import sys
+
+import psycopg2
+
+import benchmark
+import db
+import querylog
+import seed
+from application import app
+
+# Node types we want to hear about.
+flagged_nodes = ('Seq Scan', 'Sort')
+
+# Only these statements can be explained.
+explainable = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+captured = {}  # normalized statement -> one actual statement, with values filled in
+
+
+class CapturingCursor(querylog.InstrumentedCursor):
+    """An InstrumentedCursor that also remembers each statement it runs."""
+
+    def execute(self, query, vars=None):
+        sql = self.mogrify(query, vars).decode(self.connection.encoding)
+        # Some functions send more than one statement at once.
+        for statement in sql.split(';\n'):
+            statement = statement.strip()
+            if statement.upper().startswith(explainable):
+                captured.setdefault(querylog.normalize(statement), statement)
+        return super(CapturingCursor, self).execute(query, vars)
+
+
+def all_members(counts):
+    db.all_members()
+
+
+def all_accounts(counts):
+    db.all_accounts()
+
+
+def find_account(counts):
+    db.find_account(100)
+
+
+def update_member(counts):
+    db.update_member(seed.member_email(1), 'First', 'Last', 'pass')
+
+
+# Everything the benchmark suite runs, plus functions it doesn't time.
+workload = [(name, function) for name, function, max_scale in benchmark.benchmarks] + [
+    ('all_members', all_members),
+    ('all_accounts', all_accounts),
+    ('find_account', find_account),
+    ('update_member', update_member),
+]
+
+
+def flagged(plan, found=None):
+    """Return a list of descriptions of the flagged nodes in a JSON query plan."""
+    if found is None:
+        found = []
+    if plan['Node Type'] in flagged_nodes:
+        detail = plan.get('Relation Name') or ', '.join(plan.get('Sort Key', []))
+        found.append('{} ({}) ~{} rows, {:.1f} ms'.format(plan['Node Type'], detail, plan.get('Actual Rows'),
+                                                           plan.get('Actual Total Time', 0.0)))
+    for child in plan.get('Plans', []):
+        flagged(child, found)
+    return found
+
+
+def explain(connection, statement):
+    """Return the plan for a statement, rolling back anything it changed."""
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + statement)
+        plan = cursor.fetchone()[0]
+    connection.rollback()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+def audit(dsn, scale):
+    """Seed the database, capture every statement, and return {statement: [flags]}."""
+    querylog.slow_query_threshold = None
+    connection = psycopg2.connect(dsn)
+    seed.seed(connection, **benchmark.scale_counts(scale))
+
+    db.init_pool(dsn)
+    db.cursor_factory = CapturingCursor
+    counts = benchmark.scale_counts(scale)
+    for name, function in workload:
+        with app.test_request_context():
+            db.open_db_connection()
+            try:
+                function(counts)
+            finally:
+                db.close_db_connection()
+
+    report = {}
+    for normalized, statement in sorted(captured.items()):
+        report[normalized] = flagged(explain(connection, statement)['Plan'])
+    connection.close()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='EXPLAIN every query in db.py (drops and re-creates the tables in --dsn!)')
+    parser.add_argument('--dsn', required=True, help='Database to seed and audit')
+    parser.add_argument('--scale', type=int, default=100000, help='Number of comments to seed')
+    parser.add_argument('--strict', action='store_true', help='Exit with status 1 if anything is flagged')
+    args = parser.parse_args()
+
+    report = audit(args.dsn, args.scale)
+    for statement, flags in report.items():
+        print('OK  ' if not flags else 'FLAG', statement)
+        for flag in flags:
+            print('       ' + flag)
+    if args.strict and any(report.values()):
+        sys.exit(1)
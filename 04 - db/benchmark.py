@@ -0,0 +1,192 @@
+# Time the functions in db.py against generated data at several sizes.
+#
+# For each scale (the number of comments; there are a tenth as many members
+# and accounts), the database at --dsn is re-seeded with seed.py and every
+# benchmark below is run. Results can be saved as a baseline and later runs
+# compared against it; any function whose median time grows by more than
+# --tolerance makes the script exit with status 1.
+#
+# WARNING: this drops and re-creates the tables in the --dsn database.
+#
+#   python benchmark.py --dsn "dbname=isd_bench" --scales 10000 1000000 --save baseline.json
+#   python benchmark.py --dsn "dbname=isd_bench" --scales 10000 1000000 --compare baseline.json
+
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+
+import psycopg2
+
+import db
+import querylog
+import seed
+from application import app
+
+
+def scale_counts(scale):
+    """Return the seed.seed arguments for a given scale."""
+    return {'members': max(scale // 10, 10), 'comments': scale,
+            'photos': max(scale // 20, 5), 'accounts': max(scale // 10, 10)}
+
+
+def random_member(counts):
+    # Uniform over all members, unlike comment authorship.
+    return seed.member_email(random.randint(1, counts['members']))
+
+
+def find_member(counts):
+    db.member_cache.clear()  # Measure the database, not the cache.
+    db.find_member(random_member(counts))
+
+
+def comments_by_member(counts):
+    db.comments_by_member(random_member(counts))
+
+
+def busiest_member_comments(counts):
+    # Member 1 writes the most comments (see the skew in seed.py).
+    db.comments_by_member(seed.member_email(1))
+
+
+def members_page(counts):
+    db.members_page(random_member(counts), 50)
+
+
+def comments_page(counts):
+    db.comments_page(None, 50)
+
+
+def all_comments(counts):
+    db.all_comments()
+
+
+def search_comments(counts):
+    # Each generated comment starts with "Comment <number>:".
+    db.search_comments('"comment {}"'.format(random.randint(1, counts['comments'])))
+
+
+def create_comments(counts):
+    # One commit per comment...
+    for n in range(100):
+        db.create_comment(random_member(counts), 'Benchmark comment')
+
+
+def queue_comments(counts):
+    # ...versus one commit per batch.
+    futures = [db.queue_comment(random_member(counts), 'Benchmark comment') for n in range(100)]
+    for future in futures:
+        future.result()
+
+
+def transfer_funds(counts):
+    # Move a cent back and forth so balances stay put.
+    from_id, to_id = random.sample(range(100, 100 + counts['accounts']), 2)
+    db.transfer_funds(from_id, to_id, 1, False)
+    db.transfer_funds(to_id, from_id, 1, False)
+
+
+# (name, function, largest scale to run it at). all_comments reads every
+# comment into memory, so we stop it before it gets out of hand.
+benchmarks = [
+    ('find_member', find_member, None),
+    ('comments_by_member', comments_by_member, None),
+    ('comments_by_member (busiest)', busiest_member_comments, None),
+    ('members_page', members_page, None),
+    ('comments_page', comments_page, None),
+    ('all_comments', all_comments, 1000000),
+    ('search_comments', search_comments, None),
+    ('create_comment (100)', create_comments, None),
+    ('queue_comment (100)', queue_comments, None),
+    ('transfer_funds', transfer_funds, None),
+]
+
+
+def time_function(function, counts, runs, warmups=2):
+    """Run `function` several times and return timing statistics in milliseconds."""
+    times = []
+    for run in range(warmups + runs):
+        with app.test_request_context():
+            db.open_db_connection()
+            start = time.perf_counter()
+            try:
+                function(counts)
+            finally:
+                elapsed = time.perf_counter() - start
+                db.close_db_connection()
+        if run >= warmups:
+            times.append(1000 * elapsed)
+    times.sort()
+    return {'median_ms': statistics.median(times),
+            'p95_ms': times[min(len(times) - 1, int(0.95 * len(times)))],
+            'min_ms': times[0],
+            'runs': runs}
+
+
+def run(dsn, scales, runs):
+    """Seed the database at each scale and time every benchmark. Returns {scale: {name: stats}}."""
+    querylog.slow_query_threshold = None  # Every query here is slow on purpose; don't log them.
+    db.init_pool(dsn)
+    results = {}
+    for scale in scales:
+        counts = scale_counts(scale)
+        connection = psycopg2.connect(dsn)
+        print('Seeding {} comments...'.format(scale), file=sys.stderr)
+        seed.seed(connection, **counts)
+        connection.close()
+        # The pool may hold connections with plans for the old tables.
+        db.init_pool(dsn)
+
+        random.seed(scale)
+        results[str(scale)] = {}
+        for name, function, max_scale in benchmarks:
+            if max_scale is not None and scale > max_scale:
+                continue
+            stats = time_function(function, counts, runs)
+            results[str(scale)][name] = stats
+            print('{:>10} {:30} median {:9.2f} ms   p95 {:9.2f} ms'.format(scale, name, stats['median_ms'],
+                                                                            stats['p95_ms']))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of messages for every benchmark that got slower than the baseline allows."""
+    regressions = []
+    for scale, functions in results.items():
+        for name, stats in functions.items():
+            before = baseline.get(scale, {}).get(name)
+            if before is None:
+                continue
+            if stats['median_ms'] > before['median_ms'] * (1 + tolerance):
+                regressions.append('{} at {}: median {:.2f} ms, baseline {:.2f} ms'.format(
+                    name, scale, stats['median_ms'], before['median_ms']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark db.py (drops and re-creates the tables in --dsn!)')
+    parser.add_argument('--dsn', required=True, help='Database to seed and benchmark')
+    parser.add_argument('--scales', type=int, nargs='+', default=[10000, 1000000, 10000000],
+                        help='Numbers of comments to benchmark at')
+    parser.add_argument('--runs', type=int, default=20, help='Timed runs of each function')
+    parser.add_argument('--save', help='Write results to this JSON file')
+    parser.add_argument('--compare', help='Compare results with this baseline JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown before failing, as a fraction of the baseline')
+    args = parser.parse_args()
+
+    results = run(args.dsn, args.scales, args.runs)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print('REGRESSION: ' + message, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
@@ -1,173 +1,1303 @@
-from flask import g
+import atexit
+import bisect
+import concurrent.futures
+import csv
+import decimal
+import functools
+import io
+import itertools
+import os
+import random
+import threading
+import time
+from collections import deque, OrderedDict
+
+from flask import g, has_request_context, session
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 
+import querylog
+
 # Database Utilities ########################################
 
-data_source_name = "dbname=isd user=tom host=localhost"
+# Set the DATABASE_URL environment variable to use a different database.
+data_source_name = os.environ.get('DATABASE_URL', "dbname=isd user=tom host=localhost")
+
+# Connection pool settings. Change these before the first request
+# (or call `init_pool` with different values) to resize the pool.
+pool_max_size = 10  # Most connections the pool will ever open at once
+pool_timeout = 30.0  # Seconds to wait for a free connection before giving up
+pool_max_idle = 300.0  # Close connections that sit unused longer than this (seconds)
+pool_health_check = 30.0  # Ping connections idle longer than this before handing them out (seconds)
+
+# The kind of cursor `get_cursor` hands out. InstrumentedCursor times every statement.
+cursor_factory = querylog.InstrumentedCursor
+
+# Member cache settings (see `find_member`).
+member_cache_size = 1024  # Most members kept in memory
+member_cache_ttl = 60.0  # Seconds before a cached member is looked up again
+
+# Account directory setting (see `AccountDirectory`).
+account_directory_ttl = 30.0  # Seconds before the directory is re-read, to pick up other processes' transfers
+
+# Comment writer settings (see `queue_comment`). A longer delay means bigger
+# batches and fewer commits, but each comment takes longer to be stored.
+comment_batch_size = 500  # Most comments written by one INSERT
+comment_batch_delay = 0.01  # Longest a queued comment waits for others to share its commit (seconds)
+
+
+class PoolTimeout(RuntimeError):
+    """Raised when no pooled connection becomes available in time."""
+
+
+class ConnectionPool(object):
+    """A bounded, thread-safe pool of database connections.
+
+    Connections are opened on demand, up to `max_size`. When all connections
+    are checked out, `checkout` blocks until one is returned or `timeout`
+    seconds pass. Idle connections older than `max_idle` are closed, and
+    connections idle longer than `health_check` are pinged before reuse.
+    """
+
+    def __init__(self, dsn, max_size=10, timeout=30.0, max_idle=300.0, health_check=30.0):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check = health_check
+
+        self._idle = deque()  # (connection, time returned to the pool)
+        self._size = 0  # Open connections, idle or checked out
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._closed = False
+
+        self._waiting = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn)
+
+    def _is_healthy(self, connection):
+        """Make sure a connection that has been idle a while still works."""
+        if connection.closed:
+            return False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, connection):
+        """Close a connection and give its slot back. Call with the lock held."""
+        self._size -= 1
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def _prune(self, now):
+        """Close idle connections that have outlived `max_idle`. Call with the lock held."""
+        while self._idle and now - self._idle[0][1] > self.max_idle:
+            connection, _ = self._idle.popleft()
+            self._discard(connection)
+
+    def checkout(self):
+        """Return a connection from the pool, opening one if there is room."""
+        start = time.monotonic()
+        with self._lock:
+            self._prune(start)
+            self._waiting += 1
+            try:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = self.timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout('No database connection available after {:.1f}s'.format(self.timeout))
+                    self._available.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+            waited = time.monotonic() - start
+            self._checkouts += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+
+            if self._idle:
+                # Most recently returned first, so the oldest ones can age out.
+                connection, returned_at = self._idle.pop()
+            else:
+                connection, returned_at = None, None
+                self._size += 1
+
+        # Talk to the server outside the lock.
+        try:
+            if connection is not None and (connection.closed or
+                                           time.monotonic() - returned_at > self.health_check):
+                if not self._is_healthy(connection):
+                    with self._lock:
+                        self._discard(connection)
+                        self._size += 1
+                    connection = None
+            if connection is None:
+                connection = self._connect()
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._available.notify()
+            raise
+        return connection
+
+    def checkin(self, connection):
+        """Return a connection to the pool, rolling back any open transaction."""
+        healthy = not connection.closed
+        if healthy and connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                healthy = False
+        with self._lock:
+            if healthy and not self._closed:
+                self._idle.append((connection, time.monotonic()))
+            else:
+                self._discard(connection)
+            self._available.notify()
+
+    def close(self):
+        """Close all idle connections. Connections still checked out are closed when returned."""
+        with self._lock:
+            self._closed = True
+            while self._idle:
+                connection, _ = self._idle.popleft()
+                self._discard(connection)
+            self._available.notify_all()
+
+    def stats(self):
+        """Return a dictionary of pool usage counters."""
+        with self._lock:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'waiting': self._waiting,
+                'max_size': self.max_size,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'total_wait': self._total_wait,
+                'max_wait': self._max_wait,
+                'avg_wait': self._total_wait / self._checkouts if self._checkouts else 0.0,
+            }
+
+
+connection_pool = None
+_pool_lock = threading.Lock()
+
+
+def init_pool(dsn=None, **settings):
+    """Replace the connection pool, closing the old one.
+
+    Keyword arguments override the `pool_*` settings above.
+    """
+    global connection_pool
+    options = {'max_size': pool_max_size, 'timeout': pool_timeout,
+               'max_idle': pool_max_idle, 'health_check': pool_health_check}
+    options.update(settings)
+    with _pool_lock:
+        if connection_pool is not None:
+            connection_pool.close()
+        connection_pool = ConnectionPool(dsn or data_source_name, **options)
+    return connection_pool
+
+
+def get_pool():
+    """Return the connection pool, creating it on first use."""
+    global connection_pool
+    if connection_pool is None:
+        with _pool_lock:
+            if connection_pool is None:
+                connection_pool = ConnectionPool(data_source_name,
+                                                 max_size=pool_max_size,
+                                                 timeout=pool_timeout,
+                                                 max_idle=pool_max_idle,
+                                                 health_check=pool_health_check)
+    return connection_pool
+
+
+def pool_stats():
+    """Return usage counters for the connection pool."""
+    return get_pool().stats()
 
 
 def open_db_connection():
-    """Open a connection to the database.
+    """Prepare the request to use the database.
 
-    Open a connection to the SQLite database at `db_path`.
-    Store the resulting connection in the `g.sql` global object.
+    No connection is taken from the pool here; the first call to
+    `get_cursor` checks one out and stores it in `g.connection`,
+    so requests that never query the database never touch the pool.
     """
-    g.connection = psycopg2.connect(data_source_name)
-    g.cursor = g.connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    g.connections = {}  # 'primary' or replica number -> (pool, connection, cursor)
+    g.connection = None
+    g.cursor = None
+
+
+def _connection_for(target):
+    """Return this request's (connection, cursor) for `target`, checking out a connection if needed."""
+    connections = g.setdefault('connections', {})
+    if target not in connections:
+        pool = get_pool() if target == 'primary' else get_replica_pools()[target]
+        connection = pool.checkout()
+        connections[target] = (pool, connection, connection.cursor(cursor_factory=cursor_factory))
+    return connections[target][1:]
+
+
+def get_cursor():
+    """Return the cursor for this request, checking out a connection if needed.
+
+    Inside a function tagged with `@reads` this may be a replica's cursor
+    (see Read Replicas below); everywhere else it is the primary's.
+    By default the cursor times every statement it runs (see `cursor_factory`).
+    """
+    target = g.get('db_target')
+    g.connection, g.cursor = _connection_for('primary' if target is None else target)
+    return g.cursor
 
 
 def close_db_connection():
-    g.cursor.close()
-    g.connection.close()
+    """Return this request's connections (if any) to the pools they came from.
+
+    That may not be the current pool: `init_pool` or `init_replicas` may have
+    replaced it during the request. A closed pool closes what is returned to it.
+    """
+    g.pop('cursor', None)
+    g.pop('connection', None)
+    for pool, connection, cursor in g.pop('connections', {}).values():
+        cursor.close()
+        pool.checkin(connection)
+
+
+# Read Replicas ########################################
+#
+# Model functions are tagged `@reads` or `@writes`. When replica DSNs are
+# configured, functions tagged `@reads` run on a replica and everything else
+# runs on the primary. Replicas lag a little behind the primary, so once a
+# request has written anything, its later reads go to the primary too, and
+# so do the reads of the same session for `primary_stickiness` seconds
+# (e.g., the page you are redirected to after submitting a form).
+#
+# To try this with a single server, list the primary's own DSN as a replica.
+
+# Set the DATABASE_REPLICA_URLS environment variable to replica DSNs separated by semicolons.
+replica_data_source_names = [dsn for dsn in os.environ.get('DATABASE_REPLICA_URLS', '').split(';') if dsn.strip()]
+replica_selection = 'round-robin'  # Or 'least-loaded': the replica with the fewest connections in use
+primary_stickiness = 5.0  # Seconds a session keeps reading from the primary after it writes
+
+replica_pools = None
+_replica_turn = itertools.count()
+
+
+def init_replicas(dsns=None, selection=None, **settings):
+    """Replace the replica pools, closing the old ones.
+
+    Pass an empty list to send every query to the primary. Keyword
+    arguments override the `pool_*` settings, as for `init_pool`.
+    """
+    global replica_pools, replica_data_source_names, replica_selection
+    options = {'max_size': pool_max_size, 'timeout': pool_timeout,
+               'max_idle': pool_max_idle, 'health_check': pool_health_check}
+    options.update(settings)
+    with _pool_lock:
+        for pool in replica_pools or []:
+            pool.close()
+        if dsns is not None:
+            replica_data_source_names = list(dsns)
+        if selection is not None:
+            replica_selection = selection
+        replica_pools = [ConnectionPool(dsn, **options) for dsn in replica_data_source_names]
+    return replica_pools
+
+
+def get_replica_pools():
+    """Return one connection pool per replica, creating them on first use."""
+    if replica_pools is None:
+        init_replicas()
+    return replica_pools
+
+
+def replica_pool_stats():
+    """Return usage counters for each replica's connection pool."""
+    return [pool.stats() for pool in get_replica_pools()]
+
+
+def choose_replica():
+    """Return the number of the replica to use next, according to `replica_selection`."""
+    pools = get_replica_pools()
+    if replica_selection == 'least-loaded':
+        def load(number):
+            stats = pools[number].stats()
+            return stats['in_use'] + stats['waiting']
+        return min(range(len(pools)), key=load)
+    return next(_replica_turn) % len(pools)
+
+
+def read_target():
+    """Return where a read should run now: 'primary' or the number of a replica.
+
+    A request uses the same replica for all its reads, so they see the same data.
+    """
+    if not get_replica_pools() or g.get('db_target') == 'primary' or g.get('wrote_to_primary'):
+        return 'primary'
+    if has_request_context() and session.get('primary_until', 0) > time.time():
+        return 'primary'
+    if g.get('replica') is None:
+        g.replica = choose_replica()
+    return g.replica
+
+
+def _run_on(target, function, args, kwargs):
+    """Call `function` with `get_cursor` pointed at `target`, then point it back."""
+    saved = (g.get('db_target'), g.get('connection'), g.get('cursor'))
+    g.db_target = target
+    try:
+        return function(*args, **kwargs)
+    finally:
+        g.db_target, g.connection, g.cursor = saved
+
+
+def reads(function):
+    """Tag a model function as read-only, so it may run on a replica."""
+    @functools.wraps(function)
+    def read(*args, **kwargs):
+        return _run_on(read_target(), function, args, kwargs)
+    read.access = 'read'
+    return read
+
+
+def writes(function):
+    """Tag a model function as one that changes data.
+
+    It runs on the primary, and so do the reads that follow it in this request and session.
+    """
+    @functools.wraps(function)
+    def write(*args, **kwargs):
+        g.wrote_to_primary = True
+        if has_request_context() and get_replica_pools():
+            session['primary_until'] = time.time() + primary_stickiness
+        return _run_on('primary', function, args, kwargs)
+    write.access = 'write'
+    return write
+
+
+# Member Cache ########################################
+
+
+class MemberCache(object):
+    """A thread-safe LRU cache whose entries also expire after `ttl` seconds.
+
+    The cache lives in this process only. Model functions that change a
+    member call `invalidate`; the TTL bounds how stale an entry can get
+    when some other process changes the database.
+    """
+
+    def __init__(self, max_size=1024, ttl=60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, expiry time)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Return the cached value for `key`, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return a dictionary of cache counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+member_cache = MemberCache(member_cache_size, member_cache_ttl)
+
+
+def member_cache_stats():
+    """Return hit, miss, and eviction counters for the member cache."""
+    return member_cache.stats()
 
 
 # Users and Comments ########################################
 
 
+@writes
 def create_member(email, first_name, last_name, password):
     """Create a new member."""
     query = '''
 INSERT INTO member (email, first_name, last_name, password)
 VALUES (%(email)s, %(first)s, %(last)s, %(pass)s)
     '''
-    g.cursor.execute(query, {'email': email, 'first': first_name, 'last': last_name, 'pass': password})
+    get_cursor().execute(query, {'email': email, 'first': first_name, 'last': last_name, 'pass': password})
+    rowcount = g.cursor.rowcount
+    add_to_summary(member_count=rowcount)
     g.connection.commit()
-    return g.cursor.rowcount
+    forget_member(email)
+    return rowcount
 
 
-def init_photo(email):
-    """Create a photo record and return its ID"""
-    query_dictionary = {'email': email}
-    g.cursor.execute("INSERT INTO photo (member_email) VALUES (%(email)s)", query_dictionary)
+@writes
+def create_comment(email, body):
+    """Add a comment from a member and return the new row.
+
+    The comment, the member's comment count, and the overall comment count
+    are all written by one statement, in one transaction.
+    """
+    query = '''
+WITH new_comment AS (
+  INSERT INTO comment (body, member) VALUES (%(body)s, %(email)s)
+  RETURNING id, body, member
+), counted AS (
+  INSERT INTO member_comment_count (member, comment_count)
+  SELECT member, 1 FROM new_comment
+  ON CONFLICT (member) DO UPDATE SET comment_count = member_comment_count.comment_count + 1
+), summarized AS (
+  UPDATE summary SET comment_count = comment_count + 1 WHERE slot = %(slot)s
+)
+SELECT * FROM new_comment'''
+    get_cursor().execute(query, {'body': body, 'email': email, 'slot': summary_slot()})
+    comment = g.cursor.fetchone()
     g.connection.commit()
+    forget_member(email)
+    return comment
 
-    g.cursor.execute("SELECT * FROM photo WHERE member_email = (%(email)s)", query_dictionary)
-    return g.cursor.fetchone()
 
+@writes
+def create_photo(email, file_path):
+    """Create a photo record for a member and return the new row (including its ID)."""
+    query = """
+    INSERT INTO photo (member_email, file_path) VALUES (%(email)s, %(file_path)s)
+    RETURNING *
+    """
+    get_cursor().execute(query, {'email': email, 'file_path': file_path})
+    photo = g.cursor.fetchone()
+    g.connection.commit()
+    forget_member(email)
+    return photo
 
+
+@writes
 def set_photo(photo_id, file_path):
     """Update a photo record with the proper file name"""
     query = """
     UPDATE photo SET file_path = %(file_path)s
     WHERE id = %(id)s
+    RETURNING member_email
     """
-    g.cursor.execute(query, {'file_path': file_path, 'id': photo_id})
+    get_cursor().execute(query, {'file_path': file_path, 'id': photo_id})
     g.connection.commit()
+    for row in g.cursor.fetchall():
+        forget_member(row['member_email'])
     return g.cursor.rowcount
 
 
+@reads
 def last_photo_seq():
-    g.cursor.execute('SELECT last_value FROM photo_id_seq')
+    get_cursor().execute('SELECT last_value FROM photo_id_seq')
     return g.cursor.fetchone()[0]
 
 
+@reads
 def all_members():
     """List all members."""
-    g.cursor.execute('SELECT * FROM member ORDER BY email')
+    get_cursor().execute('SELECT * FROM member ORDER BY email')
     return g.cursor.fetchall()
 
 
+@reads
 def all_comments():
     """List all comments."""
     query = '''
 SELECT first_name, last_name, email, body
 FROM member INNER JOIN comment ON member.email = comment.member
 ORDER BY last_name ASC, first_name ASC'''
-    g.cursor.execute(query)
+    get_cursor().execute(query)
+    return g.cursor.fetchall()
+
+
+@reads
+def members_page(after_email=None, limit=50):
+    """Return up to `limit` members whose e-mail sorts after `after_email`.
+
+    This is keyset pagination: pass the e-mail of the last member on one page
+    to get the next page. Unlike OFFSET, every page costs the same.
+    """
+    query = 'SELECT email, first_name, last_name FROM member'
+    if after_email is not None:
+        query += ' WHERE email > %(after)s'
+    query += ' ORDER BY email LIMIT %(limit)s'
+    get_cursor().execute(query, {'after': after_email, 'limit': limit})
     return g.cursor.fetchall()
 
 
+@reads
+def comments_page(after=None, limit=50):
+    """Return up to `limit` comments that sort after the key `after`.
+
+    Comments are ordered by (last_name, first_name, id). Pass the
+    `(last_name, first_name, id)` of the last comment on one page
+    to get the next page.
+    """
+    query = '''
+SELECT c.id, m.first_name, m.last_name, m.email, c.body
+FROM member AS m INNER JOIN comment AS c ON m.email = c.member'''
+    params = {'limit': limit}
+    if after is not None:
+        query += '\nWHERE (m.last_name, m.first_name, c.id) > (%(last)s, %(first)s, %(id)s)'
+        params.update({'last': after[0], 'first': after[1], 'id': after[2]})
+    query += '\nORDER BY m.last_name ASC, m.first_name ASC, c.id ASC\nLIMIT %(limit)s'
+    get_cursor().execute(query, params)
+    return g.cursor.fetchall()
+
+
+def _stream_query(name, query, batch_size):
+    """Yield the rows of `query` using a server-side (named) cursor.
+
+    Only `batch_size` rows are held in memory at a time, no matter
+    how many rows the query returns. The rows come from a replica if there is one.
+    """
+    connection, _ = _connection_for(read_target())
+    cursor = connection.cursor(name=name, cursor_factory=cursor_factory)
+    cursor.itersize = batch_size
+    try:
+        cursor.execute(query)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+
+@reads
+def stream_members(batch_size=1000):
+    """Yield every member, in the same order as `all_members`, without loading them all."""
+    return _stream_query('stream_members',
+                         'SELECT email, first_name, last_name FROM member ORDER BY email',
+                         batch_size)
+
+
+@reads
+def stream_comments(batch_size=1000):
+    """Yield every comment, in the same order as `comments_page`, without loading them all."""
+    query = '''
+SELECT c.id, m.first_name, m.last_name, m.email, c.body
+FROM member AS m INNER JOIN comment AS c ON m.email = c.member
+ORDER BY m.last_name ASC, m.first_name ASC, c.id ASC'''
+    return _stream_query('stream_comments', query, batch_size)
+
+
+@reads
 def find_member(memberEmail):
-    """Look up a single member."""
-    query = """
-    SELECT m.email, m.first_name, m.last_name, p.file_path
-    FROM member AS m
-       LEFT OUTER JOIN photo AS p ON m.email = p.member_email 
-    WHERE email = %(emailParam)s
+    """Look up a single member.
+
+    Results are kept in `member_cache`; functions that change a member
+    or its photo drop the cached copy.
     """
-    g.cursor.execute(query, {'emailParam': memberEmail})
-    return g.cursor.fetchone()
+    return load_members([memberEmail])[memberEmail]
 
 
+@reads
 def comments_by_member(email):
     """Retrieve comments for a member with the given e-mail address."""
-    g.cursor.execute('SELECT * FROM comment WHERE member = %(email)s', {'email': email})
-    return g.cursor.fetchall()
+    return load_comments([email])[email]
+
+
+# Words in matching comments are wrapped in these characters by `search_comments`,
+# so the page can highlight them after escaping the rest of the comment.
+highlight_start = '\x02'
+highlight_stop = '\x03'
+
+
+@reads
+def search_comments(query, limit=20, cursor=None):
+    """Find comments matching a web-style search (words, "quoted phrases", -excluded words).
+
+    Uses the full-text index on comment.body (migration 003). Results come
+    best match first, `limit` at a time. Returns (comments, next_cursor):
+    pass `next_cursor` back in to get the next page; it is None on the
+    last page. Each comment has a `headline` with the matching words marked
+    by `highlight_start` and `highlight_stop`. Raises ValueError for a
+    cursor that didn't come from this function.
+    """
+    after_rank, after_id = None, None
+    if cursor:
+        rank, _, comment_id = cursor.partition(':')
+        after_rank, after_id = float(rank), int(comment_id)
+
+    # Only the page of comments we return gets a headline (they're slow to make).
+    query_sql = '''
+WITH search AS (
+  SELECT websearch_to_tsquery('english', %(query)s) AS terms
+), page AS (
+  SELECT c.id, c.member, c.body, ts_rank_cd(c.body_search, s.terms) AS rank
+  FROM comment AS c, search AS s
+  WHERE c.body_search @@ s.terms
+    AND (%(after_id)s IS NULL OR (ts_rank_cd(c.body_search, s.terms), c.id) < (%(after_rank)s::real, %(after_id)s))
+  ORDER BY rank DESC, c.id DESC
+  LIMIT %(limit)s
+)
+SELECT p.id, p.body, p.rank, m.email, m.first_name, m.last_name,
+       ts_headline('english', p.body, s.terms,
+                   'StartSel=' || %(start)s || ', StopSel=' || %(stop)s || ', HighlightAll=false') AS headline
+FROM page AS p
+  INNER JOIN member AS m ON m.email = p.member
+  CROSS JOIN search AS s
+ORDER BY p.rank DESC, p.id DESC'''
+    get_cursor().execute(query_sql, {'query': query, 'limit': limit + 1, 'after_rank': after_rank,
+                                     'after_id': after_id, 'start': highlight_start, 'stop': highlight_stop})
+    comments = g.cursor.fetchall()
+    next_cursor = None
+    if len(comments) > limit:
+        comments = comments[:limit]
+        next_cursor = '{}:{}'.format(comments[-1]['rank'], comments[-1]['id'])
+    return comments, next_cursor
+
+
+# Batched Loading ########################################
+
+
+class RequestLoader(object):
+    """Rows already loaded during this request, so no row is fetched twice."""
+
+    def __init__(self):
+        self.members = {}
+        self.comments = {}
+        self.comment_counts = {}
+
+    def missing(self, loaded, emails):
+        """Return the e-mails (without duplicates) that aren't in `loaded` yet."""
+        return [email for email in set(emails) if email not in loaded]
+
+    def forget(self, email):
+        for loaded in (self.members, self.comments, self.comment_counts):
+            loaded.pop(email, None)
+
+
+def request_loader():
+    """Return the loader for the current request, creating it if needed."""
+    if g.get('loader') is None:
+        g.loader = RequestLoader()
+    return g.loader
+
+
+def forget_member(email):
+    """Drop every cached copy of a member's data after it changes."""
+    member_cache.invalidate(email)
+    if g:
+        request_loader().forget(email)
+
+
+@reads
+def load_members(emails):
+    """Look up many members (with their newest photo) at once.
+
+    Returns a dictionary mapping each e-mail to its member, or to None if
+    there is no such member. Members found in `member_cache` or already
+    loaded during this request aren't fetched again; the rest are fetched
+    with a single query.
 
+    Only rows read from the primary go into `member_cache`: a replica may
+    still have a row the primary has since changed, and caching it would
+    serve it to every request until it expired. While the session is
+    reading its own writes (see `primary_stickiness`), the cache is skipped.
+    """
+    loader = request_loader()
+    on_primary = g.get('db_target', 'primary') == 'primary'
+    use_cache = not (has_request_context() and session.get('primary_until', 0) > time.time())
+    wanted = []
+    for email in loader.missing(loader.members, emails):
+        member = member_cache.get(email) if use_cache else None
+        if member is not None:
+            loader.members[email] = member
+        else:
+            wanted.append(email)
+
+    if wanted:
+        query = """
+    SELECT m.email, m.first_name, m.last_name, p.file_path
+    FROM member AS m
+       LEFT JOIN LATERAL (SELECT file_path FROM photo
+                          WHERE photo.member_email = m.email
+                          ORDER BY id DESC LIMIT 1) AS p ON TRUE
+    WHERE m.email = ANY(%(emails)s)
+    """
+        get_cursor().execute(query, {'emails': wanted})
+        for member in g.cursor.fetchall():
+            if on_primary:
+                member_cache.put(member['email'], member)
+            loader.members[member['email']] = member
+        for email in wanted:
+            loader.members.setdefault(email, None)
+
+    return {email: loader.members[email] for email in emails}
+
+
+@reads
+def load_comments(emails):
+    """Return a dictionary mapping each e-mail to the list of that member's comments.
+
+    All the comments not already loaded during this request are fetched with a single query.
+    """
+    loader = request_loader()
+    wanted = loader.missing(loader.comments, emails)
+    if wanted:
+        query = 'SELECT id, body, member FROM comment WHERE member = ANY(%(emails)s) ORDER BY member, id'
+        get_cursor().execute(query, {'emails': wanted})
+        for email in wanted:
+            loader.comments[email] = []
+        for comment in g.cursor.fetchall():
+            loader.comments[comment['member']].append(comment)
+    return {email: loader.comments[email] for email in emails}
+
+
+@reads
+def load_comment_counts(emails):
+    """Return a dictionary mapping each e-mail to the number of comments by that member.
+
+    The counts come from the `member_comment_count` summary table rather than counting comments.
+    """
+    loader = request_loader()
+    wanted = loader.missing(loader.comment_counts, emails)
+    if wanted:
+        query = 'SELECT member, comment_count FROM member_comment_count WHERE member = ANY(%(emails)s)'
+        get_cursor().execute(query, {'emails': wanted})
+        for email in wanted:
+            loader.comment_counts[email] = 0
+        for member, count in g.cursor.fetchall():
+            loader.comment_counts[member] = count
+    return {email: loader.comment_counts[email] for email in emails}
 
+
+@writes
 def update_member(email, first_name, last_name, password):
     """Update a member's profile."""
     query = '''
 UPDATE member SET first_name = %(first)s, last_name = %(last)s, password = %(pass)s
 WHERE email = %(email)s
     '''
-    g.cursor.execute(query, {'first': first_name, 'last': last_name, 'email': email, 'pass': password})
+    get_cursor().execute(query, {'first': first_name, 'last': last_name, 'email': email, 'pass': password})
     g.connection.commit()
+    forget_member(email)
     return g.cursor.rowcount
 
 
+# Comment Ingestion ########################################
+#
+# Committing each comment on its own makes PostgreSQL flush its log to disk
+# once per comment. `queue_comment` instead hands the comment to a background
+# writer, which collects comments for up to `comment_batch_delay` seconds (or
+# until it has `comment_batch_size` of them) and writes the whole batch with
+# one INSERT and one commit. Callers get a Future that resolves to the new
+# row once the batch is committed.
+
+
+class CommentWriter(object):
+    """Writes queued comments in batches from a background thread (group commit).
+
+    `max_delay` is the latency/throughput knob: the longest a comment waits
+    for others to share its commit. With 0, comments are still batched
+    whenever they arrive while the previous batch is being committed.
+    """
+
+    def __init__(self, pool=None, batch_size=500, max_delay=0.01):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+
+        self._queue = []  # (email, body, future, time queued)
+        self._closing = False
+        self._thread = None
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+        # Statistics
+        self._batches = 0
+        self._comments = 0
+        self._failures = 0
+        self._total_wait = 0.0
+
+    def submit(self, email, body):
+        """Queue a comment. Returns a Future for the new (id, body, member) row."""
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._closing:
+                raise RuntimeError('Comment writer is closed')
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='comment-writer', daemon=True)
+                self._thread.start()
+            self._queue.append((email, body, future, time.monotonic()))
+            self._changed.notify_all()
+        return future
+
+    def flush(self, timeout=None):
+        """Wait until every comment queued so far has been written (or failed)."""
+        with self._lock:
+            futures = [future for _, _, future, _ in self._queue]
+            self._changed.notify_all()
+        concurrent.futures.wait(futures, timeout)
+
+    def close(self):
+        """Write what's queued, then stop the background thread."""
+        with self._lock:
+            self._closing = True
+            self._changed.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {'queued': len(self._queue),
+                    'batches': self._batches,
+                    'comments': self._comments,
+                    'failures': self._failures,
+                    'avg_batch': self._comments / self._batches if self._batches else 0.0,
+                    'avg_wait': self._total_wait / self._comments if self._comments else 0.0}
+
+    def _next_batch(self):
+        """Wait for comments, then for the batch to fill or the oldest to wait `max_delay`."""
+        with self._lock:
+            while not self._queue and not self._closing:
+                self._changed.wait()
+            if self._queue:
+                deadline = self._queue[0][3] + self.max_delay
+                while len(self._queue) < self.batch_size and not self._closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._changed.wait(remaining)
+            batch = self._queue[:self.batch_size]
+            del self._queue[:self.batch_size]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return  # Closing, and nothing left to write
+            pool = self.pool or get_pool()
+            try:
+                connection = pool.checkout()
+            except PoolTimeout as err:
+                for _, _, future, _ in batch:
+                    future.set_exception(err)
+                continue
+            try:
+                self._write(connection, batch)
+            except Exception as err:
+                # Keep the thread alive, and don't leave anyone waiting forever.
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(err)
+            finally:
+                pool.checkin(connection)
+
+    def _write(self, connection, batch):
+        """Insert a batch in one transaction, then resolve its futures.
+
+        If the batch fails (say, one comment names an unknown member), each
+        comment is retried on its own so only the bad ones fail.
+        """
+        slot = summary_slot()
+        # execute_values fills in the single %s; the slot is an integer we chose.
+        query = '''
+WITH new_comment AS (
+  INSERT INTO comment (body, member) VALUES %s
+  RETURNING id, body, member
+), counted AS (
+  INSERT INTO member_comment_count (member, comment_count)
+  SELECT member, count(*) FROM new_comment GROUP BY member
+  ON CONFLICT (member) DO UPDATE SET comment_count = member_comment_count.comment_count + excluded.comment_count
+), summarized AS (
+  UPDATE summary SET comment_count = comment_count + (SELECT count(*) FROM new_comment) WHERE slot = {}
+)
+SELECT * FROM new_comment'''.format(int(slot))
+        try:
+            with connection.cursor(cursor_factory=cursor_factory) as cursor:
+                rows = psycopg2.extras.execute_values(cursor, query, [(body, email) for email, body, _, _ in batch],
+                                                      page_size=len(batch), fetch=True)
+            connection.commit()
+        except psycopg2.Error as err:
+            connection.rollback()
+            if len(batch) > 1:
+                for item in batch:
+                    self._write(connection, [item])
+                return
+            with self._lock:
+                self._failures += 1
+            batch[0][2].set_exception(err)
+            return
+
+        # Rows get ids in the order they are listed in VALUES.
+        rows.sort(key=lambda row: row['id'])
+        now = time.monotonic()
+        with self._lock:
+            self._batches += 1
+            self._comments += len(batch)
+            self._total_wait += sum(now - queued for _, _, _, queued in batch)
+        for (email, _, future, _), row in zip(batch, rows):
+            member_cache.invalidate(email)
+            future.set_result(row)
+
+
+comment_writer = None
+_comment_writer_lock = threading.Lock()
+
+
+def get_comment_writer():
+    """Return the process's comment writer, creating it on first use."""
+    global comment_writer
+    if comment_writer is None:
+        with _comment_writer_lock:
+            if comment_writer is None:
+                comment_writer = CommentWriter(batch_size=comment_batch_size, max_delay=comment_batch_delay)
+                # Don't lose queued comments when the process exits.
+                atexit.register(comment_writer.close)
+    return comment_writer
+
+
+@writes
+def queue_comment(email, body):
+    """Queue a comment to be written with others. Returns a Future for the new row.
+
+    Call `result()` on the Future to wait until the comment is safely stored;
+    it raises psycopg2.Error if the comment couldn't be written.
+    """
+    if g:
+        request_loader().forget(email)
+    return get_comment_writer().submit(email, body)
+
+
+def comment_writer_stats():
+    """Return batch counters for the comment writer."""
+    return get_comment_writer().stats()
+
+
+# Bulk Import ########################################
+
+member_columns = ('email', 'first_name', 'last_name', 'password')
+comment_columns = ('member', 'body')
+
+# What import_members does with e-mails that already exist.
+member_conflict_actions = {
+    'skip': 'ON CONFLICT (email) DO NOTHING',
+    'update': 'ON CONFLICT (email) DO UPDATE SET first_name = excluded.first_name, '
+              'last_name = excluded.last_name, password = excluded.password',
+    'error': '',
+}
+
+
+def _csv_chunks(rows, columns, chunk_size):
+    """Yield (buffer, row count) pairs, each buffer holding up to `chunk_size` rows as CSV.
+
+    Rows can be dictionaries (e.g., from csv.DictReader) or sequences in `columns` order.
+    Only one chunk is in memory at a time.
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in chunk:
+            if isinstance(row, dict):
+                row = [row[column] for column in columns]
+            writer.writerow(row)
+        buffer.seek(0)
+        yield buffer, len(chunk)
+
+
+@writes
+def import_members(rows, chunk_size=10000, on_conflict='skip', progress=None):
+    """Load many members quickly using COPY.
+
+    Each chunk of `chunk_size` rows is copied into a temporary staging table
+    and then moved into `member` with one INSERT, so the cost is a few round
+    trips and one commit per chunk rather than per row. `on_conflict` says
+    what to do with e-mails that already exist: 'skip' them, 'update' them,
+    or raise an 'error' (which rolls back the current chunk).
+
+    If given, `progress(rows_read, rows_written)` is called after each chunk.
+    Returns a dictionary with the total rows read and written.
+    """
+    if on_conflict not in member_conflict_actions:
+        raise ValueError("on_conflict must be 'skip', 'update', or 'error'")
+
+    cursor = get_cursor()
+    cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS member_import (LIKE member)')
+    # DISTINCT ON keeps one row per e-mail in case the input repeats one.
+    # An xmax of zero means the row was inserted rather than updated.
+    insert = '''
+WITH imported AS (
+  INSERT INTO member (email, first_name, last_name, password)
+  SELECT DISTINCT ON (email) email, first_name, last_name, password FROM member_import
+  {}
+  RETURNING xmax = 0 AS inserted
+)
+SELECT count(*), count(*) FILTER (WHERE inserted) FROM imported'''.format(member_conflict_actions[on_conflict])
+
+    read = written = 0
+    try:
+        for buffer, count in _csv_chunks(rows, member_columns, chunk_size):
+            cursor.copy_expert('COPY member_import ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                ', '.join(member_columns)), buffer)
+            cursor.execute(insert)
+            chunk_written, chunk_inserted = cursor.fetchone()
+            written += chunk_written
+            add_to_summary(member_count=chunk_inserted)
+            cursor.execute('TRUNCATE member_import')
+            g.connection.commit()
+            read += count
+            if progress is not None:
+                progress(read, written)
+    except psycopg2.Error:
+        g.connection.rollback()
+        raise
+    finally:
+        # Imported members may replace ones we have cached.
+        member_cache.clear()
+        g.pop('loader', None)
+
+    return {'read': read, 'written': written}
+
+
+@writes
+def import_comments(rows, chunk_size=10000, progress=None):
+    """Load many comments quickly using COPY, committing once per chunk.
+
+    Each row has the member's e-mail and the comment body. Each chunk is
+    copied into a staging table and moved into `comment` with one statement
+    that also updates the comment counts. If a chunk refers to a member that
+    doesn't exist, that chunk is rolled back and the error is raised.
+    """
+    cursor = get_cursor()
+    cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS comment_import (member VARCHAR(100), body TEXT)')
+    insert = '''
+WITH imported AS (
+  INSERT INTO comment (member, body) SELECT member, body FROM comment_import
+  RETURNING member
+), counted AS (
+  INSERT INTO member_comment_count (member, comment_count)
+  SELECT member, count(*) FROM imported GROUP BY member
+  ON CONFLICT (member) DO UPDATE SET comment_count = member_comment_count.comment_count + excluded.comment_count
+)
+SELECT count(*) FROM imported'''
+
+    read = 0
+    try:
+        for buffer, count in _csv_chunks(rows, comment_columns, chunk_size):
+            cursor.copy_expert('COPY comment_import ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                ', '.join(comment_columns)), buffer)
+            cursor.execute(insert)
+            add_to_summary(comment_count=cursor.fetchone()[0])
+            cursor.execute('TRUNCATE comment_import')
+            g.connection.commit()
+            read += count
+            if progress is not None:
+                progress(read, read)
+    except psycopg2.Error:
+        g.connection.rollback()
+        raise
+    finally:
+        g.pop('loader', None)
+
+    return {'read': read, 'written': read}
+
+
 # Accounts ########################################
+#
+# Balances and amounts are whole cents (integers), so they add up exactly.
+# Every movement of money is also written to the ledger table, which
+# reconcile.py checks the balances against.
+
+def to_cents(amount):
+    """Convert a dollar amount (a string, Decimal, int, or float like 12.34) to integer cents.
+
+    Raises ValueError if the amount has fractions of a cent.
+    """
+    try:
+        cents = decimal.Decimal(str(amount)).scaleb(2)
+    except decimal.InvalidOperation:
+        raise ValueError('{!r} is not an amount'.format(amount))
+    if not cents.is_finite() or cents != cents.to_integral_value():
+        raise ValueError('{} is not a whole number of cents'.format(amount))
+    return int(cents)
+
+
+def dollars(cents):
+    """Return an amount in cents as a Decimal number of dollars (1234 -> Decimal('12.34'))."""
+    return decimal.Decimal(cents).scaleb(-2)
 
+
+@reads
 def all_accounts():
     """Return all data in the account table."""
-    g.cursor.execute('SELECT * FROM account ORDER BY name')
+    get_cursor().execute('SELECT * FROM account ORDER BY name')
     return g.cursor.fetchall()
 
 
+@reads
 def find_account(account_id):
     """Return the balance for the account with id 'account_id'."""
-    g.cursor.execute('SELECT * FROM account WHERE id=%(id)s', {'id': account_id})
+    get_cursor().execute('SELECT * FROM account WHERE id=%(id)s', {'id': account_id})
     return g.cursor.fetchone()
 
 
+@reads
 def read_balance(account_id):
-    """Get the balance for an account."""
-    g.cursor.execute('SELECT balance FROM account WHERE id=%(id)s', {'id': account_id})
+    """Get the balance for an account, in cents."""
+    get_cursor().execute('SELECT balance_cents FROM account WHERE id=%(id)s', {'id': account_id})
     row = g.cursor.fetchone()
-    return row['balance']
+    return row['balance_cents']
 
 
-def update_balance(account_id, new_balance):
-    """Set the balance in account 'account_id' to 'new_balance'.
+@writes
+def update_balance(account_id, new_balance_cents):
+    """Set the balance in account 'account_id' to 'new_balance_cents'.
 
+    The difference goes in the ledger as money from outside the bank.
     Note that this function does not commit to the database
     so that we can illustrate commit and rollback behavior
     in the transfer_funds function.
     """
-    g.cursor.execute('UPDATE account SET balance = %(balance)s WHERE id=%(id)s',
-                     {'id': account_id, 'balance': new_balance})
-    if g.cursor.rowcount != 1:
+    get_cursor().execute('SELECT balance_cents FROM account WHERE id=%(id)s FOR UPDATE', {'id': account_id})
+    row = g.cursor.fetchone()
+    if row is None:
         raise RuntimeError("Failed to update account {}".format(account_id))
+    change = new_balance_cents - row['balance_cents']
+    g.cursor.execute('UPDATE account SET balance_cents = %(balance)s WHERE id=%(id)s;\n'
+                     'INSERT INTO ledger (from_account, to_account, amount_cents) VALUES (NULL, %(id)s, %(change)s)',
+                     {'id': account_id, 'balance': new_balance_cents, 'change': change})
+    add_to_summary(total_balance=dollars(change))
+    account_directory.invalidate()
+
+
+class TransferError(RuntimeError):
+    """Raised when a transfer can't be made (unknown account or insufficient funds)."""
+
 
+def _check_amount(amount_cents, what='Amount'):
+    """Raise TransferError unless the amount is a positive whole number of cents."""
+    if isinstance(amount_cents, bool) or not isinstance(amount_cents, int):
+        raise TransferError('{} must be a whole number of cents, not {!r}'.format(what, amount_cents))
+    if amount_cents <= 0:
+        raise TransferError('{} must be positive'.format(what))
 
-def transfer_funds(from_account_id, to_account_id, transfer_amount, cause_rollback):
-    """Transfer funds."""
 
-    # Get the balance of the source account.
-    from_balance = read_balance(from_account_id)
+def _check_accounts(from_account_id, to_account_id, what='Transfer'):
+    """Raise ValueError if money would move from an account to itself."""
+    if from_account_id == to_account_id:
+        raise ValueError('{}: source and destination are the same account ({})'.format(what, from_account_id))
 
-    # Ensure sufficient funds; we've already checked this in the controller,
-    # but it doesn't hurt to make sure a transfer is valid.
-    if from_balance < transfer_amount:
-        raise RuntimeError('Insufficient funds')
 
-    # Get the balance of the destination account.
-    to_balance = read_balance(to_account_id)
+def _transfer_failure(from_account_id, to_account_id, amount_cents):
+    """Work out why a transfer failed. Only runs on the (rare) failure path."""
+    for account_id in (from_account_id, to_account_id):
+        if find_account(account_id) is None:
+            return "Account {} doesn't exist".format(account_id)
+    return 'Insufficient funds: balance in account {} is {:.2f}, amount is {:.2f}'.format(
+        from_account_id, dollars(read_balance(from_account_id)), dollars(amount_cents))
+
+
+@writes
+def transfer_funds(from_account_id, to_account_id, amount_cents, cause_rollback):
+    """Transfer `amount_cents` cents.
+
+    The balance check, the debit, the credit, and the ledger entry all
+    happen in a single round trip. Both rows are locked in id order first,
+    so two transfers between the same accounts in opposite directions can't
+    deadlock. The conditional UPDATE changes nothing unless both accounts
+    exist and the source account has enough money (in which case we roll
+    back the transfer count in the summary table too).
+    Raises ValueError if both accounts are the same.
+    """
+    _check_amount(amount_cents)
+    _check_accounts(from_account_id, to_account_id)
+    query = '''
+SELECT id FROM account WHERE id IN (%(from)s, %(to)s) ORDER BY id FOR UPDATE;
+UPDATE summary SET transfer_count = transfer_count + 1,
+                   transferred_total = transferred_total + %(amount)s / 100.0
+WHERE slot = %(slot)s;
+WITH moved AS (
+  UPDATE account
+  SET balance_cents = balance_cents + CASE WHEN id = %(to)s THEN %(amount)s ELSE -%(amount)s END
+  WHERE id IN (%(from)s, %(to)s)
+    AND (SELECT count(*) FROM account WHERE id IN (%(from)s, %(to)s)) = 2
+    AND (SELECT balance_cents FROM account WHERE id = %(from)s) >= %(amount)s
+  RETURNING id, name, balance_cents
+), logged AS (
+  INSERT INTO ledger (from_account, to_account, amount_cents)
+  SELECT %(from)s, %(to)s, %(amount)s WHERE (SELECT count(*) FROM moved) = 2
+)
+SELECT * FROM moved'''
+    get_cursor().execute(query, {'from': from_account_id, 'to': to_account_id, 'amount': amount_cents,
+                                 'slot': summary_slot()})
+    balances = {row['id']: row['balance_cents'] for row in g.cursor.fetchall()}
 
-    # Transfer funds!
-    update_balance(from_account_id, from_balance - transfer_amount)
-    update_balance(to_account_id, to_balance + transfer_amount)
+    if len(balances) != 2:
+        # Nothing was updated; release the locks and explain why.
+        g.connection.rollback()
+        message = _transfer_failure(from_account_id, to_account_id, amount_cents)
+        g.connection.rollback()
+        raise TransferError(message)
 
     # Either roll back or commit the current transaction.
     if cause_rollback:
         # Roll back. To demonstrate that database updates are reversed
-        # during a rollback, create a message containing the current
-        # account balances.
-        pending_from_balance = read_balance(from_account_id)
-        pending_to_balance = read_balance(to_account_id)
-        message = "Rolled back transaction: from was {:.2f}, to was {:.2f}".format(pending_from_balance,
-                                                                                   pending_to_balance)
+        # during a rollback, create a message containing the pending
+        # account balances returned by the update.
+        message = "Rolled back transaction: from was {:.2f}, to was {:.2f}".format(
+            dollars(balances[from_account_id]), dollars(balances[to_account_id]))
         # Roll back the transaction and return the message
         g.connection.rollback()
         return message
@@ -175,4 +1305,283 @@ def transfer_funds(from_account_id, to_account_id, transfer_amount, cause_rollba
         # Commit the transaction. The member can see that the database updates are
         # persistent by viewing the current account balances.
         g.connection.commit()
+        account_directory.invalidate()
         return "Committed transaction"
+
+
+@writes
+def transfer_many(transfers):
+    """Apply a batch of transfers in one transaction.
+
+    `transfers` is a list of (from_account_id, to_account_id, amount_cents)
+    tuples, applied in order. Every account involved is locked in id order up
+    front (so concurrent batches can't deadlock), each transfer is checked
+    against the running balances, and all the new balances and ledger entries
+    are written with one UPDATE and one INSERT.
+    If any transfer fails, none are applied and TransferError is raised
+    (or ValueError, for a transfer from an account to itself).
+
+    Returns a dictionary mapping account id to its new balance in cents.
+    """
+    transfers = list(transfers)
+    account_ids = sorted({account_id for transfer in transfers for account_id in transfer[:2]})
+    if not account_ids:
+        return {}
+
+    get_cursor().execute('SELECT id, balance_cents FROM account WHERE id IN %(ids)s ORDER BY id FOR UPDATE',
+                         {'ids': tuple(account_ids)})
+    balances = {row['id']: row['balance_cents'] for row in g.cursor.fetchall()}
+
+    try:
+        for index, (from_account_id, to_account_id, amount_cents) in enumerate(transfers):
+            _check_amount(amount_cents, 'Transfer {}: amount'.format(index))
+            _check_accounts(from_account_id, to_account_id, 'Transfer {}'.format(index))
+            for account_id in (from_account_id, to_account_id):
+                if account_id not in balances:
+                    raise TransferError("Transfer {}: account {} doesn't exist".format(index, account_id))
+            if balances[from_account_id] < amount_cents:
+                raise TransferError('Transfer {}: insufficient funds in account {}'.format(index, from_account_id))
+            balances[from_account_id] -= amount_cents
+            balances[to_account_id] += amount_cents
+    except (TransferError, ValueError):
+        g.connection.rollback()
+        raise
+
+    psycopg2.extras.execute_values(g.cursor,
+                                   'UPDATE account SET balance_cents = v.balance_cents '
+                                   'FROM (VALUES %s) AS v (id, balance_cents) WHERE account.id = v.id',
+                                   sorted(balances.items()))
+    psycopg2.extras.execute_values(g.cursor,
+                                   'INSERT INTO ledger (from_account, to_account, amount_cents) VALUES %s',
+                                   transfers)
+    add_to_summary(transfer_count=len(transfers), transferred_total=dollars(sum(t[2] for t in transfers)))
+    g.connection.commit()
+    account_directory.invalidate()
+    return balances
+
+
+# Account Directory ########################################
+
+
+class AccountDirectory(object):
+    """Every account, loaded once and shared by all requests until the accounts change.
+
+    `version` goes up each time the directory is invalidated (after a
+    transfer commits or a balance is changed, or when it is older than
+    `ttl` seconds, which picks up other processes' transfers). Anything derived from the accounts,
+    such as the choices for a select field, is built once per version.
+    """
+
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        self.version = 0
+        self.loads = 0
+        self.builds = 0
+        self._snapshot = None  # (version, time loaded, accounts, accounts by id, sorted (name, id) search keys)
+        self._built = {}  # name -> value built from the current version
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._snapshot = None
+            self._built.clear()
+
+    def _current(self):
+        """Return the current snapshot, loading the accounts if needed."""
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and time.monotonic() - snapshot[1] < self.ttl:
+                return snapshot
+            if snapshot is not None:
+                self.version += 1
+                self._snapshot = None
+                self._built.clear()
+            version = self.version
+
+        # Read from the primary, so a lagging replica can't put old balances back in the directory.
+        get_cursor().execute('SELECT * FROM account ORDER BY name')
+        accounts = [dict(row) for row in g.cursor.fetchall()]
+        keys = sorted((account['name'].lower(), account['id']) for account in accounts)
+        snapshot = (version, time.monotonic(), accounts, {account['id']: account for account in accounts}, keys)
+        with self._lock:
+            # Don't keep it if a transfer committed while we were reading.
+            if self.version == version:
+                self._snapshot = snapshot
+                self.loads += 1
+        return snapshot
+
+    def accounts(self):
+        """Return every account, ordered by name."""
+        return self._current()[2]
+
+    def find(self, account_id):
+        """Return the account with this id, or None."""
+        return self._current()[3].get(account_id)
+
+    def build(self, name, function):
+        """Return `function(accounts)`, calling it only once per version of the directory."""
+        version, _, accounts, _, _ = self._current()
+        with self._lock:
+            if version == self.version and name in self._built:
+                return self._built[name]
+        value = function(accounts)
+        with self._lock:
+            if version == self.version:
+                self._built[name] = value
+                self.builds += 1
+        return value
+
+    def search(self, text, limit=20):
+        """Return up to `limit` accounts matching `text`, for search-as-you-type.
+
+        An account id matches exactly; names match case-insensitively,
+        names starting with `text` first and then names containing it.
+        """
+        _, _, accounts, by_id, keys = self._current()
+        text = text.strip().lower()
+        matches = []
+        if text.isdigit() and int(text) in by_id:
+            matches.append(int(text))
+        # Names starting with the text sit together in the sorted keys.
+        for name, account_id in itertools.islice(keys, bisect.bisect_left(keys, (text,)), None):
+            if len(matches) >= limit or not name.startswith(text):
+                break
+            if account_id not in matches:
+                matches.append(account_id)
+        for account in accounts:
+            if len(matches) >= limit:
+                break
+            if text in account['name'].lower() and account['id'] not in matches:
+                matches.append(account['id'])
+        return [by_id[account_id] for account_id in matches]
+
+    def stats(self):
+        with self._lock:
+            return {'version': self.version, 'size': len(self._snapshot[2]) if self._snapshot else 0,
+                    'loads': self.loads, 'builds': self.builds}
+
+
+account_directory = AccountDirectory(account_directory_ttl)
+
+
+def account_directory_stats():
+    """Return the version and load counters of the account directory."""
+    return account_directory.stats()
+
+
+# Summaries ########################################
+
+# Rows in the summary table (see sql/migrations/002-summaries.sql).
+summary_slots = 16
+summary_columns = ('account_count', 'total_balance', 'transfer_count', 'transferred_total',
+                   'member_count', 'comment_count')
+
+# Recompute the summaries from scratch. The transfer totals come from the
+# ledger (entries with no from_account are deposits, not transfers).
+rebuild_summaries_query = '''
+UPDATE summary
+SET account_count = 0, total_balance = 0, transfer_count = 0, transferred_total = 0,
+    member_count = 0, comment_count = 0;
+
+UPDATE summary
+SET account_count = (SELECT count(*) FROM account),
+    total_balance = (SELECT coalesce(sum(balance_cents), 0) / 100.0 FROM account),
+    (transfer_count, transferred_total) = (SELECT count(*), coalesce(sum(amount_cents), 0) / 100.0
+                                           FROM ledger WHERE from_account IS NOT NULL),
+    member_count  = (SELECT count(*) FROM member),
+    comment_count = (SELECT count(*) FROM comment)
+WHERE slot = 0;
+
+TRUNCATE member_comment_count;
+INSERT INTO member_comment_count (member, comment_count)
+SELECT member, count(*) FROM comment GROUP BY member;'''
+
+
+def summary_slot():
+    """Pick the summary row for this transaction to update."""
+    return random.randrange(summary_slots)
+
+
+@writes
+def add_to_summary(**amounts):
+    """Add to the running totals in the summary table, as part of the current transaction.
+
+    For example, `add_to_summary(member_count=1)`. The caller commits.
+    """
+    amounts = {column: amount for column, amount in amounts.items() if amount}
+    if not amounts:
+        return
+    assignments = ', '.join('{0} = {0} + %({0})s'.format(column) for column in amounts)
+    get_cursor().execute('UPDATE summary SET {} WHERE slot = %(slot)s'.format(assignments),
+                         dict(amounts, slot=summary_slot()))
+
+
+@reads
+def summary_totals():
+    """Return the overall totals (account count, total balance, comment count, and so on)."""
+    query = 'SELECT {} FROM summary'.format(', '.join('sum({0}) AS {0}'.format(c) for c in summary_columns))
+    get_cursor().execute(query)
+    return dict(g.cursor.fetchone())
+
+
+@reads
+def top_commenters(limit=10):
+    """Return the members with the most comments, most first, as (member, comment count) pairs."""
+    query = '''
+SELECT member, comment_count FROM member_comment_count
+ORDER BY comment_count DESC, member
+LIMIT %(limit)s'''
+    get_cursor().execute(query, {'limit': limit})
+    counts = g.cursor.fetchall()
+    members = load_members([row['member'] for row in counts])
+    return [(members[row['member']], row['comment_count']) for row in counts]
+
+
+@writes
+def rebuild_summaries():
+    """Recompute the summary tables from the data they summarize.
+
+    Writes to the summarized tables wait until the rebuild commits.
+    """
+    get_cursor().execute('LOCK TABLE account, ledger, member, comment IN SHARE MODE')
+    g.cursor.execute(rebuild_summaries_query)
+    g.connection.commit()
+    g.pop('loader', None)
+
+
+@reads
+def verify_summaries():
+    """Compare the summary tables with a full recount and return a list of differences.
+
+    An empty list means the summaries are correct. Each comparison is a single
+    statement, so it sees one snapshot and concurrent writes can't cause false alarms.
+    """
+    recounts = {
+        'account_count': 'SELECT count(*) FROM account',
+        'total_balance': 'SELECT coalesce(sum(balance_cents), 0) / 100.0 FROM account',
+        'transfer_count': 'SELECT count(*) FROM ledger WHERE from_account IS NOT NULL',
+        'transferred_total': 'SELECT coalesce(sum(amount_cents), 0) / 100.0 FROM ledger WHERE from_account IS NOT NULL',
+        'member_count': 'SELECT count(*) FROM member',
+        'comment_count': 'SELECT count(*) FROM comment',
+    }
+    query = 'SELECT ' + ', '.join('(SELECT sum({0}) FROM summary) AS {0}, ({1}) AS actual_{0}'.format(column, recount)
+                                  for column, recount in recounts.items())
+    get_cursor().execute(query)
+    row = g.cursor.fetchone()
+
+    problems = []
+    for column in recounts:
+        if row[column] != row['actual_' + column]:
+            problems.append('{} is {} but should be {}'.format(column, row[column], row['actual_' + column]))
+
+    g.cursor.execute('''
+SELECT coalesce(s.member, c.member) AS member, s.comment_count AS summary, c.comment_count AS actual
+FROM member_comment_count AS s
+  FULL OUTER JOIN (SELECT member, count(*) AS comment_count FROM comment GROUP BY member) AS c
+    ON s.member = c.member
+WHERE s.comment_count IS DISTINCT FROM c.comment_count''')
+    for row in g.cursor.fetchall():
+        problems.append('Comment count for {} is {} but should be {}'.format(row['member'], row['summary'] or 0,
+                                                                            row['actual'] or 0))
+    return problems
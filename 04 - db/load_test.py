@@ -0,0 +1,135 @@
+# Compare requests per second and latency of application.py (Flask, sync)
+# and async_application.py (Quart, async) under many concurrent clients.
+#
+# Both apps are served by Hypercorn, one process each, against the database
+# at --dsn (fill it with seed.py first). Hypercorn runs the sync app on a small
+# pool of worker threads, so it behaves like a threaded WSGI server: once every
+# thread is waiting on PostgreSQL, new requests queue up. The clients are
+# simple keep-alive HTTP/1.1 connections that request --paths in turn for
+# --duration seconds.
+#
+#   python load_test.py --dsn "dbname=isd_bench" --clients 100 300 1000
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import seed
+
+apps = [('sync', 'application:app', 8301), ('async', 'async_application:app', 8302)]
+
+# {member} is replaced with a random generated member's e-mail.
+default_paths = ['/comments/{member}', '/details/{member}', '/dashboard', '/members']
+
+
+def start_server(module, port, dsn):
+    """Start Hypercorn serving `module` and wait until it accepts connections."""
+    env = dict(os.environ, DATABASE_URL=dsn)
+    server = subprocess.Popen([sys.executable, '-m', 'hypercorn', '--bind', '127.0.0.1:{}'.format(port),
+                               '--backlog', '4096', '--log-level', 'warning', module],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                              # Under this much load every query is "slow"; don't flood the terminal.
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('{} did not start'.format(module))
+
+
+async def get(reader, writer, path):
+    """Send one GET on a keep-alive connection and read the whole response. Returns the status code."""
+    writer.write('GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(path).encode())
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return int(lines[0].split()[1])
+
+
+async def client(port, paths, members, deadline, latencies, errors):
+    reader = writer = None
+    while time.monotonic() < deadline:
+        path = random.choice(paths).format(member=seed.member_email(random.randint(1, members)))
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            status = await get(reader, writer, path)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            errors.append(path)
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            continue
+        if status >= 400:
+            errors.append(path)
+        latencies.append(time.perf_counter() - start)
+    if writer is not None:
+        writer.close()
+
+
+async def load(port, clients, duration, paths, members):
+    """Run `clients` concurrent clients for `duration` seconds. Returns statistics (times in ms)."""
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    started = time.monotonic()
+    await asyncio.gather(*(client(port, paths, members, deadline, latencies, errors) for _ in range(clients)))
+    elapsed = time.monotonic() - started
+    latencies.sort()
+
+    def percentile(fraction):
+        return 1000 * latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] if latencies else None
+
+    return {'clients': clients, 'requests': len(latencies), 'errors': len(errors),
+            'rps': len(latencies) / elapsed, 'p50_ms': percentile(0.50), 'p99_ms': percentile(0.99)}
+
+
+def run(dsn, client_counts, duration, paths, members):
+    """Load-test each app at each number of clients. Returns {app name: [stats, ...]}."""
+    results = {}
+    for name, module, port in apps:
+        server = start_server(module, port, dsn)
+        try:
+            asyncio.run(load(port, 10, 2, paths, members))  # Warm up the pools and caches.
+            results[name] = []
+            for clients in client_counts:
+                stats = asyncio.run(load(port, clients, duration, paths, members))
+                results[name].append(stats)
+                print('{:6} {:5} clients  {:8.1f} req/s  p50 {:8.1f} ms  p99 {:8.1f} ms  {} errors'.format(
+                    name, clients, stats['rps'], stats['p50_ms'] or 0, stats['p99_ms'] or 0, stats['errors']))
+        finally:
+            server.terminate()
+            server.wait()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the sync and async apps under concurrent load')
+    parser.add_argument('--dsn', required=True, help='Database both apps use (fill it with seed.py first)')
+    parser.add_argument('--clients', type=int, nargs='+', default=[100, 300, 1000],
+                        help='Numbers of concurrent clients to test with')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to run each test')
+    parser.add_argument('--paths', nargs='+', default=default_paths, help='Paths to request, in random order')
+    parser.add_argument('--members', type=int, default=1000, help='Members in the database (for {member} paths)')
+    parser.add_argument('--save', help='Write results to this JSON file')
+    args = parser.parse_args()
+
+    results = run(args.dsn, args.clients, args.duration, args.paths, args.members)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
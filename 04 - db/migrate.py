@@ -0,0 +1,73 @@
+# Apply the schema changes in sql/migrations to a database.
+#
+# Each migration is a SQL file whose name starts with its version number
+# (e.g., 001-indexes.sql). Migrations run in order, each in its own transaction,
+# and the schema_migrations table records which ones have been applied,
+# so running this script again only applies new ones.
+#
+#   python migrate.py --dsn "dbname=isd user=tom host=localhost"
+
+import argparse
+import os
+
+import psycopg2
+
+import db
+
+migrations_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql', 'migrations')
+
+
+def all_migrations():
+    """Return (version, path) for every migration file, in order."""
+    migrations = []
+    for file_name in sorted(os.listdir(migrations_folder)):
+        if file_name.endswith('.sql'):
+            migrations.append((file_name[:-len('.sql')], os.path.join(migrations_folder, file_name)))
+    return migrations
+
+
+def applied_migrations(connection):
+    """Return the set of versions already applied to the database."""
+    with connection.cursor() as cursor:
+        cursor.execute('''
+CREATE TABLE IF NOT EXISTS schema_migrations
+(
+  version    VARCHAR(255) NOT NULL PRIMARY KEY,
+  applied_at TIMESTAMP    NOT NULL DEFAULT now()
+)''')
+        cursor.execute('SELECT version FROM schema_migrations')
+        versions = {row[0] for row in cursor.fetchall()}
+    connection.commit()
+    return versions
+
+
+def migrate(connection):
+    """Apply every migration that hasn't been applied yet. Returns the versions applied."""
+    applied = applied_migrations(connection)
+    newly_applied = []
+    for version, path in all_migrations():
+        if version in applied:
+            continue
+        with open(path) as f:
+            sql = f.read()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql)
+                cursor.execute('INSERT INTO schema_migrations (version) VALUES (%s)', [version])
+            connection.commit()
+        except psycopg2.Error:
+            connection.rollback()
+            raise
+        newly_applied.append(version)
+    return newly_applied
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply pending schema migrations')
+    parser.add_argument('--dsn', default=db.data_source_name, help='Database to migrate')
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(args.dsn)
+    versions = migrate(connection)
+    connection.close()
+    print('Applied {}'.format(', '.join(versions)) if versions else 'Already up to date')
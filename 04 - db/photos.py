@@ -0,0 +1,141 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import PurePath
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it we just serve the original photo.
+    Image = None
+
+# Photo Storage ########################################
+
+photo_folder = 'photos'  # Where photos live, relative to the application's static folder
+thumbnail_sizes = (128, 512)  # Longest side, in pixels, of each resized copy
+thumbnail_workers = 2  # Processes used to make thumbnails
+copy_chunk_size = 64 * 1024  # Bytes read at a time while saving an upload
+
+
+def save_upload(uploaded_photo, static_folder):
+    """Save an uploaded file under a name derived from its content.
+
+    The upload is copied to a temporary file a chunk at a time (so large
+    files never sit in memory) while we compute its SHA-256 hash. The file
+    is then renamed to `<hash><extension>`; if a file with that name already
+    exists, we already have this photo and the copy is thrown away.
+
+    Returns the path of the photo relative to `static_folder`.
+    """
+    folder = os.path.join(static_folder, photo_folder)
+    os.makedirs(folder, exist_ok=True)
+
+    # N.B.: We still trust the extension of the user-supplied file name.
+    # Better to inspect the file content.
+    extension = PurePath(uploaded_photo.filename or '').suffix.lower()
+
+    digest = hashlib.sha256()
+    temp_file = tempfile.NamedTemporaryFile(dir=folder, delete=False)
+    try:
+        with temp_file:
+            while True:
+                chunk = uploaded_photo.stream.read(copy_chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                temp_file.write(chunk)
+
+        file_name = digest.hexdigest() + extension
+        save_path = os.path.join(folder, file_name)
+        if not os.path.exists(save_path):
+            os.replace(temp_file.name, save_path)
+    finally:
+        # Left over if we already had the photo, or if the upload failed part way.
+        _remove_if_present(temp_file.name)
+    return os.path.join(photo_folder, file_name)
+
+
+def _remove_if_present(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def variant_path(file_path, size):
+    """Return the path of the resized copy of `file_path` with longest side `size`."""
+    path = PurePath(file_path)
+    return str(path.with_name('{}-{}{}'.format(path.stem, size, path.suffix)))
+
+
+def best_variant(static_folder, file_path, size):
+    """Return the resized copy of a photo if it has been made, otherwise the original."""
+    resized = variant_path(file_path, size)
+    if os.path.exists(os.path.join(static_folder, resized)):
+        return resized
+    return file_path
+
+
+# Names given by save_upload: a SHA-256 hash, maybe followed by a thumbnail size.
+_hashed_name = re.compile(r'^[0-9a-f]{64}(-[0-9]+)?$')
+
+
+def is_fingerprinted(file_path):
+    """Return True if the file's name already identifies its content."""
+    return _hashed_name.match(PurePath(file_path).stem) is not None
+
+
+def fingerprint(static_folder, file_path):
+    """Return a string that changes whenever the content of a photo changes.
+
+    For photos saved by `save_upload` this is the content hash in the name.
+    Older photos don't have one, so we use the file's modification time and size.
+    """
+    if is_fingerprinted(file_path):
+        return PurePath(file_path).stem
+    stat = os.stat(os.path.join(static_folder, file_path))
+    return '{:x}-{:x}'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def make_thumbnails(static_folder, file_path, sizes):
+    """Write a resized copy of a photo for each size. Runs in a worker process."""
+    source = os.path.join(static_folder, file_path)
+    made = []
+    with Image.open(source) as original:
+        for size in sizes:
+            target = os.path.join(static_folder, variant_path(file_path, size))
+            if os.path.exists(target):
+                continue
+            resized = original.copy()
+            resized.thumbnail((size, size))
+            # Write to a temporary file first so no one sees a half-written file. Its name
+            # is unique, so two uploads of the same photo at once can't write over each other.
+            temp_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(target), delete=False)
+            try:
+                with temp_file:
+                    resized.save(temp_file, format=original.format)
+                os.replace(temp_file.name, target)
+            finally:
+                _remove_if_present(temp_file.name)
+            made.append(target)
+    return made
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def schedule_thumbnails(static_folder, file_path):
+    """Make thumbnails for a photo in a background process.
+
+    Returns a Future, or None if Pillow isn't installed.
+    """
+    global _executor
+    if Image is None:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=thumbnail_workers)
+    return _executor.submit(make_thumbnails, static_folder, file_path, thumbnail_sizes)
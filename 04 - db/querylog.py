@@ -0,0 +1,125 @@
+import logging
+import re
+import threading
+import time
+from collections import deque
+
+from flask import g
+import psycopg2.extras
+
+# Query Instrumentation ########################################
+
+slow_query_threshold = 0.1  # Log statements that take longer than this (seconds); None to turn off
+samples_per_query = 1000  # Recent timings kept for each statement when computing percentiles
+
+slow_query_log = logging.getLogger('db.slow_queries')
+
+# Literal values and runs of repeated VALUES tuples, so that statements
+# that differ only in their data are counted together.
+_string_literal = re.compile(r"'(?:[^']|'')*'")
+_number_literal = re.compile(r'\b\d+(?:\.\d+)?\b')
+_repeated_tuples = re.compile(r'(\([?, ]*\))(?:\s*,\s*\([?, ]*\))+')
+_whitespace = re.compile(r'\s+')
+
+
+def normalize(query):
+    """Return the statement with literal values replaced by '?' and whitespace collapsed."""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = _string_literal.sub('?', query)
+    query = _number_literal.sub('?', query)
+    query = _whitespace.sub(' ', query).strip()
+    return _repeated_tuples.sub(r'\1, ...', query)
+
+
+class QueryStats(object):
+    """Thread-safe running totals and recent timings for each normalized statement."""
+
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self._queries = {}  # normalized statement -> [count, total time, deque of recent times]
+        self._lock = threading.Lock()
+
+    def record(self, statement, duration):
+        with self._lock:
+            entry = self._queries.get(statement)
+            if entry is None:
+                entry = self._queries[statement] = [0, 0.0, deque(maxlen=self.samples)]
+            entry[0] += 1
+            entry[1] += duration
+            entry[2].append(duration)
+
+    def reset(self):
+        with self._lock:
+            self._queries.clear()
+
+    def report(self):
+        """Return one dictionary per statement, slowest total time first.
+
+        Times are in milliseconds; percentiles cover the most recent samples.
+        """
+        with self._lock:
+            snapshot = [(statement, count, total, sorted(recent))
+                        for statement, (count, total, recent) in self._queries.items()]
+
+        def percentile(times, fraction):
+            return 1000 * times[min(len(times) - 1, int(fraction * len(times)))]
+
+        report = [{'query': statement,
+                   'count': count,
+                   'total_ms': 1000 * total,
+                   'mean_ms': 1000 * total / count,
+                   'p50_ms': percentile(times, 0.50),
+                   'p95_ms': percentile(times, 0.95),
+                   'p99_ms': percentile(times, 0.99),
+                   'max_ms': 1000 * times[-1]}
+                  for statement, count, total, times in snapshot]
+        report.sort(key=lambda row: row['total_ms'], reverse=True)
+        return report
+
+
+query_stats = QueryStats(samples_per_query)
+
+
+def record_query(query, duration):
+    """Add one statement's timing to this request's totals and the process-wide stats."""
+    statement = normalize(query)
+    query_stats.record(statement, duration)
+
+    if g:
+        g.query_count = g.get('query_count', 0) + 1
+        g.query_time = g.get('query_time', 0.0) + duration
+        g.setdefault('query_timings', []).append((statement, duration))
+
+    if slow_query_threshold is not None and duration > slow_query_threshold:
+        slow_query_log.warning('Slow query (%.1f ms): %s', 1000 * duration, statement)
+
+
+class InstrumentedCursor(psycopg2.extras.DictCursor):
+    """A DictCursor that times every statement it runs."""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super(InstrumentedCursor, self).execute(query, vars)
+        finally:
+            record_query(query, time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super(InstrumentedCursor, self).copy_expert(sql, file, size)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+
+def request_summary():
+    """Return the query count, total time (seconds), and per-statement timings for this request."""
+    return {'count': g.get('query_count', 0),
+            'time': g.get('query_time', 0.0),
+            'timings': g.get('query_timings', [])}
+
+
+def server_timing():
+    """Return a Server-Timing header value describing this request's database use."""
+    return 'db;dur={:.1f};desc="{} queries"'.format(1000 * g.get('query_time', 0.0), g.get('query_count', 0))
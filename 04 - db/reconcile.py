@@ -0,0 +1,159 @@
+# Check every account balance against the ledger.
+#
+# Each account's balance should be exactly the money the ledger says went in
+# (opening balances, adjustments, transfers in) minus the money that went out
+# (transfers out), and money moved between accounts should neither appear nor
+# disappear. Balances are whole cents, so "exactly" really means exactly.
+#
+# Rather than walk the ledger row by row in Python, this copies both tables
+# out of one snapshot in PostgreSQL's binary COPY format, which NumPy reads
+# straight into arrays, and then checks every account at once. Millions of
+# ledger entries take seconds.
+#
+#   python reconcile.py --dsn "dbname=isd_bench" --strict
+
+import argparse
+import io
+import sys
+import time
+
+import numpy as np
+import psycopg2
+
+import db
+
+# Every column is a BIGINT and none is NULL, so each row of binary COPY output
+# is the same size: a field count, then a length and a value for each field.
+_copy_signature = b'PGCOPY\n\xff\r\n\x00'
+_copy_trailer = b'\xff\xff'
+
+
+def copy_int64_columns(cursor, query, columns):
+    """Run `query` (selecting only non-NULL BIGINT columns) and return {column: numpy int64 array}."""
+    buffer = io.BytesIO()
+    cursor.copy_expert('COPY ({}) TO STDOUT WITH (FORMAT binary)'.format(query), buffer)
+    data = buffer.getbuffer()
+    if bytes(data[:len(_copy_signature)]) != _copy_signature or bytes(data[-2:]) != _copy_trailer:
+        raise RuntimeError('Unexpected COPY output for {}'.format(query))
+    # The header is the signature, 32 bits of flags, and an extension area with its length in front.
+    extension_length = int.from_bytes(data[len(_copy_signature) + 4:len(_copy_signature) + 8], 'big')
+    header_size = len(_copy_signature) + 8 + extension_length
+
+    fields = [('field_count', '>i2')]
+    for column in columns:
+        fields += [(column + '_length', '>i4'), (column, '>i8')]
+    rows = np.frombuffer(data[header_size:-2], dtype=np.dtype(fields))
+    if len(rows) and (np.any(rows['field_count'] != len(columns))
+                      or any(np.any(rows[column + '_length'] != 8) for column in columns)):
+        raise RuntimeError('Rows of {} are not all {} BIGINTs'.format(query, len(columns)))
+    return {column: rows[column].astype(np.int64) for column in columns}
+
+
+def load(connection):
+    """Read the balances and the ledger. Both come from the connection's current transaction.
+
+    Returns (accounts, ledger): `accounts` has 'id' and 'balance_cents' arrays
+    sorted by id, and `ledger` has 'from_account' (0 for money from outside
+    the bank), 'to_account' and 'amount_cents' arrays.
+    """
+    with connection.cursor() as cursor:
+        accounts = copy_int64_columns(cursor, 'SELECT id::BIGINT, balance_cents FROM account ORDER BY id',
+                                      ['id', 'balance_cents'])
+        ledger = copy_int64_columns(cursor, 'SELECT coalesce(from_account, 0)::BIGINT, to_account::BIGINT, '
+                                            'amount_cents FROM ledger',
+                                    ['from_account', 'to_account', 'amount_cents'])
+    return accounts, ledger
+
+
+def check(accounts, ledger, show=20):
+    """Compare the balances with the ledger. Returns a report dictionary.
+
+    `problems` in the report is a list of messages (at most `show` about
+    individual accounts); it is empty when everything reconciles.
+    """
+    ids, balances = accounts['id'], accounts['balance_cents']
+    from_ids, to_ids, amounts = ledger['from_account'], ledger['to_account'], ledger['amount_cents']
+    problems = []
+
+    # Find each ledger entry's accounts by binary search in the sorted ids.
+    def positions(account_ids):
+        if not len(ids):
+            return np.zeros(len(account_ids), np.int64), np.zeros(len(account_ids), bool)
+        found = np.minimum(np.searchsorted(ids, account_ids), len(ids) - 1)
+        return found, ids[found] == account_ids
+
+    internal = from_ids != 0
+    to_positions, to_known = positions(to_ids)
+    from_positions, from_known = positions(from_ids)
+    from_known |= ~internal
+
+    unknown = ~(to_known & from_known)
+    if unknown.any():
+        problems.append('{} ledger entries name accounts that don\'t exist'.format(int(unknown.sum())))
+    bad_amounts = internal & (amounts <= 0)
+    if bad_amounts.any():
+        problems.append('{} transfers are not for a positive amount'.format(int(bad_amounts.sum())))
+    self_transfers = internal & (from_ids == to_ids)
+    if self_transfers.any():
+        problems.append('{} transfers are from an account to itself'.format(int(self_transfers.sum())))
+
+    # What each balance should be: everything credited minus everything debited.
+    expected = np.zeros(len(ids), dtype=np.int64)
+    np.add.at(expected, to_positions[to_known], amounts[to_known])
+    debits = internal & from_known
+    np.subtract.at(expected, from_positions[debits], amounts[debits])
+
+    wrong = np.flatnonzero(expected != balances)
+    for position in wrong[:show]:
+        problems.append('Account {} has {} cents but the ledger says {}'.format(
+            ids[position], balances[position], expected[position]))
+    if len(wrong) > show:
+        problems.append('... and {} more accounts'.format(len(wrong) - show))
+
+    # Transfers only move money around, so the total must be what came in from outside.
+    total_balance = int(balances.sum())
+    deposited = int(amounts[~internal].sum())
+    if total_balance != deposited:
+        problems.append('Accounts hold {} cents in total but {} cents were deposited'.format(total_balance,
+                                                                                         deposited))
+
+    return {'accounts': len(ids), 'ledger_entries': len(amounts), 'transfers': int(internal.sum()),
+            'total_balance_cents': total_balance, 'deposited_cents': deposited,
+            'mismatched_accounts': len(wrong), 'problems': problems}
+
+
+def reconcile(dsn, show=20):
+    """Load one consistent snapshot of the database at `dsn` and check it. Returns the report with timings."""
+    connection = psycopg2.connect(dsn)
+    connection.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    try:
+        start = time.perf_counter()
+        accounts, ledger = load(connection)
+        loaded = time.perf_counter()
+        report = check(accounts, ledger, show)
+        checked = time.perf_counter()
+    finally:
+        connection.rollback()
+        connection.close()
+    report['load_seconds'] = loaded - start
+    report['check_seconds'] = checked - loaded
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check account balances against the ledger')
+    parser.add_argument('--dsn', default=db.data_source_name, help='Database to check')
+    parser.add_argument('--show', type=int, default=20, help='Most mismatched accounts to list')
+    parser.add_argument('--strict', action='store_true', help='Exit with status 1 if anything is wrong')
+    args = parser.parse_args()
+
+    report = reconcile(args.dsn, args.show)
+    print('{accounts} accounts, {ledger_entries} ledger entries ({transfers} transfers), '
+          'total {total_balance_cents} cents'.format(**report))
+    print('loaded in {load_seconds:.2f}s, checked in {check_seconds:.2f}s'.format(**report))
+    for problem in report['problems']:
+        print('PROBLEM', problem)
+    if not report['problems']:
+        print('OK')
+    if args.strict and report['problems']:
+        sys.exit(1)
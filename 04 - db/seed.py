@@ -0,0 +1,103 @@
+# Fill the database with synthetic members, comments, photos, and accounts.
+#
+# The rows are generated inside PostgreSQL with generate_series, so even
+# millions of rows load quickly. Comments are skewed: a few members write
+# most of them, as in real life. WARNING: this drops and re-creates the tables.
+#
+#   python seed.py --members 100000 --comments 1000000 --photos 50000 --accounts 100000
+
+import argparse
+import os
+import time
+
+import psycopg2
+
+import db
+import migrate
+
+# A few common names, with the first ones picked more often than the last ones.
+first_names = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'William', 'Elizabeth',
+               'David', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen']
+last_names = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+              'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin']
+
+
+def member_email(n):
+    """Return the e-mail address of generated member number `n` (starting at 1)."""
+    return 'member{}@example.com'.format(n)
+
+
+def seed(connection, members, comments, photos, accounts, skew=3.0, random_seed=0.5):
+    """Re-create the tables (with all migrations applied) and fill them with generated rows.
+
+    `skew` controls how unevenly comments are spread over members: member
+    number 1 + floor(members * random()^skew) writes each comment, so
+    1.0 is uniform and larger values favor the low-numbered members.
+    Returns a dictionary of how long each table took to load (seconds).
+    """
+    timings = {}
+    params = {'members': members, 'comments': comments, 'photos': min(photos, members), 'accounts': accounts,
+              'skew': skew, 'first_names': first_names, 'last_names': last_names}
+    statements = [
+        ('member', '''
+INSERT INTO member (email, first_name, last_name, password)
+SELECT 'member' || i || '@example.com',
+       (%(first_names)s::text[])[1 + floor(20 * power(random(), 2))::int],
+       (%(last_names)s::text[])[1 + floor(20 * power(random(), 2))::int],
+       'pass' || i
+FROM generate_series(1, %(members)s) AS i'''),
+        ('comment', '''
+INSERT INTO comment (body, member)
+SELECT 'Comment ' || i || ': ' || repeat(md5(random()::text) || ' ', 1 + floor(random() * 8)::int),
+       'member' || (1 + floor(%(members)s * power(random(), %(skew)s)))::int || '@example.com'
+FROM generate_series(1, %(comments)s) AS i'''),
+        ('photo', '''
+INSERT INTO photo (file_path, member_email)
+SELECT 'photos/' || encode(sha256(i::text::bytea), 'hex') || '.jpg', 'member' || i || '@example.com'
+FROM generate_series(1, %(photos)s) AS i'''),
+        ('account', '''
+INSERT INTO account (name, balance_cents)
+SELECT 'Account ' || i, 10000 + floor(random() * 1000000)::bigint
+FROM generate_series(1, %(accounts)s) AS i'''),
+    ]
+
+    with connection.cursor() as cursor:
+        with open(os.path.join(os.path.dirname(__file__), 'sql', 'create-db.sql')) as f:
+            cursor.execute(f.read())
+        connection.commit()
+        migrate.migrate(connection)
+        cursor.execute('SELECT setseed(%s)', [random_seed])
+        for table, statement in statements:
+            start = time.perf_counter()
+            cursor.execute(statement, params)
+            connection.commit()
+            timings[table] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cursor.execute(db.rebuild_summaries_query)
+        connection.commit()
+        timings['summaries'] = time.perf_counter() - start
+
+    # Autocommit so that ANALYZE isn't stuck inside a transaction block.
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+    connection.autocommit = False
+    return timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill the database with synthetic data (drops existing tables!)')
+    parser.add_argument('--dsn', default=db.data_source_name, help='Database to fill')
+    parser.add_argument('--members', type=int, default=10000)
+    parser.add_argument('--comments', type=int, default=100000)
+    parser.add_argument('--photos', type=int, default=5000)
+    parser.add_argument('--accounts', type=int, default=10000)
+    parser.add_argument('--skew', type=float, default=3.0, help='1.0 spreads comments evenly; higher is more skewed')
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(args.dsn)
+    for table, seconds in seed(connection, args.members, args.comments, args.photos, args.accounts,
+                               args.skew).items():
+        print('{:8} {:8.2f}s'.format(table, seconds))
+    connection.close()
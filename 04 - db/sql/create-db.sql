@@ -1,3 +1,5 @@
+-- This is version 0 of the schema. Run migrate.py afterward to bring it up to date.
+DROP TABLE IF EXISTS schema_migrations;
 DROP TABLE IF EXISTS comment;
 DROP TABLE IF EXISTS photo;
 DROP TABLE IF EXISTS member;
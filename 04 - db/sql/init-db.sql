@@ -21,8 +21,28 @@ VALUES (3, 'Phil''s profound comment.', 'phcollins@taylor.edu');
 INSERT INTO comment (id, body, member)
 VALUES (4, 'Bible Gateway is a helpful partner.', 'phcollins@taylor.edu');
 
--- Insert data in to account table
-INSERT INTO account (id, name, balance) VALUES (1, 'Fred''s Savings Account', 4000);
-INSERT INTO account (id, name, balance) VALUES (2, 'Fred''s Checking Account', 600);
-INSERT INTO account (id, name, balance) VALUES (3, 'Zelda''s Savings Account', 7565);
-INSERT INTO account (id, name, balance) VALUES (4, 'Zelda''s Checking Account', 1435);
+-- Insert data in to account table (balances are in cents)
+INSERT INTO account (id, name, balance_cents) VALUES (1, 'Fred''s Savings Account', 400000);
+INSERT INTO account (id, name, balance_cents) VALUES (2, 'Fred''s Checking Account', 60000);
+INSERT INTO account (id, name, balance_cents) VALUES (3, 'Zelda''s Savings Account', 756500);
+INSERT INTO account (id, name, balance_cents) VALUES (4, 'Zelda''s Checking Account', 143500);
+
+-- The inserts above don't go through db.py, so bring the summary tables
+-- (see sql/migrations/002-summaries.sql) up to date with a full recount.
+-- This is the same as `flask rebuild-summaries` (db.rebuild_summaries_query).
+UPDATE summary
+SET account_count = 0, total_balance = 0, transfer_count = 0, transferred_total = 0,
+    member_count = 0, comment_count = 0;
+
+UPDATE summary
+SET account_count = (SELECT count(*) FROM account),
+    total_balance = (SELECT coalesce(sum(balance_cents), 0) / 100.0 FROM account),
+    (transfer_count, transferred_total) = (SELECT count(*), coalesce(sum(amount_cents), 0) / 100.0
+                                           FROM ledger WHERE from_account IS NOT NULL),
+    member_count  = (SELECT count(*) FROM member),
+    comment_count = (SELECT count(*) FROM comment)
+WHERE slot = 0;
+
+TRUNCATE member_comment_count;
+INSERT INTO member_comment_count (member, comment_count)
+SELECT member, count(*) FROM comment GROUP BY member;
@@ -0,0 +1,19 @@
+-- Primary keys already come with a unique index. These duplicates
+-- make every insert and update maintain a second, identical index.
+DROP INDEX IF EXISTS user_email_uindex;
+DROP INDEX IF EXISTS comment_id_uindex;
+DROP INDEX IF EXISTS account_id_uindex;
+
+-- Comments by member (comments_by_member, and the join in all_comments).
+-- Including id lets comments for one member come back in id order.
+CREATE INDEX IF NOT EXISTS comment_member_index
+  ON comment (member, id);
+
+-- A member's photos (the join in find_member, newest photo first).
+CREATE INDEX IF NOT EXISTS photo_member_email_index
+  ON photo (member_email, id);
+
+-- Members in name order, for all_comments and comments_page. Including email
+-- means the join to comment can be driven from the index alone.
+CREATE INDEX IF NOT EXISTS member_name_index
+  ON member (last_name, first_name) INCLUDE (email);
@@ -0,0 +1,45 @@
+-- Running totals kept up to date by the functions in db.py, in the same
+-- transaction as the change they summarize, so dashboards never need to
+-- GROUP BY the big tables. `flask verify-summaries` compares them with a
+-- full recount; `flask rebuild-summaries` recomputes them.
+
+-- The totals are split over several rows ("slots"). Each transaction adds
+-- to one slot picked at random, so concurrent writers rarely wait on the
+-- same row; readers add up all the slots.
+DROP TABLE IF EXISTS summary;
+CREATE TABLE summary
+(
+  slot              INTEGER       NOT NULL
+    CONSTRAINT summary_pkey
+    PRIMARY KEY,
+  account_count     BIGINT        NOT NULL DEFAULT 0,
+  total_balance     NUMERIC(16,2) NOT NULL DEFAULT 0,
+  transfer_count    BIGINT        NOT NULL DEFAULT 0,
+  transferred_total NUMERIC(16,2) NOT NULL DEFAULT 0,
+  member_count      BIGINT        NOT NULL DEFAULT 0,
+  comment_count     BIGINT        NOT NULL DEFAULT 0
+);
+INSERT INTO summary (slot) SELECT generate_series(0, 15);
+
+-- Number of comments by each member who has written any.
+DROP TABLE IF EXISTS member_comment_count;
+CREATE TABLE member_comment_count
+(
+  member        VARCHAR(100) NOT NULL
+    CONSTRAINT member_comment_count_pkey
+    PRIMARY KEY,
+  comment_count BIGINT       NOT NULL
+);
+CREATE INDEX member_comment_count_top_index
+  ON member_comment_count (comment_count DESC, member);
+
+-- Start from the data already in the database.
+UPDATE summary
+SET account_count = (SELECT count(*) FROM account),
+    total_balance = (SELECT coalesce(sum(balance::NUMERIC), 0) FROM account),
+    member_count  = (SELECT count(*) FROM member),
+    comment_count = (SELECT count(*) FROM comment)
+WHERE slot = 0;
+
+INSERT INTO member_comment_count (member, comment_count)
+SELECT member, count(*) FROM comment GROUP BY member;
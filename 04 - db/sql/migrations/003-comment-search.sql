@@ -0,0 +1,11 @@
+-- Full-text search over comment bodies (see db.search_comments).
+-- PostgreSQL computes the generated column itself whenever a comment is
+-- inserted or its body changes, so the index never falls out of date.
+-- Adding the column rewrites the comment table, so on a big table run
+-- this migration when the site is quiet.
+ALTER TABLE comment
+  ADD COLUMN IF NOT EXISTS body_search TSVECTOR
+  GENERATED ALWAYS AS (to_tsvector('english', body)) STORED;
+
+CREATE INDEX IF NOT EXISTS comment_body_search_index
+  ON comment USING GIN (body_search);
@@ -0,0 +1,40 @@
+-- Store balances as whole cents. REAL can't hold most amounts exactly
+-- (0.10 is really 0.100000001490116), so balances drifted a little with
+-- every transfer and totals never quite added up.
+ALTER TABLE account
+  ALTER COLUMN balance TYPE BIGINT USING round(balance::NUMERIC * 100);
+ALTER TABLE account
+  RENAME COLUMN balance TO balance_cents;
+
+-- Every movement of money, so balances can be reconciled (see reconcile.py).
+-- Money that comes from outside the bank (opening balances, adjustments made
+-- with db.update_balance) has no from_account.
+DROP TABLE IF EXISTS ledger;
+CREATE TABLE ledger
+(
+  id           BIGSERIAL NOT NULL
+    CONSTRAINT ledger_pkey
+    PRIMARY KEY,
+  from_account INTEGER,
+  to_account   INTEGER   NOT NULL,
+  amount_cents BIGINT    NOT NULL,
+  created_at   TIMESTAMP NOT NULL DEFAULT now()
+);
+
+-- A new account's starting balance is its opening entry in the ledger.
+CREATE OR REPLACE FUNCTION record_opening_balances() RETURNS TRIGGER AS $$
+BEGIN
+  INSERT INTO ledger (from_account, to_account, amount_cents)
+  SELECT NULL, id, balance_cents FROM new_accounts;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER account_opening_balance
+  AFTER INSERT ON account
+  REFERENCING NEW TABLE AS new_accounts
+  FOR EACH STATEMENT EXECUTE FUNCTION record_opening_balances();
+
+-- Accounts that already exist open with their current balance.
+INSERT INTO ledger (from_account, to_account, amount_cents)
+SELECT NULL, id, balance_cents FROM account;
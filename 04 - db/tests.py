@@ -1,11 +1,108 @@
+import asyncio
+import hashlib
 import tempfile
 import unittest
 import os
 
-from flask import g, url_for
+from flask import g, session, url_for
+import psycopg2
+import psycopg2.extensions
 
+import async_db
 import db
+import migrate
+import photos
+import querylog
+import reconcile
 from application import app
+import async_application
+
+
+# Test Database ########################################
+#
+# Each test process gets its own schema, created once in setUpModule, so
+# several processes can run the suite at once (e.g., `python -m pytest -n 4 tests.py`).
+# Database tests run inside a transaction that is rolled back afterward
+# instead of re-creating the tables for every test.
+#
+# Set TEST_DATABASE_URL to point at a throwaway PostgreSQL database. Otherwise,
+# if the `pgserver` package is installed, we start an embedded PostgreSQL server.
+# The tests drop and create schemas, so they never fall back to the
+# application's own database.
+
+
+def database_url_for_tests():
+    """Return the connection string for the database that holds the test schemas."""
+    if 'TEST_DATABASE_URL' in os.environ:
+        return os.environ['TEST_DATABASE_URL']
+    try:
+        import pgserver
+    except ImportError:
+        raise RuntimeError('Set TEST_DATABASE_URL to a throwaway PostgreSQL database, '
+                           'or install pgserver to run the tests against an embedded server')
+    server = pgserver.get_server(os.path.join(tempfile.gettempdir(), 'isd-test-pgdata'), cleanup_mode=None)
+    return server.get_uri()
+
+
+class RollbackConnection(psycopg2.extensions.connection):
+    """A connection whose commit and rollback only go as far as a savepoint.
+
+    Model functions can commit and roll back as usual, while the test
+    itself runs in one transaction that `end_test` throws away.
+    """
+
+    def begin_test(self):
+        super(RollbackConnection, self).rollback()
+        with self.cursor() as cursor:
+            cursor.execute('SAVEPOINT test_case')
+
+    def end_test(self):
+        super(RollbackConnection, self).rollback()
+
+    def commit(self):
+        with self.cursor() as cursor:
+            cursor.execute('RELEASE SAVEPOINT test_case; SAVEPOINT test_case')
+
+    def rollback(self):
+        with self.cursor() as cursor:
+            cursor.execute('ROLLBACK TO SAVEPOINT test_case')
+
+
+test_schema = 'test_{}'.format(os.getpid())
+test_dsn = None
+test_connection = None
+
+
+def setUpModule():
+    """Create this process's schema and up-to-date tables, and point the application at them."""
+    global test_dsn, test_connection
+    base_url = database_url_for_tests()
+    with psycopg2.connect(base_url) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}'.format(test_schema))
+    connection.close()
+
+    test_dsn = psycopg2.extensions.make_dsn(base_url, options='-c search_path={}'.format(test_schema))
+    db.init_pool(test_dsn)
+
+    test_connection = psycopg2.connect(test_dsn, connection_factory=RollbackConnection)
+    with app.open_resource('sql/create-db.sql', mode='r') as f:
+        with test_connection.cursor() as cursor:
+            cursor.execute(f.read())
+    psycopg2.extensions.connection.commit(test_connection)
+    with psycopg2.connect(test_dsn) as connection:
+        migrate.migrate(connection)
+    connection.close()
+
+
+def tearDownModule():
+    """Drop this process's schema."""
+    test_connection.close()
+    db.get_pool().close()
+    with psycopg2.connect(database_url_for_tests()) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute('DROP SCHEMA IF EXISTS {} CASCADE'.format(test_schema))
+    connection.close()
 
 
 # @unittest.skip
@@ -54,6 +151,23 @@ class FlaskTestCase(unittest.TestCase):
 class ApplicationTestCase(FlaskTestCase):
     """Test the basic behavior of page routing and display"""
 
+    @classmethod
+    def setUpClass(cls):
+        """Load the sample data. Pages use pooled connections, so this data is committed."""
+        cls.execute_committed(open(os.path.join(app.root_path, 'sql/init-db.sql')).read())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.execute_committed('TRUNCATE comment, photo, account, ledger, member')
+        cls.execute_committed(db.rebuild_summaries_query)
+
+    @staticmethod
+    def execute_committed(sql):
+        with psycopg2.connect(test_dsn) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(sql)
+        connection.close()
+
     def test_home_page(self):
         """Verify the home page."""
         resp = self.client.get('/')
@@ -64,6 +178,45 @@ class ApplicationTestCase(FlaskTestCase):
         resp = self.client.get(url_for('all_members'))
         self.assertTrue(b'Comments' in resp.data)
 
+    def test_dashboard(self):
+        """Verify the dashboard shows the summary totals."""
+        resp = self.client.get(url_for('dashboard'))
+        self.assertTrue(b'$13600.00' in resp.data)
+
+    def test_search_comments_page(self):
+        """Verify the comment search page highlights what matched."""
+        resp = self.client.get(url_for('search_comments', q='lively'))
+        self.assertIn(b'Another <mark>lively</mark> comment.', resp.data)
+        resp = self.client.get(url_for('search_comments', q='lively', after='not a cursor'))
+        self.assertEqual(resp.status_code, 400)
+
+    def test_transfer_batch_bad_requests(self):
+        """Malformed batches are refused with 400 and change nothing."""
+        resp = self.client.post('/transfer/batch', json=[{'from': 1, 'to': 2, 'amount': '1.00'}])
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.post('/transfer/batch', json={'transfers': [{'from': 1, 'to': 1, 'amount': '1.00'}]})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('same account', resp.get_json()['error'])
+
+    def test_transfer_account_gone(self):
+        """An account that drops out of the directory after the choices were checked is a form error."""
+        app.config['WTF_CSRF_ENABLED'] = False
+        find = db.account_directory.find
+        db.account_directory.find = lambda account_id: None if account_id == 2 else find(account_id)
+        try:
+            resp = self.client.post(url_for('transfer'), data={'from_account': 1, 'to_account': 2, 'amount': '1.00'})
+        finally:
+            del db.account_directory.find
+            app.config['WTF_CSRF_ENABLED'] = True
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'Not a valid choice', resp.data)
+
+    def test_member_page_streamed(self):
+        """Verify the streamed version of the member page."""
+        resp = self.client.get(url_for('all_members', stream=1))
+        self.assertTrue(b'All the Members' in resp.data)
+        self.assertNotIn('Server-Timing', resp.headers)
+
 
 class DatabaseTestCase(FlaskTestCase):
     """Test database access and update functions."""
@@ -72,18 +225,24 @@ class DatabaseTestCase(FlaskTestCase):
     def execute_sql(resource_name):
         """Helper function to run a SQL script on the test database."""
         with app.open_resource(resource_name, mode='r') as f:
-            g.cursor.execute(f.read())
+            db.get_cursor().execute(f.read())
         g.connection.commit()
 
     def setUp(self):
-        """Open the database connection and create all the tables."""
+        """Start a transaction on the test connection and hand it to the model layer."""
         super(DatabaseTestCase, self).setUp()
-        db.open_db_connection()
-        self.execute_sql('sql/create-db.sql')
+        test_connection.begin_test()
+        g.connection = test_connection
+        g.cursor = test_connection.cursor(cursor_factory=db.cursor_factory)
+        g.connections = {'primary': (None, g.connection, g.cursor)}
+        db.member_cache.clear()
+        db.account_directory.invalidate()
 
     def tearDown(self):
-        """Clear all tables in the database and close the connection."""
-        db.close_db_connection()
+        """Roll back everything the test did."""
+        _, connection, cursor = g.pop('connections')['primary']
+        cursor.close()
+        connection.end_test()
         super(DatabaseTestCase, self).tearDown()
 
     def test_add_member(self):
@@ -111,6 +270,637 @@ class DatabaseTestCase(FlaskTestCase):
         self.assertEqual(test_member['first_name'], 'NewFirstName')
         self.assertEqual(test_member['last_name'], 'LastName')
 
+    def test_members_page(self):
+        """Page through members using the last e-mail of each page."""
+        for n in range(5):
+            db.create_member('test{}@example.com'.format(n), 'First', 'Last', 'pass')
+
+        first_page = db.members_page(limit=3)
+        self.assertEqual([m['email'] for m in first_page],
+                         ['test0@example.com', 'test1@example.com', 'test2@example.com'])
+
+        second_page = db.members_page(first_page[-1]['email'], limit=3)
+        self.assertEqual([m['email'] for m in second_page], ['test3@example.com', 'test4@example.com'])
+
+    def test_comments_page(self):
+        """Pages of comments line up with the full streamed listing."""
+        db.create_member('test@example.com', 'First', 'Last', 'pass')
+        for n in range(5):
+            db.get_cursor().execute("INSERT INTO comment (body, member) VALUES (%s, 'test@example.com')",
+                                    ['Comment {}'.format(n)])
+
+        first_page = db.comments_page(limit=3)
+        last = first_page[-1]
+        second_page = db.comments_page((last['last_name'], last['first_name'], last['id']), limit=3)
+        paged = [c['body'] for c in first_page + second_page]
+        streamed = [c['body'] for c in db.stream_comments(batch_size=2)]
+        self.assertEqual(paged, streamed)
+        self.assertEqual(len(paged), 5)
+
+    def test_member_cache(self):
+        """Repeat lookups come from the cache; updates drop the cached copy."""
+        db.create_member('test@example.com', 'FirstName', 'LastName', 'pass')
+        db.find_member('test@example.com')
+        hits = db.member_cache.hits
+        g.pop('loader')  # As if this were the next request.
+        db.find_member('test@example.com')
+        self.assertEqual(db.member_cache.hits, hits + 1)
+
+        db.update_member('test@example.com', 'NewFirstName', 'LastName', 'newpass')
+        self.assertEqual(db.find_member('test@example.com')['first_name'], 'NewFirstName')
+
+    def test_transfer_funds(self):
+        """A committed transfer moves money; a failed one changes nothing."""
+        self.execute_sql('sql/init-db.sql')
+        db.transfer_funds(1, 2, 10000, False)
+        self.assertEqual(db.read_balance(1), 390000)
+        self.assertEqual(db.read_balance(2), 70000)
+
+        with self.assertRaises(db.TransferError):
+            db.transfer_funds(2, 1, 1000000, False)
+        with self.assertRaises(db.TransferError):
+            db.transfer_funds(1, 999, 10000, False)
+        with self.assertRaises(db.TransferError):
+            db.transfer_funds(1, 2, 0.5, False)  # Amounts are whole cents.
+        with self.assertRaises(ValueError):
+            db.transfer_funds(1, 1, 10000, False)
+        self.assertEqual(db.read_balance(1), 390000)
+        self.assertEqual(db.read_balance(2), 70000)
+
+        db.transfer_funds(1, 2, 10000, True)
+        self.assertEqual(db.read_balance(1), 390000)
+
+    def test_transfer_many(self):
+        """A batch is applied in order, and all or nothing."""
+        self.execute_sql('sql/init-db.sql')
+        balances = db.transfer_many([(2, 1, 60000), (1, 2, 10000), (3, 4, 6501)])
+        self.assertEqual(balances, {1: 450000, 2: 10000, 3: 749999, 4: 150001})
+        self.assertEqual(db.read_balance(2), 10000)
+
+        with self.assertRaises(db.TransferError):
+            db.transfer_many([(1, 2, 10000), (2, 3, 100000)])
+        with self.assertRaises(ValueError):
+            db.transfer_many([(1, 2, 10000), (3, 3, 100)])
+        self.assertEqual(db.read_balance(1), 450000)
+
+    def test_reconcile(self):
+        """Balances match the ledger after transfers, and a changed balance is caught."""
+        self.execute_sql('sql/init-db.sql')
+        db.transfer_funds(1, 2, 10000, False)
+        db.transfer_many([(3, 4, 5000), (4, 1, 2500)])
+        db.update_balance(2, 12345)
+        report = reconcile.check(*reconcile.load(g.connection))
+        self.assertEqual(report['problems'], [])
+        self.assertEqual((report['accounts'], report['transfers']), (4, 3))
+
+        g.cursor.execute('UPDATE account SET balance_cents = balance_cents + 1 WHERE id = 3')
+        report = reconcile.check(*reconcile.load(g.connection))
+        self.assertEqual(report['mismatched_accounts'], 1)
+        self.assertIn('Account 3 has 751501 cents but the ledger says 751500', report['problems'])
+
+    def test_search_comments(self):
+        """Search ranks better matches first and pages through the rest."""
+        db.create_member('test@example.com', 'FirstName', 'LastName', 'pass')
+        for body in ['The cats sat', 'A cat, a cat, and another cat', 'Dogs only', 'One cat <b>here</b>']:
+            db.create_comment('test@example.com', body)
+
+        comments, cursor = db.search_comments('cat', limit=2)
+        self.assertEqual(comments[0]['body'], 'A cat, a cat, and another cat')
+        self.assertIn(db.highlight_start + 'cat' + db.highlight_stop, comments[0]['headline'])
+        more, cursor = db.search_comments('cat', limit=2, cursor=cursor)
+        self.assertIsNone(cursor)
+        self.assertEqual(len(comments + more), 3)
+        # Words are stemmed, so "cat" also matches "cats".
+        bodies = {comment['body'] for comment in db.search_comments('cat -another')[0]}
+        self.assertEqual(bodies, {'The cats sat', 'One cat <b>here</b>'})
+
+    def test_account_directory(self):
+        """The directory builds things once per version and changes after a transfer commits."""
+        self.execute_sql('sql/init-db.sql')
+        def account_ids(accounts):
+            return [account['id'] for account in accounts]
+        ids = db.account_directory.build('ids', account_ids)
+        self.assertEqual(sorted(ids), [1, 2, 3, 4])
+        self.assertIs(db.account_directory.build('ids', account_ids), ids)
+
+        version = db.account_directory.version
+        db.transfer_funds(1, 2, 10000, False)
+        self.assertGreater(db.account_directory.version, version)
+        self.assertEqual(db.account_directory.find(2)['balance_cents'], 70000)
+        self.assertIsNot(db.account_directory.build('ids', account_ids), ids)
+
+        version = db.account_directory.version
+        db.update_balance(2, 12345)
+        g.connection.commit()
+        self.assertGreater(db.account_directory.version, version)
+        self.assertEqual(db.account_directory.find(2)['balance_cents'], 12345)
+
+    def test_search_accounts(self):
+        """Search matches ids, then name prefixes, then anything containing the text."""
+        self.execute_sql('sql/init-db.sql')
+        names = [account['name'] for account in db.account_directory.search('zelda')]
+        self.assertEqual(names, ["Zelda's Checking Account", "Zelda's Savings Account"])
+        names = [account['name'] for account in db.account_directory.search('savings', limit=1)]
+        self.assertEqual(names, ["Fred's Savings Account"])
+        self.assertEqual(db.account_directory.search('3')[0]['id'], 3)
+
+    def test_import_members(self):
+        """Bulk import skips or updates existing members."""
+        db.create_member('test0@example.com', 'Old', 'Name', 'pass')
+        rows = [{'email': 'test{}@example.com'.format(n), 'first_name': 'New',
+                 'last_name': 'Name', 'password': 'pass'} for n in range(5)]
+
+        totals = db.import_members(rows, chunk_size=2)
+        self.assertEqual(totals, {'read': 5, 'written': 4})
+        self.assertEqual(db.find_member('test0@example.com')['first_name'], 'Old')
+
+        totals = db.import_members(rows, chunk_size=2, on_conflict='update')
+        self.assertEqual(totals, {'read': 5, 'written': 5})
+        self.assertEqual(db.find_member('test0@example.com')['first_name'], 'New')
+
+    def test_create_photo(self):
+        """The new photo row comes back from the insert and shows up on the member."""
+        db.create_member('test@example.com', 'FirstName', 'LastName', 'pass')
+        db.find_member('test@example.com')
+        photo = db.create_photo('test@example.com', 'photos/abc.png')
+        self.assertIsNotNone(photo['id'])
+        self.assertEqual(db.find_member('test@example.com')['file_path'], 'photos/abc.png')
+
+    def test_load_members_batched(self):
+        """Loading many members costs one query per kind of data, and repeats cost nothing."""
+        for n in range(3):
+            db.create_member('test{}@example.com'.format(n), 'First', 'Last', 'pass')
+        db.create_comment('test1@example.com', 'Hi')
+        emails = ['test0@example.com', 'test1@example.com', 'test2@example.com', 'nobody@example.com']
+        db.member_cache.clear()
+
+        queries = querylog.request_summary()['count']
+        members = db.load_members(emails)
+        counts = db.load_comment_counts(emails)
+        comments = db.load_comments(emails)
+        db.find_member('test2@example.com')
+        db.comments_by_member('test1@example.com')
+        self.assertEqual(querylog.request_summary()['count'], queries + 3)
+
+        self.assertIsNone(members['nobody@example.com'])
+        self.assertEqual(members['test0@example.com']['first_name'], 'First')
+        self.assertEqual(counts, {'test0@example.com': 0, 'test1@example.com': 1,
+                                  'test2@example.com': 0, 'nobody@example.com': 0})
+        self.assertEqual([c['body'] for c in comments['test1@example.com']], ['Hi'])
+
+    def test_init_db_summaries(self):
+        """The sample data from init-db.sql comes with correct summaries, as set up in the README."""
+        self.execute_sql('sql/init-db.sql')
+        self.assertEqual(db.verify_summaries(), [])
+        self.assertEqual(db.summary_totals()['member_count'], 3)
+        self.assertEqual(db.top_commenters(1)[0][0]['email'], 'phcollins@taylor.edu')
+
+    def test_summaries(self):
+        """Writes keep the summary tables in step with a full recount."""
+        self.execute_sql('sql/init-db.sql')
+        db.rebuild_summaries()
+        self.assertEqual(db.summary_totals()['total_balance'], 13600)
+
+        db.create_member('test@example.com', 'FirstName', 'LastName', 'pass')
+        db.create_comment('test@example.com', 'First!')
+        db.create_comment('test@example.com', 'Second!')
+        db.create_comment('test@example.com', 'Third!')
+        db.transfer_funds(1, 2, 10000, False)
+        db.transfer_many([(3, 4, 5000), (4, 1, 2500)])
+        db.update_balance(4, 200000)
+        db.import_comments([('fred@ziffle.com', 'Imported')])
+
+        totals = db.summary_totals()
+        self.assertEqual(totals['member_count'], 4)
+        self.assertEqual(totals['comment_count'], 8)
+        self.assertEqual(totals['transfer_count'], 3)
+        self.assertEqual(totals['transferred_total'], 175)
+        self.assertEqual(db.top_commenters(1)[0][0]['email'], 'test@example.com')
+        self.assertEqual(db.verify_summaries(), [])
+
+
+class CommentWriterTestCase(FlaskTestCase):
+    """Test that queued comments are written in batches, each committed once."""
+
+    def setUp(self):
+        super(CommentWriterTestCase, self).setUp()
+        self.writer = db.CommentWriter(batch_size=10, max_delay=0.05)
+        ApplicationTestCase.execute_committed("INSERT INTO member (email, first_name, last_name, password) "
+                               "VALUES ('writer@example.com', 'Comment', 'Writer', 'pass')")
+
+    def tearDown(self):
+        self.writer.close()
+        ApplicationTestCase.execute_committed("DELETE FROM comment WHERE member = 'writer@example.com'; "
+                               "DELETE FROM member_comment_count WHERE member = 'writer@example.com'; "
+                               "DELETE FROM member WHERE email = 'writer@example.com'")
+        ApplicationTestCase.execute_committed(db.rebuild_summaries_query)
+        super(CommentWriterTestCase, self).tearDown()
+
+    def test_batches(self):
+        """Many comments share a few commits, and each caller gets its own row back."""
+        futures = [self.writer.submit('writer@example.com', 'Comment {}'.format(n)) for n in range(25)]
+        rows = [future.result(timeout=5) for future in futures]
+        self.assertEqual([row['body'] for row in rows], ['Comment {}'.format(n) for n in range(25)])
+        self.assertEqual(len({row['id'] for row in rows}), 25)
+
+        stats = self.writer.stats()
+        self.assertEqual(stats['comments'], 25)
+        self.assertLessEqual(stats['batches'], 5)
+        with psycopg2.connect(test_dsn) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT comment_count FROM member_comment_count WHERE member = 'writer@example.com'")
+                self.assertEqual(cursor.fetchone()[0], 25)
+        connection.close()
+
+    def test_bad_comment(self):
+        """A comment that can't be written fails alone; the rest of its batch is stored."""
+        good = self.writer.submit('writer@example.com', 'Fine')
+        bad = self.writer.submit('nobody@example.com', 'Orphan')
+        self.assertEqual(good.result(timeout=5)['body'], 'Fine')
+        with self.assertRaises(psycopg2.IntegrityError):
+            bad.result(timeout=5)
+
+    def test_add_comment_route(self):
+        """The route answers once the comment is stored."""
+        resp = self.client.post(url_for('add_comment'), json={'email': 'writer@example.com', 'body': 'Hi'})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.get_json()['body'], 'Hi')
+        resp = self.client.post(url_for('add_comment'), json={'email': 'nobody@example.com', 'body': 'Hi'})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_add_comment_bad_body(self):
+        """Bodies that aren't a comment, or won't fit in the table, are refused with a 400."""
+        for body in (['writer@example.com', 'Hi'], 'Hi', 5, {'email': ['writer@example.com'], 'body': 'Hi'}):
+            resp = self.client.post(url_for('add_comment'), json=body)
+            self.assertEqual(resp.status_code, 400)
+        resp = self.client.post(url_for('add_comment'), json={'email': 'x' * 200 + '@example.com', 'body': 'Hi'})
+        self.assertEqual(resp.status_code, 400)
+
+
+class AsyncTestCase(unittest.IsolatedAsyncioTestCase):
+    """Test the async model layer and pages against the sample data."""
+
+    @classmethod
+    def setUpClass(cls):
+        ApplicationTestCase.setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        ApplicationTestCase.tearDownClass()
+
+    async def asyncSetUp(self):
+        await async_db.init_pool(test_dsn, max_size=3)
+        db.member_cache.clear()
+
+    async def asyncTearDown(self):
+        await async_db.close_pool()
+
+    async def test_member_comments(self):
+        """Functions run at the same time get the same answers as one after the other."""
+        member, comments = await asyncio.gather(async_db.find_member('zelda@ziffle.com'),
+                                                async_db.comments_by_member('zelda@ziffle.com'))
+        self.assertEqual(member['first_name'], 'Zelda')
+        self.assertEqual([comment['body'] for comment in comments], ['Another lively comment.'])
+        self.assertIsNone(await async_db.find_member('nobody@example.com'))
+
+    async def test_transfer_funds(self):
+        """A committed transfer moves money; a failed one changes nothing."""
+        await async_db.transfer_funds(1, 2, 10000, False)
+        self.assertEqual(await async_db.read_balance(2), 70000)
+        with self.assertRaises(db.TransferError):
+            await async_db.transfer_funds(2, 1, 1000000, False)
+        with self.assertRaises(ValueError):
+            await async_db.transfer_funds(2, 2, 100, False)
+        await async_db.transfer_funds(2, 1, 10000, True)
+        await async_db.transfer_funds(2, 1, 10000, False)
+        self.assertEqual(await async_db.read_balance(2), 60000)
+
+    async def test_members_and_photos(self):
+        """New and changed members and photos are stored, and the cached copies are dropped."""
+        self.assertEqual(await async_db.create_member('async@example.com', 'First', 'Last', 'pass'), 1)
+        self.assertEqual((await async_db.find_member('async@example.com'))['first_name'], 'First')
+        self.assertEqual(await async_db.update_member('async@example.com', 'New', 'Last', 'pass'), 1)
+        photo = await async_db.create_photo('async@example.com', '')
+        self.assertEqual(await async_db.set_photo(photo['id'], 'photos/async.png'), 1)
+        member = await async_db.find_member('async@example.com')
+        self.assertEqual((member['first_name'], member['file_path']), ('New', 'photos/async.png'))
+        # The pages would look for the file.
+        await async_db.execute('DELETE FROM photo WHERE id = $1', photo['id'])
+
+    async def test_comments(self):
+        """Queued and imported comments are stored and counted."""
+        await async_db.create_member('async-comments@example.com', 'First', 'Last', 'pass')
+        row = await async_db.queue_comment('async-comments@example.com', 'Queued')
+        self.assertEqual(row['body'], 'Queued')
+        totals = await async_db.import_comments([{'member': 'async-comments@example.com', 'body': 'Imported'},
+                                                 ('async-comments@example.com', 'Also imported')], chunk_size=1)
+        self.assertEqual(totals, {'read': 2, 'written': 2})
+        counts = await async_db.load_comment_counts(['async-comments@example.com'])
+        self.assertEqual(counts['async-comments@example.com'], 3)
+
+    async def test_import_members(self):
+        """Imported members are counted once each, and existing ones are skipped or updated."""
+        before = (await async_db.summary_totals())['member_count']
+        rows = [('import{}@example.com'.format(n), 'First', 'Last', 'pass') for n in range(5)]
+        totals = await async_db.import_members(rows + [('fred@ziffle.com', 'Freddy', 'Z', 'pass')], chunk_size=2)
+        self.assertEqual(totals, {'read': 6, 'written': 5})
+        self.assertEqual((await async_db.summary_totals())['member_count'], before + 5)
+        await async_db.import_members([{'email': 'import0@example.com', 'first_name': 'Updated',
+                                        'last_name': 'Last', 'password': 'pass'}], on_conflict='update')
+        self.assertEqual((await async_db.find_member('import0@example.com'))['first_name'], 'Updated')
+        with self.assertRaises(ValueError):
+            await async_db.import_members([], on_conflict='replace')
+
+    async def test_transfer_many(self):
+        """A batch is all or nothing, and balance changes are recorded."""
+        balances = await async_db.transfer_many([(2, 1, 60000), (1, 2, 60000)])
+        self.assertEqual(balances[2], 60000)
+        with self.assertRaises(db.TransferError):
+            await async_db.transfer_many([(1, 2, 100), (2, 3, 10000000)])
+        with self.assertRaises(ValueError):
+            await async_db.transfer_many([(3, 3, 100)])
+        self.assertEqual(await async_db.read_balance(1), 400000)
+
+        await async_db.update_balance(4, 143600)
+        self.assertEqual(await async_db.read_balance(4), 143600)
+        await async_db.update_balance(4, 143500)
+        with self.assertRaises(RuntimeError):
+            await async_db.update_balance(999, 100)
+
+    async def test_pages(self):
+        """Pages render, and links to pages only the sync app serves still work."""
+        async with async_application.app.test_app() as test_app:
+            client = test_app.test_client()
+            resp = await client.get('/comments/zelda@ziffle.com')
+            self.assertIn(b'Another lively comment.', await resp.get_data())
+            resp = await client.get('/members')
+            self.assertIn(b'/members/update/zelda@ziffle.com', await resp.get_data())
+
+
+class PhotoTestCase(unittest.TestCase):
+    """Test saving uploaded photos."""
+
+    def test_duplicate_upload_saved_once(self):
+        """Uploads with the same content end up in the same file."""
+        from io import BytesIO
+        from werkzeug.datastructures import FileStorage
+
+        with tempfile.TemporaryDirectory() as static_folder:
+            first = photos.save_upload(FileStorage(BytesIO(b'photo bytes'), 'me.PNG'), static_folder)
+            second = photos.save_upload(FileStorage(BytesIO(b'photo bytes'), 'me-again.png'), static_folder)
+            self.assertEqual(first, second)
+            self.assertTrue(first.endswith('.png'))
+            self.assertEqual(os.listdir(os.path.join(static_folder, photos.photo_folder)),
+                             [os.path.basename(first)])
+
+    def test_failed_upload_cleaned_up(self):
+        """An upload that fails part way leaves no temporary file behind."""
+        from io import BytesIO
+        from werkzeug.datastructures import FileStorage
+
+        class BrokenStream(BytesIO):
+            def read(self, size=-1):
+                if self.tell():
+                    raise OSError('Connection reset')
+                return super(BrokenStream, self).read(4)
+
+        with tempfile.TemporaryDirectory() as static_folder:
+            with self.assertRaises(OSError):
+                photos.save_upload(FileStorage(BrokenStream(b'photo bytes'), 'me.png'), static_folder)
+            self.assertEqual(os.listdir(os.path.join(static_folder, photos.photo_folder)), [])
+
+    @unittest.skipIf(photos.Image is None, 'Pillow is not installed')
+    def test_thumbnails(self):
+        """Each size is written under its own name, with no temporary files left."""
+        with tempfile.TemporaryDirectory() as static_folder:
+            os.makedirs(os.path.join(static_folder, photos.photo_folder))
+            file_path = os.path.join(photos.photo_folder, 'photo.png')
+            photos.Image.new('RGB', (800, 600)).save(os.path.join(static_folder, file_path))
+            made = photos.make_thumbnails(static_folder, file_path, (128, 512))
+            self.assertEqual(len(made), 2)
+            with photos.Image.open(made[0]) as thumbnail:
+                self.assertEqual(max(thumbnail.size), 128)
+            self.assertEqual(sorted(os.listdir(os.path.join(static_folder, photos.photo_folder))),
+                             ['photo-128.png', 'photo-512.png', 'photo.png'])
+
+
+class PhotoServingTestCase(FlaskTestCase):
+    """Test caching headers and conditional requests for photos."""
+
+    def setUp(self):
+        super(PhotoServingTestCase, self).setUp()
+        folder = os.path.join(app.static_folder, photos.photo_folder)
+        os.makedirs(folder, exist_ok=True)
+        # Name the file after this process so parallel test runs don't collide.
+        self.etag = hashlib.sha256(str(os.getpid()).encode()).hexdigest()
+        self.file_name = self.etag + '.png'
+        self.file_path = os.path.join(folder, self.file_name)
+        with open(self.file_path, 'wb') as f:
+            f.write(b'0123456789')
+
+    def tearDown(self):
+        os.remove(self.file_path)
+        super(PhotoServingTestCase, self).tearDown()
+
+    def test_cache_headers(self):
+        resp = self.client.get(url_for('serve_photo', file_name=self.file_name))
+        self.assertEqual(resp.data, b'0123456789')
+        self.assertEqual(resp.headers['ETag'], '"{}"'.format(self.etag))
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        resp.close()
+
+    def test_if_none_match(self):
+        resp = self.client.get(url_for('serve_photo', file_name=self.file_name),
+                               headers={'If-None-Match': '"{}"'.format(self.etag)})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_range(self):
+        resp = self.client.get(url_for('serve_photo', file_name=self.file_name), headers={'Range': 'bytes=2-4'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, b'234')
+        resp.close()
+
+
+class MemberCacheTestCase(unittest.TestCase):
+    """Test eviction and expiry in the member cache."""
+
+    def test_lru_eviction(self):
+        cache = db.MemberCache(max_size=2, ttl=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl_expiry(self):
+        cache = db.MemberCache(max_size=2, ttl=0)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class QueryLogTestCase(FlaskTestCase):
+    """Test query timing and normalization."""
+
+    def test_normalize(self):
+        self.assertEqual(querylog.normalize("SELECT *\n  FROM t WHERE a = 'x''y' AND b = 42"),
+                         'SELECT * FROM t WHERE a = ? AND b = ?')
+        self.assertEqual(querylog.normalize('VALUES (1, 2), (3, 4), (5, 6)'), 'VALUES (?, ?), ...')
+
+    def test_request_counts(self):
+        """Queries are counted for the request and reported in the Server-Timing header."""
+        db.open_db_connection()
+        db.all_accounts()
+        db.all_accounts()
+        self.assertEqual(querylog.request_summary()['count'], 2)
+        db.close_db_connection()
+
+        resp = self.client.get(url_for('all_accounts'))
+        self.assertIn('db;dur=', resp.headers['Server-Timing'])
+
+
+class ConnectionPoolTestCase(FlaskTestCase):
+    """Test checkout, reuse, and limits of the connection pool."""
+
+    def setUp(self):
+        super(ConnectionPoolTestCase, self).setUp()
+        self.pool = db.ConnectionPool(test_dsn, max_size=2, timeout=0.1)
+
+    def tearDown(self):
+        self.pool.close()
+        super(ConnectionPoolTestCase, self).tearDown()
+
+    def test_lazy_checkout(self):
+        """A request that never queries should not take a connection."""
+        db.open_db_connection()
+        self.assertIsNone(g.connection)
+        db.close_db_connection()
+
+    def test_reuse_connection(self):
+        """A returned connection is handed out again."""
+        first = self.pool.checkout()
+        self.pool.checkin(first)
+        second = self.pool.checkout()
+        self.assertIs(first, second)
+        self.assertEqual(self.pool.stats()['size'], 1)
+        self.pool.checkin(second)
+
+    def test_pool_timeout(self):
+        """Checkout gives up when every connection is in use."""
+        first = self.pool.checkout()
+        second = self.pool.checkout()
+        self.assertEqual(self.pool.stats()['in_use'], 2)
+        with self.assertRaises(db.PoolTimeout):
+            self.pool.checkout()
+        self.assertEqual(self.pool.stats()['timeouts'], 1)
+        self.pool.checkin(first)
+        self.pool.checkin(second)
+
+    def test_checkin_after_close(self):
+        """A connection returned to a closed pool is closed, not kept."""
+        connection = self.pool.checkout()
+        self.pool.close()
+        self.pool.checkin(connection)
+        self.assertTrue(connection.closed)
+        self.assertEqual(self.pool.stats()['size'], 0)
+
+    def test_pool_replaced_during_request(self):
+        """A request's connection goes back to the pool it came from, even if that pool was replaced."""
+        old_pool = db.get_pool()
+        db.open_db_connection()
+        db.all_accounts()
+        _, connection, _ = g.connections['primary']
+        new_pool = db.init_pool(test_dsn)
+        db.close_db_connection()
+        self.assertTrue(connection.closed)
+        self.assertEqual(old_pool.stats()['size'], 0)
+        self.assertEqual(new_pool.stats()['size'], 0)
+
+
+class ReplicaRoutingTestCase(FlaskTestCase):
+    """Test that reads go to replicas and writes go to the primary.
+
+    The test database is listed twice as a replica, standing in for two real replicas.
+    """
+
+    def setUp(self):
+        super(ReplicaRoutingTestCase, self).setUp()
+        db.init_replicas([test_dsn, test_dsn], selection='round-robin')
+        db.open_db_connection()
+
+    def tearDown(self):
+        db.close_db_connection()
+        db.init_replicas([])
+        super(ReplicaRoutingTestCase, self).tearDown()
+
+    def test_reads_use_one_replica(self):
+        """All the reads of a request go to the same replica."""
+        self.assertEqual(db.all_accounts.access, 'read')
+        db.all_accounts()
+        db.all_members()
+        self.assertEqual(len(g.connections), 1)
+        self.assertNotIn('primary', g.connections)
+
+    def test_verify_summaries_on_replica(self):
+        """Checking the summaries only reads, so it runs on a replica too."""
+        self.assertEqual(db.verify_summaries.access, 'read')
+        db.verify_summaries()
+        self.assertNotIn('primary', g.connections)
+
+    def test_round_robin(self):
+        """Successive requests take turns between the replicas."""
+        chosen = {db.choose_replica(), db.choose_replica()}
+        self.assertEqual(chosen, {0, 1})
+
+    def test_least_loaded(self):
+        """The replica with fewer connections in use is chosen."""
+        db.replica_selection = 'least-loaded'
+        busy = db.get_replica_pools()[0].checkout()
+        try:
+            self.assertEqual(db.choose_replica(), 1)
+        finally:
+            db.get_replica_pools()[0].checkin(busy)
+            db.replica_selection = 'round-robin'
+
+    def test_read_after_write(self):
+        """Reads after a write stay on the primary for the rest of the request and session."""
+        self.assertEqual(db.update_member.access, 'write')
+        db.update_member('nobody@example.com', 'No', 'Body', 'pass')
+        db.find_account(100)
+        self.assertEqual(list(g.connections), ['primary'])
+
+        # The next request in the same session still reads from the primary...
+        g.wrote_to_primary = False
+        self.assertEqual(db.read_target(), 'primary')
+
+        # ...until the replicas have had time to catch up.
+        session['primary_until'] = 0
+        self.assertIn(db.read_target(), (0, 1))
+
+    def test_replica_reads_not_cached(self):
+        """Members read from a replica stay out of the member cache, which is skipped after a write."""
+        email = 'replica@example.com'
+        ApplicationTestCase.execute_committed("INSERT INTO member (email, first_name, last_name, password) "
+                                              "VALUES ('replica@example.com', 'Old', 'Name', 'pass')")
+        try:
+            db.member_cache.clear()
+            self.assertEqual(db.find_member(email)['first_name'], 'Old')
+            self.assertNotIn('primary', g.connections)
+            self.assertIsNone(db.member_cache.get(email))
+
+            db.update_member(email, 'New', 'Name', 'pass')
+            self.assertIsNone(db.member_cache.get(email))
+            # As if another process had cached a lagging replica's copy just after the write.
+            db.member_cache.put(email, {'email': email, 'first_name': 'Old', 'last_name': 'Name',
+                                        'file_path': None})
+            g.pop('loader')  # As if this were the next request, inside the stickiness window.
+            g.wrote_to_primary = False
+            self.assertEqual(db.find_member(email)['first_name'], 'New')
+        finally:
+            db.member_cache.clear()
+            ApplicationTestCase.execute_committed("DELETE FROM member WHERE email = 'replica@example.com'")
+
 
 # Do the right thing if this file is run standalone.
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+# Measure logins per second against the credential store (credentials.py)
+# for several hash costs and hashing pool sizes.
+#
+# Each run sends --logins login attempts (half with the wrong password) from
+# --clients threads at once, as a burst of POSTs to /login would. Meanwhile a
+# "heartbeat" thread does a little work every millisecond, like the other
+# routes of the app would; its worst delays show whether the burst starves them.
+#
+#   python benchmark.py --iterations 50000 200000 600000 --workers 1 2 4
+
+import argparse
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import credentials
+
+
+def heartbeat(stop, delays):
+    """Sleep 1 ms at a time until `stop` is set, recording how late each wake-up is."""
+    while not stop.is_set():
+        start = time.perf_counter()
+        time.sleep(0.001)
+        delays.append(time.perf_counter() - start - 0.001)
+
+
+def run(iterations, workers, logins, clients, users=1000):
+    """Time a burst of logins. Returns statistics (times in ms)."""
+    store = credentials.CredentialStore(iterations=iterations, workers=workers, max_waiting=clients)
+    # Setting up all the users at full cost would take a while; they share one hash instead.
+    encoded = credentials.hash_password('password', iterations=iterations)
+    for n in range(users):
+        store._hashes['user{}@example.com'.format(n)] = encoded
+
+    def login(n):
+        return store.verify('user{}@example.com'.format(n % users), 'password' if n % 2 else 'wrong')
+
+    stop, delays = threading.Event(), []
+    ticker = threading.Thread(target=heartbeat, args=(stop, delays))
+    ticker.start()
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as burst:
+        matched = sum(burst.map(login, range(logins)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    ticker.join()
+    store.close()
+
+    assert matched == logins // 2
+    delays.sort()
+    return {'iterations': iterations, 'workers': workers, 'logins_per_second': logins / elapsed,
+            'ms_per_login': 1000 * elapsed / logins,
+            'heartbeat_p99_ms': 1000 * delays[int(0.99 * (len(delays) - 1))] if delays else None}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark logins per second against the credential store')
+    parser.add_argument('--iterations', type=int, nargs='+', default=[50000, credentials.default_iterations, 600000],
+                        help='PBKDF2 rounds to try')
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({1, 2, os.cpu_count() or 1}),
+                        help='Hashing pool sizes to try')
+    parser.add_argument('--logins', type=int, default=200, help='Login attempts in each burst')
+    parser.add_argument('--clients', type=int, default=32, help='Concurrent login attempts')
+    parser.add_argument('--save', help='Write results to this JSON file')
+    args = parser.parse_args()
+
+    results = []
+    for iterations in args.iterations:
+        for workers in args.workers:
+            stats = run(iterations, workers, args.logins, args.clients)
+            results.append(stats)
+            print('{:8} rounds  {:3} workers  {:8.1f} logins/s  {:7.1f} ms/login  heartbeat p99 {:6.1f} ms'.format(
+                iterations, workers, stats['logins_per_second'], stats['ms_per_login'], stats['heartbeat_p99_ms']))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
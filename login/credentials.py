@@ -0,0 +1,108 @@
+# A credential store for examples-login.py.
+#
+# Users are kept in a dictionary keyed by e-mail address, so finding one takes
+# the same time however many users there are. Passwords are never stored;
+# instead we keep a salted PBKDF2 hash, which is deliberately slow to compute
+# so that a stolen copy of the store is slow to attack.
+#
+# Because checking a password is slow on purpose, it runs on a small pool of
+# worker threads. (hashlib releases the GIL while it hashes, so threads are
+# enough; the hashes really do run in parallel with the rest of the app.)
+# The pool and the number of logins allowed to wait for it are both bounded,
+# so a burst of login attempts can use at most `workers` CPUs and can't tie
+# up every thread the web server has.
+
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import threading
+
+# PBKDF2-SHA256 rounds for new hashes. More rounds is slower for us and for
+# an attacker alike; benchmark.py shows what each setting costs in logins per second.
+default_iterations = 200000
+
+# Threads that compute hashes, and logins that may wait for one of them.
+default_workers = 2
+default_max_waiting = 16
+
+
+class CredentialStoreBusy(RuntimeError):
+    """Raised when too many logins are already waiting for their passwords to be checked."""
+
+
+def hash_password(password, salt=None, iterations=default_iterations):
+    """Return a salted hash of `password` as a string like 'pbkdf2_sha256$200000$<salt>$<hash>'."""
+    if salt is None:
+        salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return 'pbkdf2_sha256${}${}${}'.format(iterations, salt.hex(), digest.hex())
+
+
+def check_password(password, encoded):
+    """Return True if `password` matches a hash made by hash_password."""
+    algorithm, iterations, salt, expected = encoded.split('$')
+    if algorithm != 'pbkdf2_sha256':
+        raise ValueError('Unknown password hash {}'.format(algorithm))
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), bytes.fromhex(salt), int(iterations))
+    # Compare in constant time, so the time taken doesn't hint at how much matched.
+    return hmac.compare_digest(digest.hex(), expected)
+
+
+def normalize_email(email):
+    return email.strip().lower()
+
+
+class CredentialStore(object):
+    """E-mail addresses and password hashes, checked on a bounded pool of threads."""
+
+    def __init__(self, iterations=default_iterations, workers=default_workers, max_waiting=default_max_waiting):
+        self.iterations = iterations
+        self._hashes = {}  # normalized e-mail -> encoded hash
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                               thread_name_prefix='password-hash')
+        # One slot for each running or waiting check.
+        self._slots = threading.BoundedSemaphore(workers + max_waiting)
+        # Unknown users are checked against this, so they take as long as known ones;
+        # otherwise the response time would tell an attacker which addresses have accounts.
+        self._dummy_hash = hash_password('', iterations=iterations)
+        # Functions called with the (normalized) e-mail of each user added, changed, or removed.
+        self.listeners = []
+
+    def add_user(self, email, password):
+        """Add a user, or change an existing user's password."""
+        self._hashes[normalize_email(email)] = hash_password(password, iterations=self.iterations)
+        self._changed(email)
+
+    def remove_user(self, email):
+        self._hashes.pop(normalize_email(email), None)
+        self._changed(email)
+
+    def _changed(self, email):
+        for listener in self.listeners:
+            listener(normalize_email(email))
+
+    def __contains__(self, email):
+        return normalize_email(email) in self._hashes
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def verify(self, email, password):
+        """Return True if `password` is the password for `email`.
+
+        Runs the hash on the pool and waits for it. Raises CredentialStoreBusy
+        at once, without waiting, if `workers + max_waiting` checks are already
+        running or queued.
+        """
+        encoded = self._hashes.get(normalize_email(email))
+        if not self._slots.acquire(blocking=False):
+            raise CredentialStoreBusy('Too many logins in progress')
+        try:
+            matched = self._executor.submit(check_password, password, encoded or self._dummy_hash).result()
+        finally:
+            self._slots.release()
+        return matched and encoded is not None
+
+    def close(self):
+        self._executor.shutdown(wait=False)
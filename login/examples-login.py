@@ -1,55 +1,121 @@
-from flask import Flask, render_template, redirect, url_for, flash
+import os
 
-from flask.ext.login import LoginManager, login_user, logout_user, login_required
-from flask.ext.wtf import Form
+from flask import Flask, render_template, redirect, url_for, flash, jsonify, request
+
+from flask_login import LoginManager, login_user, logout_user, login_required, user_logged_out
+from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired
 
+import credentials
+import ratelimit
+import users
+from users import User
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'zippy zappy zoopy'      # Needed because we're doing WTForms
 
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024       # No page here takes more than a small form
+
 login_mgr = LoginManager(app)                       # Simple way to initialize
 
 # Fake up a "database" of users and an authentication function.
+# The plain-text passwords are only here for the cheat notes on the login page;
+# the credential store keeps salted hashes of them (see credentials.py).
 valid_users = [
     { 'email': 'fred@ziffle.com', 'password': 'fred-pass' },
     { 'email': 'zelda@ziffle.com', 'password': 'zelda-pass'},
 ]
 
+credential_store = credentials.CredentialStore()
+for valid_user in valid_users:
+    credential_store.add_user(valid_user['email'], valid_user['password'])
+
 
 def authenticate(email, password):
-    """Check whether the arguments match a user from the "database" of valid users."""
-    for user in valid_users:
-        if email == user['email'] and password == user['password']:
-            return email
+    """Check whether the arguments match a user in the credential store."""
+    if credential_store.verify(email, password):
+        return email
     return None
 
 
-class User(object):
-    """Class for the currently logged-in user (if there is one). Only stores the user's e-mail."""
-    def __init__(self, email):
-        self.email = email
-        self.is_authenticated = True
-        self.is_active = True
-        self.is_anonymous = False
+@app.errorhandler(credentials.CredentialStoreBusy)
+def credential_store_busy(error):
+    """Too many people are logging in at once; ask this one to try again shortly."""
+    return 'Too many logins right now. Please try again in a moment.', 503, {'Retry-After': '5'}
+
+
+def find_user(email):
+    """Look a user up in the "database". Returns a User, or None if there is no such user."""
+    if email in credential_store:
+        return User(email)
+    return None
 
-    def get_id(self):
-        """Return the unique ID for this user. Used by Flask-Login to keep track of the user in the session object."""
-        return self.email
 
-    def __repr__(self):
-        return "<User '{}' {} {} {}>".format(self.email, self.is_authenticated, self.is_active, self.is_anonymous)
+# Flask-Login calls the user loader on every request to recreate the current user object
+# based on the unique ID it stored previously the session object. UserLoader remembers
+# recent users, so most requests don't have to look the user up at all (see users.py).
+user_loader = users.UserLoader(find_user, users.user_cache_size, users.user_cache_ttl, users.user_cache_enabled,
+                               key=credentials.normalize_email)
+
+# Forget a cached user when their details change or they log out.
+credential_store.listeners.append(user_loader.invalidate)
+
+
+@user_logged_out.connect_via(app)
+def forget_logged_out_user(sender, user):
+    user_loader.invalidate(user.get_id())
 
 
-# Flask-Login calls this function on every request to recreate the current user object
-# based on the unique ID it stored previously the session object.
 @login_mgr.user_loader
 def load_user(id):
     """Return the currently logged-in user when given the user's unique ID"""
-    return User(id)
+    return user_loader(id)
+
+
+@app.route('/stats/user-cache')
+def user_cache_stats():
+    return jsonify(user_loader.stats())
+
+
+# Limit login attempts, per client and per account (see ratelimit.py). A client
+# gets 10 tries, then one every 6 seconds; an account gets 5, then one a minute.
+# Set LOGIN_RATE_LIMIT_DB to a file name to share the limits between processes.
+# (Behind a proxy, use werkzeug's ProxyFix so remote_addr is the real client.)
+if os.environ.get('LOGIN_RATE_LIMIT_DB'):
+    client_buckets = account_buckets = ratelimit.SQLiteBuckets(os.environ['LOGIN_RATE_LIMIT_DB'])
+else:
+    client_buckets = ratelimit.LocalBuckets()
+    # Never drop an account's bucket to make room, or trying lots of made-up
+    # addresses would reset the limit on a real one.
+    account_buckets = ratelimit.LocalBuckets(when_full='reject')
+client_limiter = ratelimit.RateLimiter('client', rate=1 / 6, burst=10, backend=client_buckets)
+account_limiter = ratelimit.RateLimiter('account', rate=1 / 60, burst=5, backend=account_buckets)
+
+
+@app.before_request
+def limit_login_attempts():
+    """Refuse login attempts over the limits before doing any real work."""
+    if request.endpoint != 'login' or request.method != 'POST':
+        return None
+    # The client's limit is cheap, so it comes first, before the form is even read.
+    wait = client_limiter.take(request.remote_addr)
+    if wait:
+        return ratelimit.too_many_requests(wait)
+    # The account's limit needs the e-mail address, but still comes
+    # before the form is validated and the password is checked.
+    wait = account_limiter.take(credentials.normalize_email(request.form.get('email', '')))
+    if wait:
+        return ratelimit.too_many_requests(wait)
+    return None
+
+
+@app.route('/stats/rate-limits')
+def rate_limit_stats():
+    return jsonify([client_limiter.stats(), account_limiter.stats()])
 
 
-class LoginForm(Form):
+class LoginForm(FlaskForm):
     email = StringField('E-mail Address', validators=[DataRequired()])
     password = PasswordField('Password', validators=[DataRequired()])
     submit = SubmitField('Log In')
@@ -0,0 +1,173 @@
+# Token-bucket rate limiting for the login page.
+#
+# Each key (a client's IP address, or an account's e-mail) has a bucket that
+# holds up to `burst` tokens and refills at `rate` tokens per second. Each
+# attempt takes a token; with the bucket empty, the attempt is refused until
+# a token refills. So a person mistyping a password a few times is never
+# bothered, but a script trying thousands of passwords gets `rate` tries per
+# second at most.
+#
+# A bucket is just (tokens, time last updated), and there are at most
+# `max_keys` of them, so memory stays bounded however many keys show up.
+# A bucket that has refilled is the same as no bucket, so those are dropped
+# to make room. If none have refilled, LocalBuckets either drops the least
+# recently used bucket (when_full='evict') or refuses the new key until one
+# refills (when_full='reject'). Account limits must use 'reject': otherwise
+# an attacker could reset an account's bucket by trying a flood of made-up
+# addresses until it is dropped.
+#
+# This module is shared by the login example and "03 - sessions (WT Forms)".
+#
+# LocalBuckets keeps the buckets in this process. When the app runs as several
+# processes, each would have its own buckets (and allow several times the
+# rate), so SQLiteBuckets keeps them in a file they all share instead. A
+# deployment over several machines would do the same with a shared store
+# such as Redis.
+
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalBuckets(object):
+    """Token buckets kept in memory, in this process only.
+
+    `when_full` says what happens to a new key when there are already
+    `max_keys` buckets and none has refilled: 'evict' drops the least
+    recently used bucket, 'reject' refuses the new key.
+    """
+
+    def __init__(self, max_keys=10000, when_full='evict'):
+        if when_full not in ('evict', 'reject'):
+            raise ValueError("when_full must be 'evict' or 'reject'")
+        self.max_keys = max_keys
+        self.when_full = when_full
+        self._buckets = OrderedDict()  # key -> (tokens, time updated, time full again)
+        self._next_full = 0.0  # No bucket is full again before this
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.rejections = 0
+
+    def take(self, key, rate, burst, now=None):
+        """Take a token from the bucket for `key`. Returns 0.0 if one was available,
+        otherwise the number of seconds until there will be one."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None and len(self._buckets) >= self.max_keys and not self._make_room(now):
+                self.rejections += 1
+                return self._next_full - now
+            tokens, updated, _ = bucket or (burst, now, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if wait == 0.0:
+                tokens -= 1
+            full_at = now + (burst - tokens) / rate
+            self._buckets[key] = (tokens, now, full_at)
+            self._buckets.move_to_end(key)
+            self._next_full = min(self._next_full, full_at)
+        return wait
+
+    def _make_room(self, now):
+        """Make room for a new bucket. Call with the lock held. Returns False if there is none."""
+        # Only look through the buckets once one can have refilled, so a flood
+        # of new keys while we're full doesn't cost a scan each.
+        if now >= self._next_full:
+            refilled = [key for key, (_, _, full_at) in self._buckets.items() if full_at <= now]
+            for key in refilled:
+                del self._buckets[key]
+            self._next_full = min((full_at for _, _, full_at in self._buckets.values()), default=math.inf)
+            if refilled:
+                return True
+        if self.when_full == 'evict':
+            self._buckets.popitem(last=False)
+            self.evictions += 1
+            return True
+        return False
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SQLiteBuckets(object):
+    """Token buckets kept in an SQLite file, shared by every process that opens it.
+
+    Idle buckets are deleted every `sweep_interval` seconds; a bucket that has
+    been idle long enough to refill is the same as no bucket at all.
+    """
+
+    def __init__(self, path, sweep_interval=60.0):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._next_sweep = 0.0
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket '
+                               '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def _connection(self):
+        # SQLite connections can't be shared between threads, so each thread opens its own.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, rate, burst, now=None):
+        """Take a token from the bucket for `key` (see LocalBuckets.take)."""
+        # Wall-clock time, since the processes sharing the file don't share a monotonic clock.
+        now = time.time() if now is None else now
+        connection = self._connection()
+        # BEGIN IMMEDIATE locks the file for writing, so two processes can't both take the last token.
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row is not None else (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            connection.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                               (key, tokens - 1 if wait == 0.0 else tokens, now))
+            if now >= self._next_sweep:
+                # Anything untouched for an hour has refilled at any sensible rate.
+                connection.execute('DELETE FROM bucket WHERE updated < ?', (now - 3600,))
+                self._next_sweep = now + self.sweep_interval
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class RateLimiter(object):
+    """Allow `burst` attempts at once per key, refilling at `rate` attempts per second."""
+
+    def __init__(self, name, rate, burst, backend=None):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.backend = backend if backend is not None else LocalBuckets()
+        self.allowed = 0
+        self.rejected = 0
+
+    def take(self, key):
+        """Count an attempt for `key`. Returns 0.0 if it's allowed, or the seconds to wait if not."""
+        # Limiters can share a backend, so keep their keys apart.
+        wait = self.backend.take('{}:{}'.format(self.name, key), self.rate, self.burst)
+        if wait:
+            self.rejected += 1
+        else:
+            self.allowed += 1
+        return wait
+
+    def stats(self):
+        return {'name': self.name, 'rate': self.rate, 'burst': self.burst,
+                'allowed': self.allowed, 'rejected': self.rejected}
+
+
+def too_many_requests(wait):
+    """A short plain-text 429 response. No template, no session: refusing should cost next to nothing."""
+    return 'Too many login attempts. Try again in {} seconds.\n'.format(int(wait) + 1), 429, \
+        {'Retry-After': str(int(wait) + 1), 'Content-Type': 'text/plain'}
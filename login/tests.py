@@ -0,0 +1,39 @@
+import time
+import unittest
+
+import credentials
+
+
+class CredentialStoreTestCase(unittest.TestCase):
+    """Test the credential store."""
+
+    def setUp(self):
+        self.store = credentials.CredentialStore(iterations=1000, workers=1, max_waiting=1)
+        self.store.add_user('Fred@Ziffle.com', 'password!0!')
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_verify(self):
+        self.assertTrue(self.store.verify('fred@ziffle.com ', 'password!0!'))
+        self.assertFalse(self.store.verify('fred@ziffle.com', 'wrong'))
+        self.assertFalse(self.store.verify('nobody@ziffle.com', 'password!0!'))
+
+    def test_busy_without_waiting(self):
+        """Once every slot is running or queued, the next login is refused at once."""
+        for n in range(2):
+            self.assertTrue(self.store._slots.acquire(blocking=False))
+        try:
+            start = time.perf_counter()
+            with self.assertRaises(credentials.CredentialStoreBusy):
+                self.store.verify('fred@ziffle.com', 'password!0!')
+            self.assertLess(time.perf_counter() - start, 0.5)
+        finally:
+            for n in range(2):
+                self.store._slots.release()
+        self.assertTrue(self.store.verify('fred@ziffle.com', 'password!0!'))
+
+
+# Do the right thing if this file is run standalone.
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+# Loading the logged-in user for examples-login.py.
+#
+# Flask-Login calls the user loader on every request from a logged-in user.
+# With a real user database behind it, that would be one lookup per page view,
+# so the loader keeps recently used users in a small LRU cache whose entries
+# also expire after `ttl` seconds. Logging out, or changing a user's details,
+# removes the user from the cache so the next request looks them up again.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+user_cache_size = 1024  # Most users kept in memory
+user_cache_ttl = 300.0  # Seconds before a cached user is looked up again
+user_cache_enabled = os.environ.get('USER_CACHE', 'on') != 'off'
+
+
+class User(object):
+    """The currently logged-in user (if there is one). Only stores the user's e-mail.
+
+    Flask-Login's flags are the same for every logged-in user, so they are
+    class attributes; __slots__ leaves each instance with just its e-mail
+    address, rather than a dictionary of attributes.
+    """
+    __slots__ = ('email',)
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, email):
+        self.email = email
+
+    def get_id(self):
+        """Return the unique ID for this user. Used by Flask-Login to keep track of the user in the session object."""
+        return self.email
+
+    def __repr__(self):
+        return "<User '{}' {} {} {}>".format(self.email, self.is_authenticated, self.is_active, self.is_anonymous)
+
+
+class UserLoader(object):
+    """Look users up by ID with `lookup(id)`, keeping recent answers in a thread-safe LRU/TTL cache.
+
+    `key(id)` gives the cache key for an ID, for IDs that can be written more
+    than one way (such as e-mail addresses in any case).
+    Set `enabled` to False to send every call straight to `lookup`.
+    """
+
+    def __init__(self, lookup, max_size=1024, ttl=300.0, enabled=True, key=None):
+        self.lookup = lookup
+        self.key = key or (lambda user_id: user_id)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = enabled
+        self._entries = OrderedDict()  # key -> (user, expiry time)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __call__(self, user_id):
+        """Return the user with this ID, or None if there is no such user."""
+        if not self.enabled:
+            with self._lock:
+                self.misses += 1
+            return self.lookup(user_id)
+
+        key = self.key(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+
+        user = self.lookup(user_id)
+        # Unknown IDs aren't cached, so a user who signs up afterwards is found.
+        if user is not None:
+            with self._lock:
+                self._entries[key] = (user, time.monotonic() + self.ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return user
+
+    def invalidate(self, user_id):
+        """Forget a user, for example when they log out or their details change."""
+        with self._lock:
+            if self._entries.pop(self.key(user_id), None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return a dictionary of cache counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
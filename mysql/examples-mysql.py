@@ -1,19 +1,108 @@
-from flask import Flask, render_template, redirect, url_for
-from flask.ext.wtf import Form
+import csv
+import io
+import json
+import os
+import threading
+import time
+
+from flask import Flask, render_template, redirect, url_for, request, jsonify, Response, stream_with_context
+from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired
 
 import mysql.connector
+import mysql.connector.pooling
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'very secret-y key value; shhhhh!'
 
+# Update to correspond to your MySQL server and schema,
+# or set these environment variables.
+db_settings = {
+    'user': os.environ.get('MYSQL_USER', 'test'),
+    'password': os.environ.get('MYSQL_PASSWORD', 'password'),
+    'host': os.environ.get('MYSQL_HOST', 'localhost'),
+    'port': int(os.environ.get('MYSQL_PORT', 3306)),
+    'database': os.environ.get('MYSQL_DATABASE', 'flask_test'),
+}
+
+# Connections are kept open in a pool and reused, instead of connecting
+# (and logging in) again for every request. mysql.connector allows at most
+# 32 connections per pool. When all of them are in use, db_connect waits up
+# to pool_timeout seconds for one to be returned before giving up.
+pool_size = int(os.environ.get('MYSQL_POOL_SIZE', 5))
+pool_timeout = float(os.environ.get('MYSQL_POOL_TIMEOUT', 10.0))
+
+# Rows fetched from the server at a time when streaming a table.
+fetch_size = 500
+
+# Rows sent to the server in each multi-row INSERT by create_users.
+insert_chunk_size = 1000
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the connection pool, creating it the first time."""
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = mysql.connector.pooling.MySQLConnectionPool(pool_name='examples', pool_size=pool_size,
+                                                               **db_settings)
+        return pool
+
+
+def db_connect(timeout=None):
+    """Take a connection from the pool. Calling close() on it puts it back.
+
+    Waits up to `timeout` seconds (default `pool_timeout`) if every pooled
+    connection is in use, then raises mysql.connector.errors.PoolError.
+    """
+    deadline = time.monotonic() + (pool_timeout if timeout is None else timeout)
+    while True:
+        try:
+            return get_pool().get_connection()
+        except mysql.connector.errors.PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.01)
+
+
+def stream_users():
+    """Yield every user as a (username, password) row, ordered by user name.
+
+    The cursor is unbuffered, so rows stay on the server until we fetch
+    them, `fetch_size` at a time; memory use doesn't grow with the table.
+    The connection is held until the last row is read.
+    """
+    conn = db_connect()
+    try:
+        cursor = conn.cursor(buffered=False)
+        cursor.execute("SELECT username, password FROM user ORDER BY username")
+        rows = cursor.fetchmany(fetch_size)
+        while rows:
+            for row in rows:
+                yield row
+            rows = cursor.fetchmany(fetch_size)
+        cursor.close()
+    finally:
+        # If the page was abandoned part way, the rest of the rows still have
+        # to be read before the connection can be used again.
+        if conn.unread_result:
+            conn.consume_results()
+        conn.close()
+
+
+def stream_template(template_name, **context):
+    """Render a template a piece at a time instead of building one big string."""
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(5)
+    return stream
 
-def db_connect():
-    # Update to correspond to your MySQL server and schema.
-    conn = mysql.connector.connect(user='test', password='password',
-                                   host='localhost', database='flask_test')
-    return conn
 
 @app.route('/')
 def index():
@@ -22,15 +111,12 @@ def index():
 
 @app.route('/users')
 def show_users():
-    conn = db_connect()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM user")
-    users = cursor.fetchall()
-    conn.close()
-    return render_template('show-users.html', users=users)
+    # The page is sent while the rows arrive, so a big user table
+    # never has to fit in memory.
+    return Response(stream_with_context(stream_template('show-users.html', users=stream_users())))
 
 
-class UserForm(Form):
+class UserForm(FlaskForm):
     username = StringField('User Name', validators=[DataRequired()])
     password = PasswordField('Password', validators=[DataRequired()])
     submit = SubmitField('Submit User')
@@ -41,14 +127,158 @@ def add_user():
     user_form = UserForm()
     if user_form.validate_on_submit():
         conn = db_connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO user (username, password) VALUES (%(username)s, %(password)s)",
+                           {'username': user_form.username.data,
+                            'password': user_form.password.data})
+            conn.commit()
+        finally:
+            conn.close()
+        return redirect(url_for('show_users'))
+    return render_template('add-user.html', form=user_form)
+
+
+# Bulk Creation ########################################
+
+# The longest values the user table can hold (see create-db.sql).
+user_column_lengths = {'username': 40, 'password': 45}
+
+
+def validate_user(row):
+    """Check one user the way UserForm would. Returns a list of error messages (empty if it's fine).
+
+    Like DataRequired, a value that is missing or only spaces doesn't count.
+    Values too long for their column are caught here too, rather than
+    failing the whole upload when they reach the database.
+    """
+    errors = []
+    for column, max_length in user_column_lengths.items():
+        value = row.get(column)
+        if not isinstance(value, str) or not value.strip():
+            errors.append('{} is required'.format(column))
+        elif len(value) > max_length:
+            errors.append('{} is longer than {} characters'.format(column, max_length))
+    return errors
+
+
+def username_key(username):
+    """Return what MySQL compares when it checks user names for duplicates.
+
+    With the default collations, 'Fred', 'fred', and 'fred ' are all the same user.
+    """
+    return username.rstrip().lower()
+
+
+def create_users(rows, chunk_size=None):
+    """Validate and insert many users in one transaction.
+
+    `rows` is an iterable of (row number, dictionary) pairs. Rows that fail
+    validation, repeat a user name from earlier in the upload, or name a user
+    who already exists are skipped and reported; the rest are inserted with
+    executemany, which mysql.connector turns into one multi-row INSERT per
+    chunk of `chunk_size` rows. Everything is committed once at the end, so
+    if the database refuses a chunk nothing from the upload is stored.
+
+    Returns a dictionary with the number of rows read and created, the
+    errors as (row number, message) pairs, and the rows per second.
+    """
+    chunk_size = chunk_size or insert_chunk_size
+    start = time.perf_counter()
+    totals = {'read': 0, 'created': 0, 'errors': []}
+    seen = set()
+    conn = db_connect()
+    try:
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO user (username, password) VALUES (%(username)s, %(password)s)",
-                       {'username': user_form.username.data,
-                        'password': user_form.password.data})
+
+        def insert(chunk):
+            # Leave out users who are already in the table.
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cursor.execute('SELECT username FROM user WHERE username IN ({})'.format(placeholders),
+                           [row['username'] for number, row in chunk])
+            existing = {username_key(username) for (username,) in cursor.fetchall()}
+            new_users = []
+            for number, row in chunk:
+                if username_key(row['username']) in existing:
+                    totals['errors'].append((number, 'user {} already exists'.format(row['username'])))
+                else:
+                    new_users.append((row['username'], row['password']))
+            if new_users:
+                cursor.executemany('INSERT INTO user (username, password) VALUES (%s, %s)', new_users)
+                totals['created'] += len(new_users)
+
+        chunk = []
+        for number, row in rows:
+            totals['read'] += 1
+            errors = validate_user(row) if isinstance(row, dict) else ['expected an object with username and password']
+            if not errors and username_key(row['username']) in seen:
+                errors = ['user {} appears more than once'.format(row['username'])]
+            if errors:
+                totals['errors'].extend((number, error) for error in errors)
+                continue
+            seen.add(username_key(row['username']))
+            chunk.append((number, row))
+            if len(chunk) >= chunk_size:
+                insert(chunk)
+                chunk = []
+        if chunk:
+            insert(chunk)
         conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
         conn.close()
-        return redirect(url_for('show_users'))
-    return render_template('add-user.html', form=user_form)
+
+    seconds = time.perf_counter() - start
+    totals['seconds'] = seconds
+    totals['rows_per_second'] = totals['read'] / seconds if seconds else 0.0
+    return totals
+
+
+def read_upload(file_name, stream):
+    """Yield (row number, row) pairs from an uploaded CSV (with a header row) or JSON (a list of objects) file."""
+    if file_name.lower().endswith('.json'):
+        rows = json.load(io.TextIOWrapper(stream, encoding='utf-8'))
+        if not isinstance(rows, list):
+            raise ValueError('expected a JSON list of users')
+        return enumerate(rows, start=1)
+    # Row numbers count the header, so they match the line in a spreadsheet.
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8', newline=''))
+    return ((reader.line_num, row) for row in reader)
+
+
+class BulkUserForm(FlaskForm):
+    users = FileField('Users (CSV with username and password columns, or JSON)', validators=[FileRequired()])
+    submit = SubmitField('Upload Users')
+
+
+# Upload many users at once, either as a file from the form, or as a JSON
+# body like {"users": [{"username": ..., "password": ...}, ...]}.
+@app.route('/users/bulk', methods=['GET', 'POST'])
+def bulk_add_users():
+    if request.is_json:
+        body = request.get_json(silent=True)
+        users = body.get('users') if isinstance(body, dict) else None
+        if not isinstance(users, list):
+            return jsonify(error='Expected {"users": [...]}'), 400
+        try:
+            totals = create_users(enumerate(users, start=1))
+        except mysql.connector.Error as err:
+            return jsonify(error=str(err)), 409
+        return jsonify(totals)
+
+    bulk_form = BulkUserForm()
+    totals = error = None
+    if bulk_form.validate_on_submit():
+        upload = bulk_form.users.data
+        try:
+            totals = create_users(read_upload(upload.filename, upload.stream))
+        except (ValueError, csv.Error) as err:
+            error = 'Could not read {}: {}'.format(upload.filename, err)
+        except mysql.connector.Error as err:
+            error = 'Nothing was stored: {}'.format(err)
+    return render_template('bulk-add-users.html', form=bulk_form, totals=totals, error=error)
 
 if __name__ == '__main__':
     app.run(debug=True)